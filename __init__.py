@@ -42,12 +42,13 @@ if "decompose" in locals():
     imp.reload(utils)
     if DEBUG and "testing" in locals(): imp.reload(testing)
 
-from .decompose import TOptions, Scan
+from .decompose import TOptions, Scan, EvaluatedMeshesUpdate, ClearEvaluatedMeshes, PruneEvaluatedMeshes
 from .export_urho import UrhoExportData, UrhoExportOptions, UrhoWriteModel, UrhoWriteAnimation, \
                          UrhoWriteTriggers, UrhoExport
 from .export_scene import SOptions, UrhoScene, UrhoExportScene, UrhoWriteMaterialTrees
 from .utils import PathType, FOptions, GetFilepath, CheckFilepath, ErrorsMem,IsJsonNodeAddonAvailable,IsBConnectAddonAvailable, getLodSetWithID,getObjectWithID, execution_queue, \
-                    PingData,set_found_blender_runtime,found_blender_runtime, PingForRuntime
+                    PingData,set_found_blender_runtime,found_blender_runtime, PingForRuntime, \
+                    DiskCache, DISK_CACHE_DIR, TempDatablocks
 
 
 if DEBUG: from .testing import PrintUrhoData, PrintAll
@@ -73,9 +74,6 @@ import subprocess
 import json
 from .networking import BCONNECT_AVAILABLE
 
-# object-array to keep track of temporary objects created just for the export-process(like for the lodsets)
-tempObjects = []
-
 if IsJsonNodeAddonAvailable():
     import JSONNodetreeUtils    
 
@@ -864,6 +862,7 @@ class UrhoExportMeshSettings(bpy.types.PropertyGroup):
         obj_vertex.export_pos = self.export_pos
         obj_vertex.export_norm = self.export_norm
         obj_vertex.export_tan = self.export_tan
+        obj_vertex.tangent_method = self.tangent_method
         obj_vertex.export_uv = self.export_uv
         obj_vertex.export_vcol = self.export_vcol
         obj_vertex.export_morph = self.export_morph
@@ -882,6 +881,12 @@ class UrhoExportMeshSettings(bpy.types.PropertyGroup):
     export_pos : bpy.props.BoolProperty(default=True,update=update)
     export_norm: bpy.props.BoolProperty(default=True,update=update)
     export_tan: bpy.props.BoolProperty(default=False,update=update)
+    tangent_method : bpy.props.EnumProperty(
+            name = "Tangents",
+            description = "How to calculate the tangents (morphs always use the exporter)",
+            items = (('EXPORTER', "Exporter", "Calculate tangents in the exporter"),
+                     ('MIKKTSPACE', "MikkTSpace", "Use Blender MikkTSpace tangents (faster, needs triangles and quads only)")),
+            default = 'EXPORTER')
     export_uv : bpy.props.BoolProperty(default=True,update=update)
     export_vcol : bpy.props.BoolProperty(default=False,update=update)
     export_morph: bpy.props.BoolProperty(default=False,update=update)
@@ -1058,11 +1063,14 @@ class UrhoExportSettings(bpy.types.PropertyGroup):
 
         self.useSubDirs = True
         self.fileOverwrite = False
+        self.useDiskCache = False
+        self.diskCacheSize = 256
 
         self.source = 'ALL'
         self.scale = 1.0
         self.modifiers = False
         self.modifiersRes = 'PREVIEW'
+        self.useEvaluatedCache = True
         self.origin = 'LOCAL'
         self.selectErrors = True
         self.forceElements = False
@@ -1072,9 +1080,16 @@ class UrhoExportSettings(bpy.types.PropertyGroup):
         self.lods = False
         self.strictLods = True
         self.optimizeIndices = False
+        self.optimizeIndicesMode = 'FORSYTH'
+        self.vertexCacheSize = 32
+        self.optimizeIndicesWorkers = 0
+        self.optimizeOverdraw = False
+        self.overdrawThreshold = 1.05
+        self.weldTolerance = 0.0
 
         self.skeletons = False
         self.onlyKeyedBones = False
+        self.bakeWorkers = 0
         self.onlyDeformBones = Falsegeometry
         self.animationExtraFrame = True
         self.animationTriggers = False
@@ -1083,6 +1098,11 @@ class UrhoExportSettings(bpy.types.PropertyGroup):
         self.animationRot = True
         self.animationSca = False
         self.filterSingleKeyFrames = False
+        self.reduceKeyframes = False
+        self.stripConstantChannels = True
+        self.reducePositionTolerance = 0.001
+        self.reduceRotationTolerance = 0.1
+        self.reduceScaleTolerance = 0.001
 
         self.geometries = True
         self.geometryPos = True
@@ -1262,6 +1282,18 @@ class UrhoExportSettings(bpy.types.PropertyGroup):
             description = "If enabled existing files are overwritten without warnings",
             default = True)
 
+    useDiskCache : BoolProperty(
+            name = "Use cache",
+            description = "Save the optimized indices and the decomposed actions in a cache folder in "
+                          "the output path, unchanged objects and actions are not processed again",
+            default = False)
+
+    diskCacheSize : IntProperty(
+            name = "Cache size (MB)",
+            description = "Maximum size of the cache folder, the least recently used data is deleted",
+            min = 1, max = 65536,
+            default = 256)
+
     # --- Source settings ---
             
     source : EnumProperty(
@@ -1298,6 +1330,12 @@ class UrhoExportSettings(bpy.types.PropertyGroup):
             description = "Apply the object modifiers before exporting",
             default = True)
 
+    useEvaluatedCache : BoolProperty(
+            name = "Cache evaluated meshes",
+            description = "Keep the meshes evaluated with modifiers between exports, an object is "
+                          "evaluated again only when it or its inputs change",
+            default = True)
+
     modifiersRes : EnumProperty(
             name = "Modifiers setting",
             description = "Resolution setting to use while applying modifiers",
@@ -1383,10 +1421,52 @@ class UrhoExportSettings(bpy.types.PropertyGroup):
             default = True)
             
     optimizeIndices : BoolProperty(
-            name = "Optimize indices (slow)",
-            description = "Linear-Speed vertex cache optimisation",
+            name = "Optimize indices",
+            description = "Sort triangles for the vertex cache",
+            default = False)
+
+    optimizeIndicesMode : EnumProperty(
+            name = "Mode",
+            description = "Vertex cache optimisation algorithm",
+            items = (('FORSYTH', "Forsyth", "Linear-Speed Vertex Cache Optimisation (Tom Forsyth), slower"),
+                     ('TIPSIFY', "Tipsify", "Tipsify (Sander et al.), faster")),
+            default = 'FORSYTH')
+
+    vertexCacheSize : IntProperty(
+            name = "Cache size",
+            description = "Size of the vertex cache to optimize for",
+            min = 4, max = 64,
+            default = 32)
+
+    optimizeIndicesWorkers : IntProperty(
+            name = "Workers",
+            description = "Number of worker processes optimizing the geometries in parallel (0 = inside Blender)",
+            min = 0, max = 64,
+            default = 0)
+
+    optimizeOverdraw : BoolProperty(
+            name = "Reduce overdraw",
+            description = "After the vertex cache optimisation, sort clusters of triangles to reduce overdraw",
             default = False)
 
+    overdrawThreshold : FloatProperty(
+            name = "Threshold",
+            description = "Higher values give less overdraw but more vertex cache misses",
+            default = 1.05,
+            min = 1.0,
+            max = 3.0,
+            step = 1,
+            precision = 2)
+
+    weldTolerance : FloatProperty(
+            name = "Weld tolerance",
+            description = "Merge vertices whose attributes differ less than this value (0 = exact match)",
+            default = 0.0,
+            min = 0.0,
+            max = 1.0,
+            step = 0.01,
+            precision = 5)
+
     # --- Components settings ---
 
     skeletons : BoolProperty(
@@ -1417,6 +1497,13 @@ class UrhoExportSettings(bpy.types.PropertyGroup):
             description = "Should be much faster than updating the whole scene, usable only for Actions and for Quaternion rotations",
             default = False)
 
+    bakeWorkers : IntProperty(
+            name = "Background processes",
+            description = "Number of background Blender processes decomposing the Actions in parallel "
+                          "(0 = inside this Blender), the blend file must be saved",
+            min = 0, max = 64,
+            default = 0)
+
     derigify : BoolProperty(
             name = "Derigify",
             description = "Remove extra bones from Rigify armature",
@@ -1499,6 +1586,44 @@ class UrhoExportSettings(bpy.types.PropertyGroup):
             description = "Do not export tracks which contain only one keyframe, useful for layered animations",
             default = False)
 
+    stripConstantChannels : BoolProperty(
+            name = "Remove constant channels",
+            description = "Remove from each track the position, rotation or scale which are constant "
+                          "and equal to the bind pose, remove the tracks without channels",
+            default = True)
+
+    reduceKeyframes : BoolProperty(
+            name = "Reduce keyframes",
+            description = "Remove the keyframes that can be rebuilt by interpolation within the tolerances",
+            default = False)
+
+    reducePositionTolerance : FloatProperty(
+            name = "Position",
+            description = "Maximum position error of the removed keyframes (world units)",
+            default = 0.001,
+            min = 0.0,
+            max = 1.0,
+            step = 0.01,
+            precision = 4)
+
+    reduceRotationTolerance : FloatProperty(
+            name = "Rotation",
+            description = "Maximum rotation error of the removed keyframes (degrees)",
+            default = 0.1,
+            min = 0.0,
+            max = 45.0,
+            step = 1,
+            precision = 3)
+
+    reduceScaleTolerance : FloatProperty(
+            name = "Scale",
+            description = "Maximum scale error of the removed keyframes",
+            default = 0.001,
+            min = 0.0,
+            max = 1.0,
+            step = 0.01,
+            precision = 4)
+
     geometries : BoolProperty(
             name = "Geometries",
             description = "Export vertex buffers, index buffers, geometries, lods",
@@ -2090,6 +2215,9 @@ class UrhoExportMeshPanel(bpy.types.Panel):
         col.prop(mesh.urho_export,"export_tan",text="Tangent")
         col.enabled = mesh.urho_export.export_uv and mesh.urho_export.export_norm and mesh.urho_export.export_pos
         row.prop(mesh.urho_export,"export_vcol",text="Vertex Color")
+        if mesh.urho_export.export_tan:
+            row = layout.row()
+            row.prop(mesh.urho_export,"tangent_method",expand=True)
         row = layout.row()
         row.prop(mesh.urho_export,"export_weight",text="Weights")
         row.prop(mesh.urho_export,"export_morph",text="Morphs")
@@ -2227,6 +2355,10 @@ class UrhoExportRenderPanel(bpy.types.Panel):
         box.prop(settings, "exportOnSave")
         box.prop(settings, "fileOverwrite")
         row = box.row()
+        row.prop(settings, "useDiskCache")
+        if settings.useDiskCache:
+            row.prop(settings, "diskCacheSize")
+        row = box.row()
         row.prop(settings, "useSubDirs")
         showDirsIcon = 'ZOOM_OUT' if settings.showDirs else 'ZOOM_IN'
         if settings.showDirs:
@@ -2319,6 +2451,10 @@ class UrhoExportRenderPanel(bpy.types.Panel):
         #box.prop(settings, "scale")
         
         box.prop(settings, "modifiers")
+        if settings.modifiers:
+            row = box.row()
+            row.separator()
+            row.prop(settings, "useEvaluatedCache")
         
         # if settings.modifiers:
         #     row = box.row()
@@ -2346,6 +2482,18 @@ class UrhoExportRenderPanel(bpy.types.Panel):
         #TODO: what and why
         #box.prop(settings, "geometrySplit")
         box.prop(settings, "optimizeIndices")
+        if settings.optimizeIndices:
+            row = box.row()
+            row.separator()
+            row.prop(settings, "optimizeIndicesMode")
+            row.prop(settings, "vertexCacheSize")
+            row.prop(settings, "optimizeIndicesWorkers")
+            row = box.row()
+            row.separator()
+            row.prop(settings, "optimizeOverdraw")
+            if settings.optimizeOverdraw:
+                row.prop(settings, "overdrawThreshold")
+        box.prop(settings, "weldTolerance")
         box.prop(settings, "lods")
         if settings.lods:
             row = box.row()
@@ -2393,11 +2541,22 @@ class UrhoExportRenderPanel(bpy.types.Panel):
             col = column.row()
             col.enabled = 'ACTION' in settings.animationSource
             col.prop(settings, "actionsByFcurves")
+            col = column.row()
+            col.enabled = 'ACTION' in settings.animationSource
+            col.prop(settings, "bakeWorkers")
             row = column.row()
             row.prop(settings, "animationPos")
             row.prop(settings, "animationRot")
             row.prop(settings, "animationSca")
             column.prop(settings, "filterSingleKeyFrames")
+            column.prop(settings, "stripConstantChannels")
+            column.prop(settings, "reduceKeyframes")
+            if settings.reduceKeyframes:
+                row = column.row()
+                row.separator()
+                row.prop(settings, "reducePositionTolerance")
+                row.prop(settings, "reduceRotationTolerance")
+                row.prop(settings, "reduceScaleTolerance")
         
         row = box.row()
         row.prop(settings, "geometries")
@@ -2637,6 +2796,7 @@ def PostLoad(dummy):
     addonPrefs = bpy.context.preferences.addons[__name__].preferences
     settings = bpy.context.scene.urho_exportsettings
     settings.errorsMem.Clear()
+    ClearEvaluatedMeshes()
     settings.updatingProperties = False
     settings.reset_paths(bpy.context, False)
 
@@ -2943,6 +3103,9 @@ def register():
     if not PostSave in bpy.app.handlers.save_post:
         bpy.app.handlers.save_post.append(PostSave)
 
+    if not EvaluatedMeshesUpdate in bpy.app.handlers.depsgraph_update_post:
+        bpy.app.handlers.depsgraph_update_post.append(EvaluatedMeshesUpdate)
+
     bpy.app.timers.register(call_execution_queue,persistent=True)        
 
     # handle the shortcuts
@@ -3040,6 +3203,9 @@ def unregister():
         bpy.app.handlers.load_post.remove(PostLoad)
     if PostSave in bpy.app.handlers.save_post:
         bpy.app.handlers.save_post.remove(PostSave)
+    if EvaluatedMeshesUpdate in bpy.app.handlers.depsgraph_update_post:
+        bpy.app.handlers.depsgraph_update_post.remove(EvaluatedMeshesUpdate)
+    ClearEvaluatedMeshes()
 
     #unregister keyboard shortcuts
     wm = bpy.context.window_manager
@@ -3157,7 +3323,9 @@ def ExecuteUrhoExportMaterialsOnly(context):
 #-------------------------------------------------------------------------
 
 
-def ExecuteUrhoExport(context):
+# Temporary objects created just for the export-process (like for the lodsets) are
+# owned by 'tempDatablocks'
+def ExecuteUrhoExport(context, tempDatablocks):
     global logList
 
     # Check Blender version
@@ -3198,11 +3366,16 @@ def ExecuteUrhoExport(context):
     tOptions.globalOrigin = (settings.origin == 'GLOBAL')
     tOptions.applyModifiers = settings.modifiers
     tOptions.applySettings = settings.modifiersRes
+    tOptions.useEvaluatedCache = settings.useEvaluatedCache
     tOptions.doBones = settings.skeletons
     tOptions.doOnlyKeyedBones = settings.onlyKeyedBones
     tOptions.doOnlyDeformBones = settings.onlyDeformBones
     tOptions.doOnlyVisibleBones = settings.onlyVisibleBones
     tOptions.actionsByFcurves = settings.actionsByFcurves
+    tOptions.bakeWorkers = settings.bakeWorkers
+    # Background processes load the saved file, it must be up to date
+    if bpy.data.filepath and not bpy.data.is_dirty:
+        tOptions.bakeFilepath = bpy.data.filepath
     tOptions.skinBoneParent = settings.parentBoneSkinning
     tOptions.derigifyArmature = settings.derigify
     tOptions.doAnimations = settings.animations
@@ -3222,6 +3395,10 @@ def ExecuteUrhoExport(context):
     tOptions.doAnimationRot = settings.animationRot
     tOptions.doAnimationSca = settings.animationSca
     tOptions.filterSingleKeyFrames = settings.filterSingleKeyFrames
+    tOptions.doReduceKeyframes = settings.reduceKeyframes
+    tOptions.reducePositionTolerance = settings.reducePositionTolerance
+    tOptions.reduceRotationTolerance = settings.reduceRotationTolerance
+    tOptions.reduceScaleTolerance = settings.reduceScaleTolerance
     tOptions.doGeometries = settings.geometries
     tOptions.doGeometryPos = settings.geometryPos
     tOptions.doGeometryNor = settings.geometryNor
@@ -3236,6 +3413,16 @@ def ExecuteUrhoExport(context):
     tOptions.doMorphTan = settings.morphTan
     tOptions.doMorphUV = settings.morphTan
     tOptions.doOptimizeIndices = settings.optimizeIndices
+    tOptions.optimizeIndicesMode = settings.optimizeIndicesMode
+    tOptions.vertexCacheSize = settings.vertexCacheSize
+    tOptions.optimizeIndicesWorkers = settings.optimizeIndicesWorkers
+    tOptions.doOptimizeOverdraw = settings.optimizeOverdraw
+    tOptions.overdrawThreshold = settings.overdrawThreshold
+    if settings.useDiskCache and settings.outputPath:
+        cachePath = os.path.join(os.path.normpath(bpy.path.abspath(settings.outputPath)), DISK_CACHE_DIR)
+        tOptions.diskCache = DiskCache(cachePath, settings.diskCacheSize * 1024 * 1024)
+    tOptions.weldTolerance = settings.weldTolerance
+    tOptions.tempDatablocks = tempDatablocks
     tOptions.doMaterials = settings.materials or settings.textures
     tOptions.bonesGlobalOrigin = settings.bonesGlobalOrigin
     tOptions.actionsGlobalOrigin = settings.actionsGlobalOrigin
@@ -3339,6 +3526,7 @@ def ExecuteUrhoExport(context):
                 #scn.objects.link(new_obj)
             if not new_obj:
                 new_obj = bpy.data.objects.new(name=new_objname,object_data=lodmesh)
+            tempDatablocks.addObject(new_obj)
 
             ## mark this object to be temporary lodset object (used to assure applyModifier)
             new_obj.lodsetID=-2
@@ -3357,7 +3545,6 @@ def ExecuteUrhoExport(context):
                 decimate.ratio = lod.decimate
 
             firstLOD = False
-            tempObjects.append(new_obj)
             bpy.context.scene.collection.objects.link(new_obj)
             print ("LODSET:%s" % lodset.name)
 
@@ -3365,9 +3552,14 @@ def ExecuteUrhoExport(context):
     if DEBUG: ttt = time.time() #!TIME
     Scan(context, tDataList, settings.errorsMem, tOptions)
     if DEBUG: print("[TIME] Decompose in {:.4f} sec".format(time.time() - ttt) ) #!TIME
+    if tOptions.diskCache:
+        log.info("Cache {:s}: {:d} hits, {:d} misses".format(tOptions.diskCache.directory,
+                tOptions.diskCache.hits, tOptions.diskCache.misses))
 
     # keep track of all meshes that we processed and avoid multiple handling
     processedMeshes = []
+    # Models of the TData with shared geometries
+    sharedModels = {}
 
     # Export each decomposed object
     for tData in tDataList:
@@ -3382,12 +3574,13 @@ def ExecuteUrhoExport(context):
         uExportOptions.splitSubMeshes = settings.geometrySplit
         uExportOptions.useStrictLods = settings.strictLods
         uExportOptions.useRatioTriggers = settings.animationRatioTriggers
+        uExportOptions.stripConstantChannels = settings.stripConstantChannels
         uExportOptions.bonesPerGeometry = addonPrefs.bonesPerGeometry
         uExportOptions.bonesPerVertex = addonPrefs.bonesPerVertex
         uExportOptions.clampBoundingBox = settings.clampBoundingBox
 
         if DEBUG: ttt = time.time() #!TIME
-        UrhoExport(tData, uExportOptions, uExportData, settings.errorsMem)
+        UrhoExport(tData, uExportOptions, uExportData, settings.errorsMem, sharedModels)
         if DEBUG: print("[TIME] Export in {:.4f} sec".format(time.time() - ttt) ) #!TIME
         if DEBUG: ttt = time.time() #!TIME
 
@@ -3543,17 +3736,15 @@ def ExecuteAddon(context, silent=False, ignoreGeoAnim=False):
 
     startTime = time.time()
     print("----------------------Urho export start----------------------")    
-    ExecuteUrhoExport(context)
+    # Temporary meshes and objects are removed even if the export fails
+    with TempDatablocks() as tempDatablocks:
+        ExecuteUrhoExport(context, tempDatablocks)
+    # Forget the evaluated meshes of the objects removed by the export or by the user
+    PruneEvaluatedMeshes()
+    log.info("Temporary datablocks: {:d} created, {:d} peak".format(tempDatablocks.created, tempDatablocks.peak))
 
     log.setLevel(logging.DEBUG)
 
-    print ("TRY TO REMOVE TEMPOBJECTS:")
-    for tempObj in tempObjects:
-        print("REMOVE tempobject:%s" % tempObj.name)
-        bpy.data.objects.remove(tempObj, do_unlink=True)
-        pass
-    tempObjects.clear()
-
     try:
         bpy.ops.object.mode_set(mode='OBJECT', toggle=False)
     except:
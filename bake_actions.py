@@ -0,0 +1,26 @@
+#
+# This script is licensed as public domain.
+#
+
+# Background worker to decompose a subset of the Actions of an armature, it is started
+# by BakeActionsInWorkers() in decompose.py:
+#   blender --factory-startup -b <file.blend> --python bake_actions.py -- <job file>
+
+import sys
+import pickle
+import importlib
+
+def main():
+    jobPath = sys.argv[sys.argv.index("--") + 1]
+    with open(jobPath, "rb") as file:
+        job = pickle.load(file)
+
+    # With factory settings the add-on is not enabled, import it from its folder
+    if job["addonsPath"] not in sys.path:
+        sys.path.insert(0, job["addonsPath"])
+    decompose = importlib.import_module(job["package"] + ".decompose")
+
+    decompose.BakeActionsJob(job)
+
+if __name__ == "__main__":
+    main()
@@ -44,15 +44,24 @@ DEBUG = 0
 
 import bpy
 import bmesh
+from bpy.app.handlers import persistent
 import math
 import time as ostime
+import numpy as np
 from mathutils import Vector, Matrix, Quaternion, Euler, Color
 from collections import OrderedDict
 import os
-import operator
-import heapq
+import sys
 import logging
 import re
+import pickle
+import shutil
+import tempfile
+import subprocess
+from .utils import DiskCache, TempDatablocks
+from .vertex_cache import OptimizeOrder, OptimizePool, OverdrawOrder, CacheStatistics
+from .keyframes import ReduceKeyframes
+from .shape_keys import ReadShapeKeysCoords, AppliedShapeKeysValues, ShapeKeyCoords
 
 log = logging.getLogger("ExportLogger")
 decomposedActions = None
@@ -139,6 +148,216 @@ class TVertex:
                 s += "{:d} {:.3f}  ".format(w[0],w[1])
         return s
 
+# Flags of the elements present in a TVertexList vertex
+VERTEX_POSITION  = 0x01
+VERTEX_NORMAL    = 0x02
+VERTEX_COLOR     = 0x04
+VERTEX_UV        = 0x08
+VERTEX_UV2       = 0x10
+VERTEX_TANGENT   = 0x20
+# Tangent has the 4th component (bitangent direction)
+VERTEX_TANGENT_W = 0x40
+VERTEX_BITANGENT = 0x80
+
+# Compact list of vertices, each element is stored in a contiguous array (a column)
+# and a mask tells which elements a vertex has. Indexing the list returns a 
+# TVertexView, so it can be used where a list of TVertex is expected.
+class TVertexList:
+    # Element name: (mask flag, components, type)
+    columns = { "pos":       (VERTEX_POSITION,  3, np.float32),
+                "normal":    (VERTEX_NORMAL,    3, np.float32),
+                "color":     (VERTEX_COLOR,     4, np.uint8),
+                "uv":        (VERTEX_UV,        2, np.float32),
+                "uv2":       (VERTEX_UV2,       2, np.float32),
+                "tangent":   (VERTEX_TANGENT,   4, np.float32),
+                "bitangent": (VERTEX_BITANGENT, 3, np.float32) }
+
+    def __init__(self):
+        # Number of vertices in the list
+        self.count = 0
+        # Allocated rows of the arrays
+        self.capacity = 0
+        # Mask of the elements present in each vertex
+        self.mask = np.zeros(0, dtype=np.uint8)
+        # Index of each vertex in the Blender buffer (-1, -1 if None)
+        self.blenderIndex = np.zeros((0, 2), dtype=np.int32)
+        # Elements arrays, see 'columns'
+        for name, (flag, size, dtype) in self.columns.items():
+            setattr(self, name, np.zeros((0, size), dtype=dtype))
+        # Bones weights of the vertices in CSR format: the weights of vertex 'i' are
+        # weightBones[weightOffsets[i]:weightOffsets[i+1]] (bone indices) and the 
+        # same range of weightValues, a vertex without weights has an empty range
+        self.weightOffsets = np.zeros(1, dtype=np.int64)
+        self.weightBones = np.zeros(0, dtype=np.int32)
+        self.weightValues = np.zeros(0, dtype=np.float32)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError("vertex index out of range")
+        return TVertexView(self, index)
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield TVertexView(self, index)
+
+    # Grow the arrays to contain at least 'count' vertices
+    def reserve(self, count):
+        if count <= self.capacity:
+            return
+        capacity = max(count, 2 * self.capacity, 1024)
+        for name in ["mask", "blenderIndex"] + list(self.columns):
+            array = getattr(self, name)
+            newArray = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            newArray[:self.count] = array[:self.count]
+            setattr(self, name, newArray)
+        offsets = np.zeros(capacity + 1, dtype=np.int64)
+        offsets[:self.count + 1] = self.weightOffsets[:self.count + 1]
+        self.weightOffsets = offsets
+        self.capacity = capacity
+
+    # Grow the weights arrays to contain at least 'count' weights
+    def reserveWeights(self, count):
+        if count <= len(self.weightBones):
+            return
+        capacity = max(count, 2 * len(self.weightBones), 1024)
+        used = self.weightOffsets[self.count]
+        for name in ("weightBones", "weightValues"):
+            array = getattr(self, name)
+            newArray = np.zeros(capacity, dtype=array.dtype)
+            newArray[:used] = array[:used]
+            setattr(self, name, newArray)
+
+    # Returns the weights of all the vertices in CSR format: offsets, bone indices, weights
+    def csrWeights(self):
+        offsets = self.weightOffsets[:self.count + 1]
+        return offsets, self.weightBones[:offsets[-1]], self.weightValues[:offsets[-1]]
+
+    # Replace the weights of the last vertex with the list of tuple(boneIndex, weight)
+    def setLastWeights(self, weights):
+        start = self.weightOffsets[self.count - 1]
+        count = len(weights) if weights else 0
+        self.reserveWeights(start + count)
+        if count:
+            self.weightBones[start:start + count] = [w[0] for w in weights]
+            self.weightValues[start:start + count] = [w[1] for w in weights]
+        self.weightOffsets[self.count] = start + count
+
+    # Add a TVertex (or TVertexView), returns its index
+    def append(self, tVertex):
+        index = self.count
+        self.reserve(index + 1)
+        self.count += 1
+        self.weightOffsets[self.count] = self.weightOffsets[index]
+        view = TVertexView(self, index)
+        view.blenderIndex = tVertex.blenderIndex
+        for name in self.columns:
+            setattr(view, name, getattr(tVertex, name))
+        view.weights = tVertex.weights
+        return index
+
+    # Add 'count' vertices from arrays of elements, elements which are None are not
+    # present. 'weights' are the CSR arrays (offsets, bone indices, weights) of the
+    # vertices. Returns the index of the first vertex added.
+    def appendArrays(self, count, blenderIndex=None, weights=None, **elements):
+        start = self.count
+        self.reserve(start + count)
+        self.count += count
+        rows = slice(start, start + count)
+        weightsStart = self.weightOffsets[start]
+        if weights is None:
+            self.weightOffsets[start + 1:start + count + 1] = weightsStart
+        else:
+            offsets, bones, values = weights
+            self.reserveWeights(weightsStart + offsets[-1])
+            self.weightOffsets[start + 1:start + count + 1] = weightsStart + offsets[1:]
+            self.weightBones[weightsStart:weightsStart + offsets[-1]] = bones
+            self.weightValues[weightsStart:weightsStart + offsets[-1]] = values
+        self.mask[rows] = 0
+        self.blenderIndex[rows] = -1 if blenderIndex is None else blenderIndex
+        for name, array in elements.items():
+            flag, size, dtype = self.columns[name]
+            if array is None:
+                continue
+            getattr(self, name)[rows, :array.shape[1]] = array
+            self.mask[rows] |= flag
+            if name == "tangent" and array.shape[1] == 4:
+                self.mask[rows] |= VERTEX_TANGENT_W
+        return start
+
+    # Returns the rows of the element 'name' of the vertices 'indices', and a bool array
+    # telling which vertices have the element
+    def gather(self, name, indices):
+        flag, size, dtype = self.columns[name]
+        indices = np.asarray(indices, dtype=np.int64)
+        return getattr(self, name)[indices], (self.mask[indices] & flag) != 0
+
+
+# Reference to a vertex of a TVertexList, its members read and write the list arrays
+class TVertexView(TVertex):
+    def __init__(self, tVertexList, index):
+        self.__dict__["list"] = tVertexList
+        self.__dict__["index"] = index
+
+    def _get(self, name):
+        tList = self.list
+        flag = tList.columns[name][0]
+        if not tList.mask[self.index] & flag:
+            return None
+        row = getattr(tList, name)[self.index]
+        if name == "color":
+            return tuple(int(c) for c in row)
+        if name == "tangent" and not tList.mask[self.index] & VERTEX_TANGENT_W:
+            return Vector(row[:3])
+        return Vector(row)
+
+    def _set(self, name, value):
+        tList = self.list
+        flag = tList.columns[name][0]
+        if name == "tangent":
+            # Clear the 4th component flag too, it is set again below if needed
+            tList.mask[self.index] &= ~VERTEX_TANGENT_W & 0xFF
+            if value is not None and len(value) == 4:
+                flag |= VERTEX_TANGENT_W
+        if value is None:
+            tList.mask[self.index] &= ~flag & 0xFF
+            return
+        getattr(tList, name)[self.index, :len(value)] = tuple(value)
+        tList.mask[self.index] |= flag
+
+    def __getattr__(self, name):
+        if name in TVertexList.columns:
+            return self._get(name)
+        if name == "blenderIndex":
+            meshIndex, vertexIndex = self.list.blenderIndex[self.index]
+            if meshIndex < 0:
+                return None
+            return (int(meshIndex), int(vertexIndex))
+        if name == "weights":
+            tList = self.list
+            start, end = tList.weightOffsets[self.index:self.index + 2]
+            if start == end:
+                return None
+            return list(zip(tList.weightBones[start:end].tolist(), tList.weightValues[start:end].tolist()))
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in TVertexList.columns:
+            self._set(name, value)
+        elif name == "blenderIndex":
+            self.list.blenderIndex[self.index] = (-1, -1) if value is None else value
+        elif name == "weights":
+            # Weights are packed, only the last vertex can change its size
+            if self.index != self.list.count - 1:
+                raise ValueError("only the weights of the last vertex can be set")
+            self.list.setLastWeights(value)
+        else:
+            raise AttributeError(name)
+
 # Geometry LOD level class
 class TLodLevel:
     def __init__(self):
@@ -317,8 +536,8 @@ class TData:
     def __init__(self):
         self.objectName = None
         self.blenderObjectName = None
-        # List of all the TVertex of all the geometries
-        self.verticesList = []
+        # List of all the vertices of all the geometries (TVertexList)
+        self.verticesList = TVertexList()
         # List of TGeometry, they contains triangles, triangles are made of vertex indices
         self.geometriesList = []
         # List of TMorph: a subset of the vertices list with modified position
@@ -334,6 +553,8 @@ class TData:
         # Common TAnimation, one track per object
         self.commonAnimation = None
         self.hasLODs = False
+        # TData whose geometry lists are shared by this one (same mesh), None if not shared
+        self.geometrySource = None
 
 class TOptions:
     def __init__(self):
@@ -376,6 +597,10 @@ class TOptions:
         self.doAnimationRot = True
         self.doAnimationSca = True
         self.filterSingleKeyFrames = False
+        self.doReduceKeyframes = False
+        self.reducePositionTolerance = 0.001
+        self.reduceRotationTolerance = 0.1 # degrees
+        self.reduceScaleTolerance = 0.001
         self.doGeometries = True
         self.doGeometryPos = True
         self.doGeometryNor = True
@@ -390,6 +615,25 @@ class TOptions:
         self.doMorphTan = True
         self.doMorphUV = True
         self.doOptimizeIndices = True
+        self.optimizeIndicesMode = 'FORSYTH'
+        self.vertexCacheSize = 32
+        self.optimizeIndicesWorkers = 0
+        # Number of background Blender processes to decompose the Actions, the saved
+        # .blend file they load (None if not saved or modified)
+        self.bakeWorkers = 0
+        self.bakeFilepath = None
+        # OptimizePool, created by the first mesh to optimize and closed at the end of Scan
+        self.optimizeIndicesPool = None
+        # TempDatablocks owner of the temporary meshes and objects of the export (can be None)
+        self.tempDatablocks = None
+        # Object local matrices sampled by SampleObjectsAnimations, used and cleared by Scan
+        self.objectsMatrices = None
+        # DiskCache of the optimized indices (None to disable)
+        self.diskCache = None
+        self.doOptimizeOverdraw = False
+        self.useEvaluatedCache = True
+        self.overdrawThreshold = 1.05
+        self.weldTolerance = 0.0
         self.doMaterials = True
         self.meshNameDerivedBy = None
         
@@ -400,6 +644,19 @@ class TOptions:
 # http://www.terathon.com/code/tangent.html
 #--------------------
         
+# Normalize the rows of 'vectors', rows of zero length are left unchanged
+def NormalizeRows(vectors):
+    lengths = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, lengths, out=vectors.copy(), where=(lengths > 0.0))
+
+# Add the vertices Blender indices (array of rows meshIndex, vertexIndex) to the errors set
+def AddErrorIndices(errorsSet, blenderIndices):
+    if errorsSet is None:
+        return
+    for meshIndex, vertexIndex in blenderIndices.tolist():
+        if meshIndex >= 0:
+            errorsSet.add((meshIndex, vertexIndex))
+
 def GenerateTangents(tLodLevels, tVertexList, errorsMem):
 
     if not tVertexList:
@@ -412,387 +669,190 @@ def GenerateTangents(tLodLevels, tVertexList, errorsMem):
         nullUvIndices = errorsMem.Get("null UV area", set() )
         incompleteUvIndices = errorsMem.Get("incomplete UV", set() )
 
-    # Init the values
-    tangentOverwritten = 0    
+    # Morph vertices are a map of TVertex, copy them in a TVertexList and convert the
+    # map keys to row indices of the list
+    tVertexMap = None
+    if isinstance(tVertexList, dict):
+        tVertexMap = tVertexList
+        mapKeys = np.array(sorted(tVertexMap), dtype=np.int64)
+        tVertexList = TVertexList()
+        for key in mapKeys.tolist():
+            tVertexList.append(tVertexMap[key])
+
+    # Get the vertex and the triangle indices of each LOD
+    lodIndices = []
+    lodTriangles = []
     for tLodLevel in reversed(tLodLevels):
         if not tLodLevel.indexSet or not tLodLevel.triangleList:
             log.warning("Empty LOD, tangent generation skipped.")
             tLodLevels.remove(tLodLevel)
             continue
-        
-        for vertexIndex in tLodLevel.indexSet:
-            vertex = tVertexList[vertexIndex]
-            
-            # Check if the tangent was already calculated (4 components) for this vertex and we're overwriting it
-            if vertex.tangent and len(vertex.tangent) == 4:
-                tangentOverwritten += 1
-                
-            # Check if we have all the needed data to do the calculations
-            if vertex.pos is None:
-                if incompleteUvIndices is not None:
-                    incompleteUvIndices.add(vertex.blenderIndex)
-                log.warning("Missing position on vertex {:d}, tangent generation cancelled.".format(vertex.blenderIndex[1]))
-                return
-            if vertex.normal is None:
-                if incompleteUvIndices is not None:
-                    incompleteUvIndices.add(vertex.blenderIndex)
-                log.warning("Missing normal on vertex {:d}, tangent generation cancelled.".format(vertex.blenderIndex[1]))
-                return
-            if vertex.uv is None:
-                if incompleteUvIndices is not None:
-                    incompleteUvIndices.add(vertex.blenderIndex)
-                log.warning("Missing UV on vertex {:d}, tangent generation cancelled.".format(vertex.blenderIndex[1]))
-                return
-            
-            # Init tangent (3 components) and bitangent vectors
-            vertex.tangent = Vector((0.0, 0.0, 0.0))
-            vertex.bitangent = Vector((0.0, 0.0, 0.0))
+        indices = np.fromiter(tLodLevel.indexSet, dtype=np.int64, count=len(tLodLevel.indexSet))
+        triangles = np.array(tLodLevel.triangleList, dtype=np.int64).reshape(-1, 3)
+        if tVertexMap is not None:
+            indices = np.searchsorted(mapKeys, indices)
+            triangles = np.searchsorted(mapKeys, triangles)
+        lodIndices.append(indices)
+        lodTriangles.append(triangles)
+    if not lodIndices:
+        return
+    indices = np.unique(np.concatenate(lodIndices))
+    triangles = np.concatenate(lodTriangles)
+    vertexMask = tVertexList.mask[indices]
 
+    # Check if the tangent was already calculated (4 components) for these vertices and we're overwriting it
+    tangentOverwritten = np.count_nonzero(vertexMask & VERTEX_TANGENT_W)
     if tangentOverwritten:
         log.warning("Overwriting {:d} tangents".format(tangentOverwritten))
 
-    # Calculate tangent and bitangent
-    invalidUV = False
-    for tLodLevel in tLodLevels:
-        for i, triangle in enumerate(tLodLevel.triangleList):
-            # For each triangle, we have 3 vertices vertex1, vertex2, vertex3, each of the have their UV coordinates, we want to 
-            # find two unit orthogonal vectors (tangent and bitangent) such as we can express each vertex position as a function
-            # of the vertex UV: 
-            #  VertexPosition = Tangent * f'(VertexUV) + BiTangent * f"(VertexUV)
-            # Actually we are going to express them relatively to a vertex chosen as origin (vertex1):
-            #  vertex - vertex1 = Tangent * (vertex.u - vertex1.u) + BiTangent * (vertex.v - vertex1.v)
-            # We have two equations, one for vertex2-vertex1 and one for vertex3-vertex1, if we put them in a system and solve it
-            # we can obtain Tangent and BiTangent:
-            #  [T; B] = [u1, v1; u2, v2]^-1 * [V2-V1; V3-V1]
-            
-            vertex1 = tVertexList[triangle[0]]
-            vertex2 = tVertexList[triangle[1]]
-            vertex3 = tVertexList[triangle[2]]
-
-            # First equation: [x1, y1, z1] = Tangent * u1 + BiTangent * v1
-            x1 = vertex2.pos.x - vertex1.pos.x
-            y1 = vertex2.pos.y - vertex1.pos.y
-            z1 = vertex2.pos.z - vertex1.pos.z
-
-            u1 = vertex2.uv.x - vertex1.uv.x
-            v1 = vertex2.uv.y - vertex1.uv.y
-
-            # Second equation: [x2, y2, z2] = Tangent * u2 + BiTangent * v2
-            x2 = vertex3.pos.x - vertex1.pos.x
-            y2 = vertex3.pos.y - vertex1.pos.y
-            z2 = vertex3.pos.z - vertex1.pos.z
-
-            u2 = vertex3.uv.x - vertex1.uv.x
-            v2 = vertex3.uv.y - vertex1.uv.y
-
-            # Determinant of the matrix [u1 v1; u2 v2]
-            d = u1 * v2 - u2 * v1
-            
-            # If the determinant is zero then the points (0,0), (u1,v1), (u2,v2) are in line, this means
-            # the area on the UV map of this triangle is null. This is an error, we must skip this triangle.
-            if d == 0:
-                if nullUvIndices is not None:
-                    nullUvIndices.add(vertex1.blenderIndex)
-                    nullUvIndices.add(vertex2.blenderIndex)
-                    nullUvIndices.add(vertex3.blenderIndex)
-                invalidUV = True
-                continue
-
-            t = Vector( ((v2 * x1 - v1 * x2) / d, (v2 * y1 - v1 * y2) / d, (v2 * z1 - v1 * z2) / d) )
-            b = Vector( ((u1 * x2 - u2 * x1) / d, (u1 * y2 - u2 * y1) / d, (u1 * z2 - u2 * z1) / d) )
-            
-            vertex1.tangent += t;
-            vertex2.tangent += t;
-            vertex3.tangent += t;
-            
-            vertex1.bitangent += b;
-            vertex2.bitangent += b;
-            vertex3.bitangent += b;
+    # Check if we have all the needed data to do the calculations
+    for flag, elementName in ((VERTEX_POSITION, "position"), (VERTEX_NORMAL, "normal"), (VERTEX_UV, "UV")):
+        incomplete = indices[(vertexMask & flag) == 0]
+        if len(incomplete):
+            AddErrorIndices(incompleteUvIndices, tVertexList.blenderIndex[incomplete])
+            log.warning("Missing {:s} on {:d} vertices (first {:d}), tangent generation cancelled."
+                        .format(elementName, len(incomplete), int(tVertexList.blenderIndex[incomplete[0], 1])))
+            return
 
-    if invalidUV:
+    # Calculate tangent and bitangent
+    # For each triangle, we have 3 vertices vertex1, vertex2, vertex3, each of the have their UV coordinates, we want to 
+    # find two unit orthogonal vectors (tangent and bitangent) such as we can express each vertex position as a function
+    # of the vertex UV: 
+    #  VertexPosition = Tangent * f'(VertexUV) + BiTangent * f"(VertexUV)
+    # Actually we are going to express them relatively to a vertex chosen as origin (vertex1):
+    #  vertex - vertex1 = Tangent * (vertex.u - vertex1.u) + BiTangent * (vertex.v - vertex1.v)
+    # We have two equations, one for vertex2-vertex1 and one for vertex3-vertex1, if we put them in a system and solve it
+    # we can obtain Tangent and BiTangent:
+    #  [T; B] = [u1, v1; u2, v2]^-1 * [V2-V1; V3-V1]
+    # All the triangles are solved at once, each row is a triangle.
+    count = len(tVertexList)
+    positions = tVertexList.pos[:count].astype(np.float64)
+    uvs = tVertexList.uv[:count].astype(np.float64)
+
+    # First equation: [x1, y1, z1] = Tangent * u1 + BiTangent * v1
+    edges1 = positions[triangles[:, 1]] - positions[triangles[:, 0]]
+    u1, v1 = (uvs[triangles[:, 1]] - uvs[triangles[:, 0]]).T
+    # Second equation: [x2, y2, z2] = Tangent * u2 + BiTangent * v2
+    edges2 = positions[triangles[:, 2]] - positions[triangles[:, 0]]
+    u2, v2 = (uvs[triangles[:, 2]] - uvs[triangles[:, 0]]).T
+
+    # Determinant of the matrix [u1 v1; u2 v2]
+    d = u1 * v2 - u2 * v1
+
+    # If the determinant is zero then the points (0,0), (u1,v1), (u2,v2) are in line, this means
+    # the area on the UV map of this triangle is null. This is an error, we must skip this triangle.
+    nullUv = (d == 0)
+    if nullUv.any():
+        if nullUvIndices is not None:
+            AddErrorIndices(nullUvIndices, tVertexList.blenderIndex[np.unique(triangles[nullUv])])
         log.error("Invalid UV, the area in the UV map is too small.")
+        triangles = triangles[~nullUv]
+        edges1, edges2 = edges1[~nullUv], edges2[~nullUv]
+        u1, v1, u2, v2, d = u1[~nullUv], v1[~nullUv], u2[~nullUv], v2[~nullUv], d[~nullUv]
+
+    t = (v2[:, None] * edges1 - v1[:, None] * edges2) / d[:, None]
+    b = (u1[:, None] * edges2 - u2[:, None] * edges1) / d[:, None]
+
+    # Sum the tangents and bitangents of the triangles of each vertex
+    corners = triangles.ravel()
+    tangents = np.empty((count, 3))
+    bitangents = np.empty((count, 3))
+    for i in range(3):
+        tangents[:, i] = np.bincount(corners, weights=np.repeat(t[:, i], 3), minlength=count)
+        bitangents[:, i] = np.bincount(corners, weights=np.repeat(b[:, i], 3), minlength=count)
+    tangents = tangents[indices]
+    bitangents = bitangents[indices]
+    normals = tVertexList.normal[indices].astype(np.float64)
 
     # Gram-Schmidt orthogonalize normal, tangent and bitangent
-    for tLodLevel in tLodLevels:
-        for vertexIndex in tLodLevel.indexSet:
-            vertex = tVertexList[vertexIndex]
-            # Skip already calculated vertices
-            if len(vertex.tangent) == 4:
-                continue
-                
-            # Unit vector perpendicular to normal and in the same plane of normal and tangent
-            tOrtho = ( vertex.tangent - vertex.normal * vertex.normal.dot(vertex.tangent) ).normalized()
-            # Unit vector perpendicular to the plane of normal and tangent
-            bOrtho = vertex.normal.cross(vertex.tangent).normalized()
-
-            # Calculate handedness: if bOrtho and bitangent have the different directions, save the verse
-            # in tangent.w, so we can reconstruct bitangent by: tangent.w * normal.cross(tangent)
-            w = 1.0 if bOrtho.dot(vertex.bitangent) >= 0.0 else -1.0
-            
-            vertex.bitangent = bOrtho
-            vertex.tangent = Vector((tOrtho.x, tOrtho.y, tOrtho.z, w))
-
-
-        
-#--------------------
-# Linear-Speed Vertex Cache Optimisation algorithm by Tom Forsyth
-#  https://home.comcast.net/~tom_forsyth/papers/fast_vert_cache_opt.html
-#--------------------
-
-# This is an optimized version, but it is still slow.
-# (on an average pc, 5 minutes for 30K smooth vertices)
-
-#  We try to sort triangles in the index buffer so that we gain an optimal use
-#  of the hardware vertices cache.
-#  We assign a score to each triangle, we find the best and save it in a new 
-#  ordered list.
-#  The score of each triangle is the sum of the score of its vertices, and the
-#  score of a vertex is higher if it is:
-#  - used recently (it is still in the cache) but we also try to avoid the last
-#    triangle added (n this way we get better result),
-#  - lonely isolated vertices (otherwise the will be keep for last and drawing
-#    them will require an higher cost)
-#  The order of vertices in the triangle does not matter.
-#  We'll apply this optimization to each lod of each geometry.
-
-# These are the constants used in the algorithm:
-VERTEX_CACHE_SIZE = 32
-CACHE_DECAY_POWER = 1.5
-LAST_TRI_SCORE = 0.75
-VALENCE_BOOST_SCALE = 2.0
-VALENCE_BOOST_POWER = 0.5
-
-def CalculateScore(rank):
-
-    if rank.useCount == 0:
-        rank.score = -1.0
-        return
-
-    score = 0.0
-    cachePosition = rank.cachePosition
-    
-    if cachePosition < 0:
-        # Vertex is not in FIFO cache - no score
-        pass
-    elif cachePosition < 3:
-        # This vertex was used in the last triangle,
-        # so it has a fixed score, whichever of the three
-        # it's in. Otherwise, you can get very different
-        # answers depending on whether you add
-        # the triangle 1,2,3 or 3,1,2 - which is silly.
-        score = LAST_TRI_SCORE
-    else:
-        # Points for being high in the cache
-        score = 1.0 - float(rank.cachePosition - 3) / (VERTEX_CACHE_SIZE - 3)
-        score = pow(score, CACHE_DECAY_POWER)
+    # Unit vector perpendicular to normal and in the same plane of normal and tangent
+    tOrtho = NormalizeRows(tangents - normals * np.einsum('ij,ij->i', normals, tangents)[:, None])
+    # Unit vector perpendicular to the plane of normal and tangent
+    bOrtho = NormalizeRows(np.cross(normals, tangents))
 
-    # Bonus points for having a low number of tris still to
-    # use the vert, so we get rid of lone verts quickly
-    valenceBoost = VALENCE_BOOST_SCALE * pow(rank.useCount, -VALENCE_BOOST_POWER);
-    rank.score = score + valenceBoost;
+    # Calculate handedness: if bOrtho and bitangent have the different directions, save the verse
+    # in tangent.w, so we can reconstruct bitangent by: tangent.w * normal.cross(tangent)
+    w = np.where(np.einsum('ij,ij->i', bOrtho, bitangents) >= 0.0, 1.0, -1.0)
 
-# Triangles score list sizes
-TRIANGLERANK_SIZE = 500
-TRIANGLERANK_MAX_SIZE = 505
+    tVertexList.tangent[indices, :3] = tOrtho
+    tVertexList.tangent[indices, 3] = w
+    tVertexList.bitangent[indices] = bOrtho
+    tVertexList.mask[indices] |= VERTEX_TANGENT | VERTEX_TANGENT_W | VERTEX_BITANGENT
 
-def OptimizeIndices(lodLevel):
-    
-    # Ranks are used to store data for each vertex
-    class Rank:
-        def __init__(self):
-            self.score = 0.0
-            self.useCount = 1
-            self.cachePosition = -1
-    
-    # Create a map: vertex index to its corresponding Rank
-    ranking = {}
-    
-    # This list contains the original triangles (not in optimal order), we'll move them 
-    # one by one in a new list following the optimal order
-    oldTriangles = lodLevel.triangleList
-
-    # For each vertex index of each triangle increment the use counter
-    # (we can find the same vertex index more than once)
-    for triangle in oldTriangles:
-        for index in triangle:
-            try:
-                ranking[index].useCount += 1
-            except KeyError:
-                ranking[index] = Rank()
+    # Copy the results back to the morph vertices
+    if tVertexMap is not None:
+        for key, row in zip(mapKeys[indices].tolist(), indices.tolist()):
+            tVertex = tVertexMap[key]
+            tVertex.tangent = Vector(tVertexList.tangent[row])
+            tVertex.bitangent = Vector(tVertexList.bitangent[row])
 
-    # Calculate the first round of scores
-    # (Rank is mutable, so CalculateScore will be able to modify it)
-    for rank in ranking.values():        
-        CalculateScore(rank)
-
-    # Ths list will contain the triangles sorted in optimal order
-    newTriangles = []
-
-    # Cache of vertex indices
-    vertexCache = []
-    
-    # The original algorithm was:
-    # - scan all the old triangles and find the one with the best score;
-    # - move it to the new triangles;
-    # - move its vertices in the cache;
-    # - recalculate the score on all the vertices on the cache.
-    # The slowest part is the first step, scanning all the old triangles,
-    # but in the last step we update only a little subset of these triangles,
-    # and it is a waste to recalculate the triangle score of each old triangle.
-    # So we do this:
-    # - create a map 'trianglesMap': vertex index to triangles;
-    # - keep a list 'trianglesRanking' of the best triangles;
-    # - at first this list is empty, we start adding triangles; we add tuples like
-    #   (score, triangle) and we keep track of the min score, we don't add triangles
-    #   with score lower than the min; for now we add triangles without bothering
-    #   about order; if the triangle is already present in the list we only update
-    #   its score (even if it is lower);
-    # - when the list is a little too big (TRIANGLERANK_MAX_SIZE), we sort the list 
-    #   by score and we only keep the best TRIANGLERANK_SIZE triangles, we update 
-    #   the min score;
-    # - after scanning all the old triangles, we take out from the list the best
-    #   triangle;
-    # - move it to the new triangles and remove it from the map;
-    # - move its vertices in the cache;
-    # - recalculate the score on all the vertices in the cache, if the score of one
-    #   vertex is changed, we use the map to find what triangles are affected and
-    #   we add them to the list (unordered and only if their score is > min);
-    # - now when we repeat we have the list already populated, so we don't need to
-    #   recalculate all old triangles scores, we only need to sort the list and take
-    #   out the best triangle.
 
         
-    # Vertex index to triangle indices list map
-    trianglesMap = {}
-    # Populate the map
-    for triangle in oldTriangles:
-        for vertexIndex in triangle:
-            try:
-                triangleList = trianglesMap[vertexIndex]
-            except KeyError:
-                triangleList = []
-                trianglesMap[vertexIndex] = triangleList
-            triangleList.append(triangle)
-
-    class TrianglesRanking:
-        def __init__(self):
-            self.ranklist = []
-            self.min = None
-            self.isSorted = True
-    
-        def update(self, triangle):            
-            # Sum the score of all its vertex. 
-            # >> This is the slowest part of the algorithm <<
-            triangleScore = ranking[triangle[0]].score + ranking[triangle[1]].score + ranking[triangle[2]].score
-            # If needed, add it to the list
-            if not self.ranklist:
-                self.ranklist.append( (triangleScore, triangle) )
-                self.min = triangleScore
-            else:
-                # We add only triangles with score > min
-                if triangleScore > self.min:
-                    found = False
-                    # Search of the triangle is already present in the list
-                    for i, rank in enumerate(self.ranklist):
-                        if triangle == rank[1]:
-                            if triangleScore != rank[0]:
-                                self.ranklist[i] = (triangleScore, triangle)
-                                self.isSorted = False
-                            found = True
-                            break
-                    # It is a new triangle
-                    if not found:
-                        self.ranklist.append( (triangleScore, triangle) )
-                        self.isSorted = False
-
-        def sort(self):
-            if self.isSorted:
-                return
-            #self.ranklist = sorted(self.ranklist, key=operator.itemgetter(0), reverse=True)[:TRIANGLERANK_SIZE]
-            self.ranklist = heapq.nlargest(TRIANGLERANK_SIZE, self.ranklist, key = operator.itemgetter(0))
-            self.min = self.ranklist[-1][0]
-            self.isSorted = True
-        
-        def popBest(self):
-            bestTriangle = self.ranklist[0][1]
-            del self.ranklist[0]
-            return bestTriangle
-
-    trianglesRanking = TrianglesRanking()
+#--------------------
+# Vertex cache optimisation (see vertex_cache.py)
+#--------------------
 
-    # Progress counter
-    progressCur = 0
-    progressTot = 0.01 * len(oldTriangles)
+# Sort the triangles of the LOD for an optimal use of the hardware vertices cache,
+# 'mode' is the algorithm: 'FORSYTH' or 'TIPSIFY'
+def OptimizeIndices(lodLevel, mode = 'FORSYTH', cacheSize = 32):
 
     if DEBUG: ttt = ostime.time() #!TIME
 
-    # While there still are unsorted triangles
-    while oldTriangles:
-        # Print progress
-        if (progressCur & 0x7F) == 0:
-            print("{:.3f}%\r".format(progressCur / progressTot), end='' )
-        progressCur += 1
-        
-        # When the list is empty, we need to scan all the old triangles
-        if not trianglesRanking.ranklist:
-            for triangle in oldTriangles:
-                # We add the triangle but we don't search for the best one
-                trianglesRanking.update(triangle)
-                # If the list is too big, sort and truncate it
-                if len(trianglesRanking.ranklist) > TRIANGLERANK_MAX_SIZE:
-                    trianglesRanking.sort()
-
-        if trianglesRanking:
-            # Only if needed, we sort and truncate
-            trianglesRanking.sort()
-            # We take the best triangles out of the list
-            bestTriangle = trianglesRanking.popBest()
-        else:
-            log.error("Could not find next triangle")
-            return        
-        
-        # Move the best triangle to the output list
-        oldTriangles.remove(bestTriangle)
-        newTriangles.append(bestTriangle)
-            
-        # Model the LRU cache behaviour
-        # Recreate the cache removing the vertices of the best triangle
-        vertexCache = [i for i in vertexCache if i not in bestTriangle]
-        
-        for vertexIndex in bestTriangle:
-            # Then push them to the front
-            vertexCache.insert(0, vertexIndex)
-            # Decrement the use counter of its vertices
-            ranking[vertexIndex].useCount -= 1
-            # Remove best triangle from the map
-            triangleList = trianglesMap[vertexIndex]
-            triangleList.remove(bestTriangle)
-
-        # Update positions & scores of all vertices in the cache
-        # Give position -1 if vertex is going to be erased
-        for i, vertexIndex in enumerate(vertexCache):
-            rank = ranking[vertexIndex]
-            if (i > VERTEX_CACHE_SIZE):
-                rank.cachePosition = -1
-            else:
-                rank.cachePosition = i
-            # Calculate the new score
-            oldScore = rank.score
-            CalculateScore(rank)
-            # If the score is changed
-            if oldScore != rank.score:
-                # Add to the list all the triangles affected
-                triangleList = trianglesMap[vertexIndex]
-                for triangle in triangleList:   
-                    trianglesRanking.update(triangle)
-                
-        # Finally erase the extra vertices
-        vertexCache[:] = vertexCache[:VERTEX_CACHE_SIZE]
+    newOrder = OptimizeOrder(lodLevel.triangleList, mode, cacheSize)
 
     if DEBUG: print("[TIME2] {:.4f}".format(ostime.time() - ttt) ) #!TIME
 
     # Rewrite the index data now
-    lodLevel.triangleList = newTriangles
+    lodLevel.triangleList = [lodLevel.triangleList[i] for i in newOrder.tolist()]
+
+# Python interpreter to run the worker processes: Blender < 2.92 has 'binary_path_python',
+# newer versions set sys.executable to the Python shipped with Blender
+def BlenderPythonPath():
+    return getattr(bpy.app, "binary_path_python", None) or sys.executable
+
+# Same as OptimizeIndices for a list of LODs, if 'tOptions.optimizeIndicesWorkers' is
+# not zero the LODs are optimized in parallel by worker processes
+def OptimizeIndicesList(lodLevels, tOptions):
+    mode = tOptions.optimizeIndicesMode
+    cacheSize = tOptions.vertexCacheSize
+    pool = tOptions.optimizeIndicesPool
+    if tOptions.optimizeIndicesWorkers > 0 and len(lodLevels) > 1:
+        if pool is None:
+            pool = OptimizePool(tOptions.optimizeIndicesWorkers, BlenderPythonPath())
+            tOptions.optimizeIndicesPool = pool
+        if not pool.failed or pool.workers:
+            if DEBUG: ttt = ostime.time() #!TIME
+            failed = pool.failed
+            newOrders = pool.map([lodLevel.triangleList for lodLevel in lodLevels], mode, cacheSize)
+            if DEBUG: print("[TIME2] {:.4f}".format(ostime.time() - ttt) ) #!TIME
+            if pool.failed and not failed:
+                log.warning("Cannot start the worker processes ({:s})".format(pool.pythonPath))
+            for lodLevel, newOrder in zip(lodLevels, newOrders):
+                lodLevel.triangleList = [lodLevel.triangleList[i] for i in newOrder.tolist()]
+            return
+    for lodLevel in lodLevels:
+        OptimizeIndices(lodLevel, mode, cacheSize)
+
+# Version of the cached optimized indices, increase it when the optimization changes
+# so the old entries are not used anymore
+OPTIMIZED_INDICES_VERSION = 1
+
+# Key in DiskCache of the optimized indices of the LOD, it depends on the triangles,
+# the vertices count and the optimization options (and positions for the overdraw)
+def OptimizedIndicesKey(lodLevel, tVertexList, tOptions, doOverdraw):
+    triangles = np.array(lodLevel.triangleList, dtype=np.int32)
+    parts = ["indices", OPTIMIZED_INDICES_VERSION, triangles, len(tVertexList), tOptions.optimizeIndicesMode, tOptions.vertexCacheSize]
+    if doOverdraw:
+        positions = tVertexList.pos[np.unique(triangles)]
+        parts += [tOptions.overdrawThreshold, np.ascontiguousarray(positions)]
+    return DiskCache.Key(*parts)
+
+# Sort clusters of triangles of the LOD to reduce overdraw, the LOD must be already
+# optimized for the vertex cache (see OverdrawOrder)
+def OptimizeOverdraw(lodLevel, tVertexList, cacheSize = 32, threshold = 1.05):
+    positions = tVertexList.pos[:len(tVertexList)]
+    newOrder = OverdrawOrder(lodLevel.triangleList, positions, cacheSize, threshold)
+    lodLevel.triangleList = [lodLevel.triangleList[i] for i in newOrder.tolist()]
 
 
 #--------------------
@@ -1215,50 +1275,552 @@ def DecomposeArmature(scene, armatureObj, meshObj, tData, tOptions):
 
 
 #--------------------
-# Decompose animations
+# F-curves evaluation
 #--------------------
 
-def DecomposeActions(scene, armatureObj, tData, tOptions):
+# Supported keyframes interpolations indexed by the values read with foreach_get
+# (Blender eBezTriple_Interpolation: 0 CONSTANT, 1 LINEAR, 2 BEZIER), the others
+# (easing) are mapped to -1 and evaluated by Blender
+FCURVE_INTERPOLATIONS = np.array([0, 1, 2], dtype=np.int32)
+
+# Slope of the F-curve extrapolation before the first keyframe (first = True) or
+# after the last, 'co' and 'handles' are the keyframes points and the left or right handles
+def FcurveExtrapolationSlope(curve, interpolations, co, handles, first):
+    if curve.extrapolation != 'LINEAR' or len(co) == 1:
+        return 0.0
+    k, n = (0, 1) if first else (-1, -2)
+    if interpolations[k] == 0:
+        return 0.0
+    if interpolations[k] == 1:
+        # Linear: slope of the first (or last) segment
+        dx = co[k, 0] - co[n, 0]
+        return (co[k, 1] - co[n, 1]) / dx if dx else 0.0
+    # Bezier: slope of the handle
+    dx = co[k, 0] - handles[k, 0]
+    return (co[k, 1] - handles[k, 1]) / dx if dx else 0.0
+
+# Evaluate the F-curve 'curve' at each time of 'frameTimes', returns an array of values.
+# Constant, linear and Bezier keyframes are evaluated here all at once, curves with
+# modifiers, baked samples or easing interpolations are evaluated by Blender.
+def EvaluateFcurve(curve, frameTimes):
+    times = np.asarray(frameTimes, dtype=np.float64)
+    keyframes = curve.keyframe_points
+    count = len(keyframes)
+    interpolations = np.empty(count, dtype=np.int32)
+    keyframes.foreach_get("interpolation", interpolations)
+    supported = (interpolations >= 0) & (interpolations < len(FCURVE_INTERPOLATIONS))
+    interpolations = np.where(supported, FCURVE_INTERPOLATIONS[np.where(supported, interpolations, 0)], -1)
+    if count == 0 or len(curve.modifiers) or len(curve.sampled_points) or not supported.all():
+        return np.array([curve.evaluate(t) for t in times.tolist()], dtype=np.float64)
+
+    def ReadPoints(name):
+        points = np.empty(count * 2, dtype=np.float32)
+        keyframes.foreach_get(name, points)
+        return points.reshape(count, 2).astype(np.float64)
+    co = ReadPoints("co")
+    lefts = ReadPoints("handle_left")
+    rights = ReadPoints("handle_right")
+
+    values = np.empty(len(times))
+
+    # Extrapolation before the first keyframe and after the last
+    before = (times <= co[0, 0])
+    after = (times >= co[-1, 0]) & ~before
+    slope = FcurveExtrapolationSlope(curve, interpolations, co, lefts, True)
+    values[before] = co[0, 1] + slope * (times[before] - co[0, 0])
+    slope = FcurveExtrapolationSlope(curve, interpolations, co, rights, False)
+    values[after] = co[-1, 1] + slope * (times[after] - co[-1, 0])
+
+    inside = np.flatnonzero(~(before | after))
+    if not len(inside):
+        return values
+    t = times[inside]
+    # Segment of each time, the interpolation is the one of the segment first keyframe
+    segments = np.clip(np.searchsorted(co[:, 0], t, side='right') - 1, 0, count - 2)
+    p0 = co[segments]
+    p3 = co[segments + 1]
+    modes = interpolations[segments]
+
+    # Constant
+    result = p0[:, 1].copy()
+
+    # Linear
+    mask = (modes == 1)
+    if mask.any():
+        dx = p3[mask, 0] - p0[mask, 0]
+        u = (t[mask] - p0[mask, 0]) / np.where(dx != 0.0, dx, 1.0)
+        result[mask] = p0[mask, 1] + (p3[mask, 1] - p0[mask, 1]) * u
+
+    # Bezier
+    mask = (modes == 2)
+    if mask.any():
+        p0 = p0[mask]
+        p3 = p3[mask]
+        p1 = rights[segments[mask]]
+        p2 = lefts[segments[mask] + 1]
+        # Correct the handles so the curve is a function of time (as Blender does)
+        h1 = p0 - p1
+        h2 = p3 - p2
+        length = p3[:, 0] - p0[:, 0]
+        handlesLength = np.abs(h1[:, 0]) + np.abs(h2[:, 0])
+        fac = np.where(handlesLength > length, length / np.where(handlesLength > 0.0, handlesLength, 1.0), 1.0)
+        p1 = p0 - fac[:, None] * h1
+        p2 = p3 - fac[:, None] * h2
+        # Find the curve parameter at each time (x is monotonic in [0,1])
+        x = t[mask]
+        lo = np.zeros(len(x))
+        hi = np.ones(len(x))
+        for i in range(40):
+            s = 0.5 * (lo + hi)
+            r = 1.0 - s
+            xs = r*r*r*p0[:, 0] + 3.0*r*r*s*p1[:, 0] + 3.0*r*s*s*p2[:, 0] + s*s*s*p3[:, 0]
+            less = (xs < x)
+            lo = np.where(less, s, lo)
+            hi = np.where(less, hi, s)
+        s = 0.5 * (lo + hi)
+        r = 1.0 - s
+        result[mask] = r*r*r*p0[:, 1] + 3.0*r*r*s*p1[:, 1] + 3.0*r*s*s*p2[:, 1] + s*s*s*p3[:, 1]
+
+    values[inside] = result
+    return values
+
+# Product of two arrays of quaternions (w, x, y, z)
+def QuaternionsMultiply(a, b):
+    aw, ax, ay, az = a[..., 0], a[..., 1], a[..., 2], a[..., 3]
+    bw, bx, by, bz = b[..., 0], b[..., 1], b[..., 2], b[..., 3]
+    return np.stack((aw*bw - ax*bx - ay*by - az*bz,
+                     aw*bx + ax*bw + ay*bz - az*by,
+                     aw*by - ax*bz + ay*bw + az*bx,
+                     aw*bz + ax*by - ay*bx + az*bw), axis=-1)
+
+# Convert an array of Euler angles (..., 3) with rotation order 'order' (e.g. 'XYZ', the
+# first axis is applied first) to quaternions
+def EulersToQuaternions(eulers, order):
+    quaternions = np.zeros(eulers.shape[:-1] + (4,))
+    quaternions[..., 0] = 1.0
+    for axis in order:
+        i = 'XYZ'.index(axis)
+        q = np.zeros_like(quaternions)
+        q[..., 0] = np.cos(0.5 * eulers[..., i])
+        q[..., 1 + i] = np.sin(0.5 * eulers[..., i])
+        quaternions = QuaternionsMultiply(q, quaternions)
+    return quaternions
+
+# Convert an array of axis angle rotations (..., 4) (angle, x, y, z) to quaternions
+def AxisAnglesToQuaternions(axisAngles):
+    axes = axisAngles[..., 1:]
+    lengths = np.linalg.norm(axes, axis=-1, keepdims=True)
+    axes = np.divide(axes, lengths, out=np.zeros_like(axes), where=(lengths > 0.0))
+    halfAngles = 0.5 * axisAngles[..., :1]
+    quaternions = np.concatenate((np.cos(halfAngles), axes * np.sin(halfAngles)), axis=-1)
+    # Zero length axis: no rotation
+    quaternions[lengths[..., 0] == 0.0] = (1.0, 0.0, 0.0, 0.0)
+    return quaternions
+
+# Convert an array of normalized quaternions (..., 4) to rotation matrices (..., 3, 3)
+def QuaternionsToMatrices(q):
+    w, x, y, z = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+    return np.stack((
+            np.stack((1.0 - 2.0*(y*y + z*z), 2.0*(x*y - w*z), 2.0*(x*z + w*y)), axis=-1),
+            np.stack((2.0*(x*y + w*z), 1.0 - 2.0*(x*x + z*z), 2.0*(y*z - w*x)), axis=-1),
+            np.stack((2.0*(x*z - w*y), 2.0*(y*z + w*x), 1.0 - 2.0*(x*x + y*y)), axis=-1)), axis=-2)
+
+# Evaluate the F-curves of the location, rotation and scale of 'poseBone' (a pose bone or an
+# object) at the times 'frameTimes', returns the matrices (frames, 4, 4) of the bone relative
+# to its rest position (the rest matrix must be applied)
+def EvaluateFcurvesMatrices(poseBone, actionFcurves, frameTimes):
+    rot_mode = poseBone.rotation_mode
+    framesCount = len(frameTimes)
+
+    # Fcurves data paths
+    position_path = poseBone.path_from_id("location")
+    scale_path = poseBone.path_from_id("scale")
+    if rot_mode == 'QUATERNION':
+        rotation_path = poseBone.path_from_id("rotation_quaternion")
+        rotations = np.tile((1.0, 0.0, 0.0, 0.0), (framesCount, 1))
+    elif rot_mode == 'AXIS_ANGLE':
+        rotation_path = poseBone.path_from_id("rotation_axis_angle")
+        rotations = np.tile((0.0, 0.0, 1.0, 0.0), (framesCount, 1))
+    else:
+        rotation_path = poseBone.path_from_id("rotation_euler")
+        rotations = np.zeros((framesCount, 3))
+    positions = np.zeros((framesCount, 3))
+    scales = np.ones((framesCount, 3))
+
+    # Evaluate the Fcurves of the bone
+    for curve in actionFcurves:
+        if curve.data_path == position_path:
+            values = positions
+        elif curve.data_path == rotation_path:
+            values = rotations
+        elif curve.data_path == scale_path:
+            values = scales
+        else:
+            continue
+        if curve.array_index < values.shape[1]:
+            values[:, curve.array_index] = EvaluateFcurve(curve, frameTimes)
+
+    if rot_mode == 'AXIS_ANGLE':
+        rotations = AxisAnglesToQuaternions(rotations)
+    elif rot_mode != 'QUATERNION':
+        rotations = EulersToQuaternions(rotations, rot_mode)
+    # Between keyframes the quaternion components curves are interpolated, so the resulting
+    # quaternion must be normalized (at keyframes the quaternions are already normalized)
+    lengths = np.linalg.norm(rotations, axis=1, keepdims=True)
+    rotations = np.divide(rotations, lengths, out=np.tile((1.0, 0.0, 0.0, 0.0), (framesCount, 1)),
+                          where=(lengths > 0.0))
+
+    # Create the full trasformation matrices: translation * rotation * scale
+    matrices = np.zeros((framesCount, 4, 4))
+    matrices[:, :3, :3] = QuaternionsToMatrices(rotations) * scales[:, None, :]
+    matrices[:, :3, 3] = positions
+    matrices[:, 3, 3] = 1.0
+    return matrices
 
-    # Class for storing a NlaStrip, its previous strip and its parent track
-    class NlaStripLink:
-        def __init__(self, strip, previous, track):
-            self.name = strip.name
-            self.strip = strip
-            self.previous = previous
-            self.track = track
 
-    # Check if 'armatureObj' is an armature (skeleton animations) or a mesh (object animations)
-    isArmature = (armatureObj.type == 'ARMATURE')
+#--------------------
+# Matrices to position, rotation, scale
+#--------------------
 
-    bonesMap = tData.bonesMap
-    animationsList = tData.animationsList
-    
-    if not armatureObj.animation_data:
-        if isArmature:
-            log.warning('Armature {:s} has no animation data'.format(armatureObj.name))
-        else:
-            log.warning('Object {:s} has no animation data'.format(armatureObj.name))
-        return
-                        
-    originMatrix = Matrix.Identity(4)
-    if tOptions.actionsGlobalOrigin:
-        originMatrix = armatureObj.matrix_world
-        if tOptions.globalOrigin and originMatrix != Matrix.Identity(4):
-            # Blender moves/rotates the armature together with the mesh, so if you set a global origin
-            # for Mesh and Actions you'll have twice the transformations. Set only one global origin.
-            log.warning("Use local origin for the object otherwise transformations are applied twice")
-    
-    # Save current action and frame, we'll restore them later
-    savedAction = armatureObj.animation_data.action
-    savedFrame = scene.frame_current
-    savedUseNla = armatureObj.animation_data.use_nla
+# Convert an array of rotation matrices (..., 3, 3) to quaternions (..., 4) (w, x, y, z)
+# with w >= 0. For each matrix the largest quaternion component is computed first, so
+# the result is accurate for any rotation (Shepperd's method).
+def RotationsToQuaternions(m):
+    m00, m01, m02 = m[..., 0, 0], m[..., 0, 1], m[..., 0, 2]
+    m10, m11, m12 = m[..., 1, 0], m[..., 1, 1], m[..., 1, 2]
+    m20, m21, m22 = m[..., 2, 0], m[..., 2, 1], m[..., 2, 2]
+    cases = np.argmax(np.stack((m00 + m11 + m22, m00, m11, m22), axis=-1), axis=-1)
+    quaternions = np.empty(m.shape[:-2] + (4,))
+    # Largest w
+    c = (cases == 0)
+    s = 2.0 * np.sqrt(np.maximum(1.0 + m00[c] + m11[c] + m22[c], 1e-12))
+    quaternions[c] = np.stack((0.25 * s, (m21[c] - m12[c]) / s, (m02[c] - m20[c]) / s, (m10[c] - m01[c]) / s), axis=-1)
+    # Largest x
+    c = (cases == 1)
+    s = 2.0 * np.sqrt(np.maximum(1.0 + m00[c] - m11[c] - m22[c], 1e-12))
+    quaternions[c] = np.stack(((m21[c] - m12[c]) / s, 0.25 * s, (m01[c] + m10[c]) / s, (m02[c] + m20[c]) / s), axis=-1)
+    # Largest y
+    c = (cases == 2)
+    s = 2.0 * np.sqrt(np.maximum(1.0 + m11[c] - m00[c] - m22[c], 1e-12))
+    quaternions[c] = np.stack(((m02[c] - m20[c]) / s, (m01[c] + m10[c]) / s, 0.25 * s, (m12[c] + m21[c]) / s), axis=-1)
+    # Largest z
+    c = (cases == 3)
+    s = 2.0 * np.sqrt(np.maximum(1.0 + m22[c] - m00[c] - m11[c], 1e-12))
+    quaternions[c] = np.stack(((m10[c] - m01[c]) / s, (m02[c] + m20[c]) / s, (m12[c] + m21[c]) / s, 0.25 * s), axis=-1)
+    quaternions *= np.where(quaternions[..., :1] < 0.0, -1.0, 1.0)
+    quaternions /= np.linalg.norm(quaternions, axis=-1, keepdims=True)
+    return quaternions
+
+# Decompose the matrices (..., 4, 4) in positions (..., 3), rotations (..., 4) (w, x, y, z)
+# and scales (..., 3), as mathutils to_translation(), to_quaternion(), to_scale(), and
+# convert them to left hand (see DecomposeActions): 'isBone' for the matrices of bones
+# relative to their parent, otherwise for object matrices.
+def MatricesToTRS(matrices, isBone):
+    t = matrices[..., :3, 3]
+    # The scale is the length of the columns
+    s = np.linalg.norm(matrices[..., :3, :3], axis=-2)
+    rotations = matrices[..., :3, :3] / np.where(s > 0.0, s, 1.0)[..., None, :]
+    q = RotationsToQuaternions(rotations)
+
+    if isBone:
+        # Bone animation
+        positions = np.stack((t[..., 0], t[..., 1], -t[..., 2]), axis=-1)
+        rotations = np.stack((q[..., 0], -q[..., 1], -q[..., 2], q[..., 3]), axis=-1)
+        scales = s.copy()
+    else:
+        # Object animation
+        positions = np.stack((t[..., 0], t[..., 2], t[..., 1]), axis=-1)
+        rotations = np.stack((q[..., 0], -q[..., 1], -q[..., 3], -q[..., 2]), axis=-1)
+        scales = np.stack((s[..., 0], s[..., 2], s[..., 1]), axis=-1)
+    return positions, rotations, scales
+
+
+#--------------------
+# Actions cache
+#--------------------
+
+# Version of the cached animations, increase it when the decomposition or the data
+# saved in the cache change so the old entries are not used anymore
+ACTION_CACHE_VERSION = 1
+
+# Key in DiskCache of the decomposed Action 'action' of the armature 'armatureObj', it
+# depends on the F-curves, the rest pose, the frames range and the options. Returns None
+# if the Action cannot be cached (the pose depends on something else than the Action).
+def ActionCacheKey(action, armatureObj, bonesMap, startframe, endframe, scene, tOptions):
+    if not tOptions.actionsByFcurves:
+        # Drivers or constraints targeting other objects can change the pose
+        if armatureObj.animation_data.drivers:
+            return None
+        for poseBone in armatureObj.pose.bones:
+            for constraint in poseBone.constraints:
+                target = getattr(constraint, "target", None)
+                if target and target != armatureObj:
+                    return None
+
+    parts = ["action", ACTION_CACHE_VERSION, startframe, endframe, scene.frame_step, scene.render.fps, list(bonesMap.keys())]
+
+    # F-curves
+    for curve in action.fcurves:
+        keyframes = curve.keyframe_points
+        points = np.empty((3, len(keyframes) * 2), dtype=np.float32)
+        for i, name in enumerate(("co", "handle_left", "handle_right")):
+            keyframes.foreach_get(name, points[i])
+        modes = np.empty((2, len(keyframes)), dtype=np.int32)
+        for i, name in enumerate(("interpolation", "easing")):
+            keyframes.foreach_get(name, modes[i])
+        parts += [curve.data_path, curve.array_index, curve.extrapolation, curve.mute, points, modes,
+                  [(m.type, m.mute, m.influence) for m in curve.modifiers]]
+    parts.append([group.name for group in action.groups])
+    parts.append([(marker.name, marker.frame) for marker in action.pose_markers])
+
+    # Rest pose
+    bones = armatureObj.data.bones
+    matrices = np.empty(len(bones) * 16, dtype=np.float32)
+    bones.foreach_get("matrix_local", matrices)
+    parts += [[(bone.name, bone.parent and bone.parent.name) for bone in bones], matrices]
+    parts.append([(poseBone.rotation_mode, [(c.type, c.mute, c.influence) for c in poseBone.constraints])
+                  for poseBone in armatureObj.pose.bones])
+    parts.append(np.array(armatureObj.matrix_world))
+
+    # Options
+    parts += [tOptions.orientation and tuple(tOptions.orientation), tOptions.scale, tOptions.globalOrigin,
+              tOptions.actionsGlobalOrigin, tOptions.actionsByFcurves, tOptions.doOnlyKeyedBones,
+              tOptions.doAnimationPos, tOptions.doAnimationRot, tOptions.doAnimationSca,
+              tOptions.filterSingleKeyFrames, tOptions.doTriggers, tOptions.doReduceKeyframes,
+              tOptions.reducePositionTolerance, tOptions.reduceRotationTolerance, tOptions.reduceScaleTolerance]
+    return DiskCache.Key(*parts)
+
+# Tracks and triggers of 'tAnimation' as plain data (arrays, strings), used to save
+# animations in the cache and to send them from the bake workers
+def AnimationToData(tAnimation):
+    tracks = []
+    for tTrack in tAnimation.tracks:
+        frames = tTrack.frames
+        times = np.array([frame.time for frame in frames])
+        values = []
+        for name in ("position", "rotation", "scale"):
+            if getattr(frames[0], name) is None:
+                values.append(None)
+            else:
+                values.append(np.array([tuple(getattr(frame, name)) for frame in frames]))
+        tracks.append((tTrack.name, times, values[0], values[1], values[2]))
+    triggers = [(tTrigger.name, tTrigger.time, tTrigger.ratio, tTrigger.data) for tTrigger in tAnimation.triggers]
+    return (tracks, triggers)
+
+# Add to 'tAnimation' the tracks and triggers of 'data' (see AnimationToData)
+def AnimationFromData(data, tAnimation):
+    tracks, triggers = data
+    for name, times, positions, rotations, scales in tracks:
+        tTrack = TTrack(name)
+        for i, time in enumerate(times.tolist()):
+            position = None if positions is None else Vector(positions[i].tolist())
+            rotation = None if rotations is None else Quaternion(rotations[i].tolist())
+            scale = None if scales is None else Vector(scales[i].tolist())
+            tTrack.frames.append(TFrame(time, position, rotation, scale))
+        tAnimation.tracks.append(tTrack)
+    for name, time, ratio, data in triggers:
+        tTrigger = TTrigger(name)
+        tTrigger.time = time
+        tTrigger.ratio = ratio
+        tTrigger.data = data
+        tAnimation.triggers.append(tTrigger)
+
+# Save the tracks and triggers of 'tAnimation' in the cache with 'key'
+def SaveCachedAnimation(cache, key, tAnimation):
+    cache.put(key, pickle.dumps(AnimationToData(tAnimation), protocol=pickle.HIGHEST_PROTOCOL))
+
+# Load from the cache the tracks and triggers of 'tAnimation', returns False if not found
+def LoadCachedAnimation(cache, key, tAnimation):
+    data = cache.get(key)
+    if data is None:
+        return False
+    try:
+        AnimationFromData(pickle.loads(data), tAnimation)
+    except Exception as e:
+        log.warning("Invalid cache data for {:s}: {!s}".format(tAnimation.name, e))
+        tAnimation.tracks.clear()
+        tAnimation.triggers.clear()
+        return False
+    return True
+
+
+#--------------------
+# Actions baking in background processes
+#--------------------
+
+#  Scene evaluation cannot be threaded, so the Actions of an armature can be split in
+#  subsets decomposed by background Blender processes:
+#    blender --factory-startup -b <file.blend> --python bake_actions.py -- <job file>
+#  The job file (pickle) contains the Actions names, the bones names and the TOptions,
+#  the worker writes the animations (see AnimationToData) in the job output file.
+#  The workers load the saved .blend file, so it must be saved and not modified.
+
+# Returns the frames range (start, end excluded) of an Action
+def ActionFrameRange(action, scene, tOptions):
+    (startframe, endframe) = action.frame_range
+    startframe = int(startframe)
+    endframe = int(endframe + 1)
+    # Extra frame at the end of a looping animation, we'll copy the start frame
+    if tOptions.doAnimationExtraFrame:
+        endframe += scene.frame_step
+    return (startframe, endframe)
+
+# Decompose the Actions 'actions' of 'armatureObj' in 'tOptions.bakeWorkers' background
+# Blender processes. Returns a dictionary Action name to TAnimation, Actions missing in the
+# dictionary (all of them if the workers cannot be used) must be decomposed here.
+def BakeActionsInWorkers(scene, armatureObj, bonesMap, actions, tOptions):
+    workersCount = min(tOptions.bakeWorkers, len(actions))
+    if workersCount < 1 or len(actions) < 2:
+        return {}
+    if not tOptions.bakeFilepath:
+        log.warning("Save the blend file to decompose the actions in background processes")
+        return {}
+
+    # Copy the options (only simple values)
+    options = {}
+    for name, value in vars(tOptions).items():
+        if value is None or isinstance(value, (bool, int, float, str)):
+            options[name] = value
+    options["bakeWorkers"] = 0
+    options["orientation"] = tOptions.orientation and tuple(tOptions.orientation)
+
+    # Split the Actions by frames count, longest first to the least loaded worker
+    subsets = [[] for i in range(workersCount)]
+    loads = [0] * workersCount
+    for action in sorted(actions, key=lambda a: a.frame_range[0] - a.frame_range[1]):
+        i = loads.index(min(loads))
+        subsets[i].append(action.name)
+        startframe, endframe = ActionFrameRange(action, scene, tOptions)
+        loads[i] += endframe - startframe
+
+    tempDir = tempfile.mkdtemp(prefix="urho_bake_")
+    workers = []
+    tAnimations = {}
+    try:
+        scriptPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bake_actions.py")
+        for i, actionNames in enumerate(subsets):
+            job = { "package": __package__,
+                    "addonsPath": os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                    "scene": scene.name,
+                    "armature": armatureObj.name,
+                    "bones": list(bonesMap.keys()),
+                    "actions": actionNames,
+                    "options": options,
+                    "output": os.path.join(tempDir, "animations{:d}.bin".format(i)) }
+            jobPath = os.path.join(tempDir, "job{:d}.bin".format(i))
+            with open(jobPath, "wb") as file:
+                pickle.dump(job, file, protocol=pickle.HIGHEST_PROTOCOL)
+            args = [bpy.app.binary_path, "--factory-startup", "-b", tOptions.bakeFilepath,
+                    "--python-exit-code", "1", "--python", scriptPath, "--", jobPath]
+            try:
+                worker = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            except OSError as e:
+                log.warning("Cannot start background Blender: {!s}".format(e))
+                continue
+            workers.append((worker, job))
+        log.info("Decomposing {:d} actions in {:d} background processes".format(len(actions), len(workers)))
+
+        # Wait the workers and load the animations
+        for worker, job in workers:
+            errors = worker.communicate()[1]
+            try:
+                if worker.returncode != 0:
+                    raise RuntimeError(errors.decode("utf-8", "replace").strip()[-500:])
+                with open(job["output"], "rb") as file:
+                    results = pickle.load(file)
+            except Exception as e:
+                log.warning("Background decomposition of {:s} failed: {!s}".format(", ".join(job["actions"]), e))
+                continue
+            for name, data in results:
+                tAnimation = TAnimation(name)
+                AnimationFromData(data, tAnimation)
+                tAnimations[name] = tAnimation
+    finally:
+        # Do not leave running workers when the export is aborted
+        for worker, job in workers:
+            if worker.poll() is None:
+                worker.kill()
+                worker.wait()
+        shutil.rmtree(tempDir, ignore_errors=True)
+    return tAnimations
+
+# Entry point of the bake worker (see bake_actions.py): decompose the Actions of the job
+# and save the animations
+def BakeActionsJob(job):
+    global decomposedActions
+    decomposedActions = []
+
+    tOptions = TOptions()
+    for name, value in job["options"].items():
+        setattr(tOptions, name, value)
+    if tOptions.orientation:
+        tOptions.orientation = Quaternion(tOptions.orientation)
+
+    scene = bpy.data.scenes[job["scene"]]
+    armatureObj = bpy.data.objects[job["armature"]]
+    armatureObj.data.pose_position = 'POSE'
+
+    # Only the bones names are needed
+    tData = TData()
+    for boneName in job["bones"]:
+        tData.bonesMap[boneName] = None
+
+    DecomposeActions(scene, armatureObj, tData, tOptions, job["actions"])
+
+    results = [(tAnimation.name, AnimationToData(tAnimation)) for tAnimation in tData.animationsList]
+    with open(job["output"], "wb") as file:
+        pickle.dump(results, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+#--------------------
+# Decompose animations
+#--------------------
+
+# Set each frame of 'frameTimes' only once and save the matrices of the bones 'boneNames' of
+# the armature 'obj' relative to their parent bone (or to the armature for root bones).
+# If 'obj' is not an armature save its local matrix (relative to the parent).
+# Returns an array (frames, bones, 4, 4).
+def SamplePoseMatrices(scene, obj, boneNames, frameTimes):
+    framesCount = len(frameTimes)
+
+    if obj.type != 'ARMATURE':
+        matrices = np.empty((framesCount, 1, 4, 4))
+        for i, frameTime in enumerate(frameTimes):
+            scene.frame_set(frameTime)
+            matrices[i, 0] = obj.matrix_local
+        return matrices
+
+    poseBones = obj.pose.bones
+    slots = {poseBone.name: i for i, poseBone in enumerate(poseBones)}
+    buffer = np.empty((framesCount, len(poseBones) * 16), dtype=np.float32)
+    for i, frameTime in enumerate(frameTimes):
+        scene.frame_set(frameTime)
+        # All the bones matrices (armature space) of the current frame
+        poseBones.foreach_get("matrix", buffer[i])
+
+    # Blender matrices are saved by columns
+    allMatrices = buffer.reshape(framesCount, len(poseBones), 4, 4).transpose(0, 1, 3, 2).astype(np.float64)
+    matrices = allMatrices[:, [slots[name] for name in boneNames]]
+    for i, boneName in enumerate(boneNames):
+        parent = poseBones[boneName].parent
+        if parent:
+            # Bone matrix relative to its parent bone
+            matrices[:, i] = np.linalg.inv(allMatrices[:, slots[parent.name]]) @ matrices[:, i]
+    return matrices
+
+# Class for storing a NlaStrip, its previous strip and its parent track
+class NlaStripLink:
+    def __init__(self, strip, previous, track):
+        self.name = strip.name
+        self.strip = strip
+        self.previous = previous
+        self.track = track
+
+# Get the animation objects (Actions, Tracks, Strips, Timeline) of the armature or of
+# the object 'armatureObj' selected by the options
+def GetAnimationObjects(scene, armatureObj, tOptions):
+    isArmature = (armatureObj.type == 'ARMATURE')
 
-    # When exporting the timeline for multiple objects (objects not armatures) use only
-    # one TAnimation with an object per track, each track must be named after the object.
-    # See the "AnimationState(Node* node, Animation* animation)" constructor.
-    commonAnimation = None
-    
     # Here we collect every animation objects we want to export
     animationObjects = []
 
@@ -1302,8 +1864,134 @@ def DecomposeActions(scene, armatureObj, tData, tOptions):
             animationObjects.append(armatureObj)
         else:
             animationObjects.append(scene)
-            # Common animation for multiple object, one object per track
-            commonAnimation = tData.commonAnimation
+
+    return animationObjects
+
+# Object animations are sampled in a single sweep of the timeline: collect every animated
+# object first, then set each frame only once and save the local matrices of all the objects.
+# Each object can play only one Action at a time, so its Actions are sampled in successive
+# sweeps (the first Action of every object, then the second, ...). Only Actions and the
+# Timeline are sampled here, Tracks and Strips are left to DecomposeActions.
+# Returns a dictionary (object, animation object) pointers to matrices (frames, 1, 4, 4).
+def SampleObjectsAnimations(scene, objects, tOptions):
+    objectsMatrices = {}
+
+    # Animation objects of each object, skip the ones already used by a previous object
+    # like DecomposeActions does
+    usedPointers = set()
+    objectsAnimations = []
+    for obj in objects:
+        if obj.type == 'ARMATURE' or not obj.animation_data:
+            continue
+        # Constraints and drivers can depend on other objects, which are playing
+        # different Actions during the sweep
+        if obj.constraints or obj.animation_data.drivers:
+            continue
+        animationObjects = []
+        for animationObject in GetAnimationObjects(scene, obj, tOptions):
+            if not isinstance(animationObject, (bpy.types.Action, bpy.types.Scene)):
+                continue
+            if animationObject.as_pointer() in usedPointers:
+                continue
+            usedPointers.add(animationObject.as_pointer())
+            # Actions decomposed by F-curves don't need the timeline
+            if isinstance(animationObject, bpy.types.Action) and tOptions.actionsByFcurves and animationObject.fcurves:
+                continue
+            animationObjects.append(animationObject)
+        if animationObjects:
+            objectsAnimations.append((obj, animationObjects))
+
+    if not objectsAnimations:
+        return objectsMatrices
+
+    savedFrame = scene.frame_current
+    sweepIndex = 0
+    while True:
+        # The animation object played by each object in this sweep
+        entries = [(obj, animationObjects[sweepIndex]) for obj, animationObjects in objectsAnimations
+                    if sweepIndex < len(animationObjects)]
+        if not entries:
+            break
+        sweepIndex += 1
+
+        savedStates = []
+        framesEntries = {}
+        for obj, animationObject in entries:
+            animationData = obj.animation_data
+            savedStates.append((animationData, animationData.action, animationData.use_nla))
+            if isinstance(animationObject, bpy.types.Action):
+                (startframe, endframe) = ActionFrameRange(animationObject, scene, tOptions)
+                animationData.use_nla = False
+                animationData.action = animationObject
+            else:
+                startframe = int(scene.frame_start)
+                endframe = int(scene.frame_end + 1)
+                if tOptions.doAnimationExtraFrame:
+                    endframe += scene.frame_step
+                animationData.use_nla = True
+            frameTimes = range(startframe, endframe, scene.frame_step)
+            matrices = np.empty((len(frameTimes), 1, 4, 4))
+            objectsMatrices[(obj.as_pointer(), animationObject.as_pointer())] = matrices
+            for i, frameTime in enumerate(frameTimes):
+                framesEntries.setdefault(frameTime, []).append((obj, matrices, i))
+
+        log.info("Sampling {:d} object animations (frames {:d})".format(len(entries), len(framesEntries)))
+        for frameTime in sorted(framesEntries):
+            scene.frame_set(frameTime)
+            for obj, matrices, i in framesEntries[frameTime]:
+                matrices[i, 0] = obj.matrix_local
+
+        for animationData, action, useNla in savedStates:
+            animationData.action = action
+            animationData.use_nla = useNla
+
+    scene.frame_set(savedFrame)
+    return objectsMatrices
+
+# If 'actionNames' is not None decompose only these Actions
+def DecomposeActions(scene, armatureObj, tData, tOptions, actionNames = None):
+
+    # Check if 'armatureObj' is an armature (skeleton animations) or a mesh (object animations)
+    isArmature = (armatureObj.type == 'ARMATURE')
+
+    bonesMap = tData.bonesMap
+    animationsList = tData.animationsList
+    
+    if not armatureObj.animation_data:
+        if isArmature:
+            log.warning('Armature {:s} has no animation data'.format(armatureObj.name))
+        else:
+            log.warning('Object {:s} has no animation data'.format(armatureObj.name))
+        return
+                        
+    originMatrix = Matrix.Identity(4)
+    if tOptions.actionsGlobalOrigin:
+        originMatrix = armatureObj.matrix_world
+        if tOptions.globalOrigin and originMatrix != Matrix.Identity(4):
+            # Blender moves/rotates the armature together with the mesh, so if you set a global origin
+            # for Mesh and Actions you'll have twice the transformations. Set only one global origin.
+            log.warning("Use local origin for the object otherwise transformations are applied twice")
+    
+    # Save current action and frame, we'll restore them later
+    savedAction = armatureObj.animation_data.action
+    savedFrame = scene.frame_current
+    savedUseNla = armatureObj.animation_data.use_nla
+
+    # When exporting the timeline for multiple objects (objects not armatures) use only
+    # one TAnimation with an object per track, each track must be named after the object.
+    # See the "AnimationState(Node* node, Animation* animation)" constructor.
+    commonAnimation = None
+    
+    # Here we collect every animation objects we want to export
+    animationObjects = GetAnimationObjects(scene, armatureObj, tOptions)
+
+    # Common animation for multiple object, one object per track
+    if tOptions.doTimeline and not isArmature:
+        commonAnimation = tData.commonAnimation
+
+    # Only the requested Actions (background worker)
+    if actionNames is not None:
+        animationObjects = [bpy.data.actions[name] for name in actionNames]
 
     if not animationObjects:
         if isArmature:
@@ -1314,6 +2002,21 @@ def DecomposeActions(scene, armatureObj, tData, tOptions):
     
     global decomposedActions;
 
+    # Decompose the Actions in background processes (except the ones in the cache)
+    bakedAnimations = {}
+    if tOptions.bakeWorkers > 0 and isArmature and actionNames is None:
+        actions = []
+        for object in animationObjects:
+            if not isinstance(object, bpy.types.Action) or object in decomposedActions or object in actions:
+                continue
+            if tOptions.diskCache:
+                startframe, endframe = ActionFrameRange(object, scene, tOptions)
+                cacheKey = ActionCacheKey(object, armatureObj, bonesMap, startframe, endframe, scene, tOptions)
+                if cacheKey and os.path.exists(tOptions.diskCache.filepath(cacheKey)):
+                    continue
+            actions.append(object)
+        bakedAnimations = BakeActionsInWorkers(scene, armatureObj, bonesMap, actions, tOptions)
+
     for object in animationObjects:
         if (object in decomposedActions):
             print("SKIPPING ACTION:%s"%object.name)
@@ -1328,22 +2031,44 @@ def DecomposeActions(scene, armatureObj, tData, tOptions):
         oldStripValue = None
     
         if isinstance(object, bpy.types.Action):
-            # Actions have their frame range
-            (startframe, endframe) = object.frame_range
-            startframe = int(startframe)
-            endframe = int(endframe + 1)
-        elif isinstance(object, NlaStripLink): # bpy.types.NlaStrip
-            # Strips also have their frame range
-            startframe = int(object.strip.frame_start)
-            endframe = int(object.strip.frame_end + 1)
+            # Actions have their frame range (with the extra frame)
+            (startframe, endframe) = ActionFrameRange(object, scene, tOptions)
         else:
-            # For Tracks and Timeline we use the scene playback range
-            startframe = int(scene.frame_start)
-            endframe = int(scene.frame_end + 1)
+            if isinstance(object, NlaStripLink): # bpy.types.NlaStrip
+                # Strips also have their frame range
+                startframe = int(object.strip.frame_start)
+                endframe = int(object.strip.frame_end + 1)
+            else:
+                # For Tracks and Timeline we use the scene playback range
+                startframe = int(scene.frame_start)
+                endframe = int(scene.frame_end + 1)
+
+            # Extra frame at the end of a looping animation, we'll copy the start frame
+            if tOptions.doAnimationExtraFrame:
+                endframe += scene.frame_step
+
+        # Load the Action from the cache if unchanged
+        cacheKey = None
+        if tOptions.diskCache and isArmature and isinstance(object, bpy.types.Action):
+            cacheKey = ActionCacheKey(object, armatureObj, bonesMap, startframe, endframe, scene, tOptions)
+            if cacheKey and LoadCachedAnimation(tOptions.diskCache, cacheKey, tAnimation):
+                log.info("Loaded action from cache: {:s}".format(object.name))
+                if tAnimation.tracks:
+                    animationsList.append(tAnimation)
+                    if not tData.commonAnimation:
+                        tData.commonAnimation = tAnimation
+                continue
 
-        # Extra frame at the end of a looping animation, we'll copy the start frame
-        if tOptions.doAnimationExtraFrame:
-            endframe += scene.frame_step
+        # Action decomposed by a background process
+        if isinstance(object, bpy.types.Action) and object.name in bakedAnimations:
+            tAnimation = bakedAnimations[object.name]
+            if cacheKey:
+                SaveCachedAnimation(tOptions.diskCache, cacheKey, tAnimation)
+            if tAnimation.tracks:
+                animationsList.append(tAnimation)
+                if not tData.commonAnimation:
+                    tData.commonAnimation = tAnimation
+            continue
 
         # Action Fcurves
         actionFcurves = None
@@ -1451,185 +2176,131 @@ def DecomposeActions(scene, armatureObj, tData, tOptions):
             for poseBone in armatureObj.pose.bones:
                 poseBone.matrix_basis = Matrix.Identity(4)
 
-        # Progress counter
-        progressCur = 0
-        progressTot = 0.01 * len(bones) * (endframe-startframe)/scene.frame_step
-    
-        for boneName in bones:
-            if isArmature:
+        # Skip the bones missing in the skeleton or in the pose
+        if isArmature:
+            validBones = []
+            for boneName in bones:
                 if not boneName in bonesMap:
                     log.warning("Skeleton does not contain bone {:s}".format(boneName))
-                    continue
-
-                if not boneName in armatureObj.pose.bones:
+                elif not boneName in armatureObj.pose.bones:
                     log.warning("Pose does not contain bone {:s}".format(boneName))
-                    continue
-                            
-                # Get the Blender pose bone (bpy.types.PoseBone)
-                poseBone = armatureObj.pose.bones[boneName]
-                parent = poseBone.parent
-            else:
-                # For object animations we use the object itself as the bone
-                poseBone = armatureObj
-                parent = armatureObj.parent
-
-            rot_mode = poseBone.rotation_mode
-
-            tTrack = TTrack(boneName)
-
-            if actionFcurves:
-                # Fcurves data paths
-                position_path = poseBone.path_from_id("location")
-                scale_path = poseBone.path_from_id("scale")
-                if rot_mode == 'QUATERNION':
-                    rotation_path = poseBone.path_from_id("rotation_quaternion")
-                elif rot_mode == 'AXIS_ANGLE':
-                    rotation_path = poseBone.path_from_id("rotation_axis_angle")
                 else:
-                    rotation_path = poseBone.path_from_id("rotation_euler")
-                # Find the Fcurves of the current bone
-                position_curves = []
-                rotation_curves = []
-                scale_curves = []
-                for curve in actionFcurves:
-                    if curve.data_path == position_path:
-                        position_curves.append(curve)
-                    elif curve.data_path == rotation_path:
-                        rotation_curves.append(curve)
-                    elif curve.data_path == scale_path:
-                        scale_curves.append(curve)
+                    validBones.append(boneName)
+            bones = validBones
+
+        frameTimes = range(startframe, endframe, scene.frame_step)
+
+        # Without Fcurves, set each frame only once and save the matrices of all the bones
+        sampledMatrices = None
+        if not actionFcurves:
+            sampleKey = None
+            if not isArmature and isinstance(object, (bpy.types.Action, bpy.types.Scene)):
+                sampleKey = (armatureObj.as_pointer(), object.as_pointer())
+            if tOptions.objectsMatrices and sampleKey in tOptions.objectsMatrices:
+                # Already sampled by the scene-wide sweep of the object animations
+                sampledMatrices = tOptions.objectsMatrices.pop(sampleKey)
+            else:
+                sampledMatrices = SamplePoseMatrices(scene, armatureObj, bones, frameTimes)
 
+        # Matrices of each bone (or of the object) at each frame: (frames, bones, 4, 4)
+        if actionFcurves:
+            poseMatrices = np.empty((len(frameTimes), len(bones), 4, 4))
+            for boneIndex, boneName in enumerate(bones):
                 if isArmature:
+                    # Get the Blender pose bone (bpy.types.PoseBone)
+                    poseBone = armatureObj.pose.bones[boneName]
                     # Local rest matrix (relative to the parent)
-                    restMatrix = poseBone.bone.matrix_local.copy()
+                    restMatrix = np.array(poseBone.bone.matrix_local)
                     if poseBone.parent:
-                        restMatrix = poseBone.parent.bone.matrix_local.inverted() * restMatrix
+                        restMatrix = np.linalg.inv(np.array(poseBone.parent.bone.matrix_local)) @ restMatrix
                 else:
-                    # Object rest matrix
-                    restMatrix = Matrix()
+                    # For object animations we use the object itself as the bone
+                    poseBone = armatureObj
+                    restMatrix = np.identity(4)
+                # Evaluate the Fcurves of the current bone at all the frames.
+                # These matrices are the rotation/scale/translation of the bone with respect to its rest
+                # position relative to its parent. 
+                # We apply the rest position to obtain the rotation/scale/translation of the bone with
+                # respect to its parent.
+                poseMatrices[:, boneIndex] = restMatrix @ EvaluateFcurvesMatrices(poseBone, actionFcurves, frameTimes)
+        else:
+            # Matrices relative to the parent bone (or the armature), for objects the local matrix
+            poseMatrices = sampledMatrices
 
-            # For each frame
-            for frameTime in range(startframe, endframe, scene.frame_step):
-                
-                if (progressCur % 40) == 0:
-                    print("{:.3f}%\r".format(progressCur / progressTot), end='' )
-                progressCur += 1
+        # Root bones or object with no parent
+        for boneIndex, boneName in enumerate(bones):
+            if isArmature:
+                if armatureObj.pose.bones[boneName].parent:
+                    continue
+                # Root bone matrix relative to the armature
+                rootMatrix = np.array(Matrix.Rotation(math.radians(-90.0), 4, 'X' ) @ originMatrix)
+                if tOptions.orientation:
+                    rootMatrix = rootMatrix @ np.array(tOptions.orientation.to_matrix().to_4x4())
+                poseMatrices[:, boneIndex] = rootMatrix @ poseMatrices[:, boneIndex]
+            elif not armatureObj.parent and tOptions.orientation:
+                # Object animations: reorient the animations
+                # Remove the orientation from the object, apply the animation then orient again
+                om = np.array(tOptions.orientation.to_matrix().to_4x4())
+                poseMatrices[:, boneIndex] = om @ poseMatrices[:, boneIndex] @ np.linalg.inv(om)
 
-                # Check if we are at the last frame
-                isLastFrame = (frameTime >= endframe - scene.frame_step)
-                
-                if actionFcurves:
-                    # Evaluate the Fcurves of the current bone at the current time
-
-                    # Evaluate the position
-                    curvePosition = Vector()
-                    for curve in position_curves:
-                        curvePosition[curve.array_index] = curve.evaluate(frameTime)
-
-                    # Evaluate the rotation
-                    curveRotation = Quaternion((1.0, 0.0, 0.0, 0.0))
-                    if rot_mode == 'QUATERNION':
-                        for curve in rotation_curves:
-                            curveRotation[curve.array_index] = curve.evaluate(frameTime)
-                    elif rot_mode == 'AXIS_ANGLE':
-                        angle_axis = Vector.Fill(4)
-                        for curve in rotation_curves:
-                            angle_axis[curve.array_index] = curve.evaluate(frameTime)
-                        curveRotation = Quaternion(angle_axis.yzw, angle_axis.x)
-                    else:
-                        eulerRotation = Euler((0.0, 0.0, 0.0), rot_mode)
-                        for curve in rotation_curves:
-                            eulerRotation[curve.array_index] = curve.evaluate(frameTime)
-                        curveRotation = eulerRotation.to_quaternion()
-                    # Between keyframes the quaternion components curves are interpolated, so the resulting
-                    # quaternion must be normalized (at keyframes the quaternions are already normalized)
-                    curveRotation.normalize()
-
-                    # Evaluate the scale
-                    curveScale = Vector((1.0, 1.0, 1.0))
-                    for curve in scale_curves:
-                        curveScale[curve.array_index] = curve.evaluate(frameTime)
-
-                    # Create the full trasformation matrix
-                    deltaMatrix = curveRotation.to_matrix().to_4x4()
-                    scaleMatrix = Matrix()
-                    for i in range(0, 3):
-                        scaleMatrix[i][i] = curveScale[i]
-                    deltaMatrix *= scaleMatrix
-                    deltaMatrix.translation = curvePosition
-
-                    # The matrix above is the rotation/scale/translation of the bone with respect to its rest
-                    # position relative to its parent. 
-                    # We apply the rest position to obtain the rotation/scale/translation of the bone with
-                    # respect to its parent.
-                    poseMatrix = restMatrix * deltaMatrix
+        if tOptions.scale != 1.0:
+            poseMatrices[..., :3, 3] *= tOptions.scale
 
-                else:
-                    # Set frame (TODO: this is very slow, try to advance only the armature)
-                    # (rna_Scene_frame_set, BKE_scene_update_for_newframe, BKE_animsys_evaluate_animdata)
-                    scene.frame_set(frameTime)
-                
-                    if isArmature:
-                        # This matrix is referred to the armature (object space)
-                        poseMatrix = poseBone.matrix.copy()
+        # Extract position, rotation and scale relative to parent in parent space, in left hand
+        positions, rotations, scales = MatricesToTRS(poseMatrices, isArmature)
+        if not tOptions.doAnimationPos:
+            positions = None
+        if not tOptions.doAnimationRot:
+            rotations = None
+        if not tOptions.doAnimationSca:
+            scales = None
 
-                        if parent:
-                            # Bone matrix relative to its parent bone
-                            poseMatrix = parent.matrix.inverted() @ poseMatrix
-                    else:
-                        # Object animations: use the matrix relative to the parent (local matrix)
-                        poseMatrix = poseBone.matrix_local.copy()
-
-                # Root bone or object with no parent
-                if not parent:
-                    if isArmature:
-                        # Root bone matrix relative to the armature
-                        if tOptions.orientation:
-                            poseMatrix = tOptions.orientation.to_matrix().to_4x4() @ poseMatrix
-                        poseMatrix = Matrix.Rotation(math.radians(-90.0), 4, 'X' ) @ originMatrix @ poseMatrix
-                    else:
-                        # Object animations: reorient the animations
-                        if tOptions.orientation:
-                            # Remove the orientation from the object, apply the animation then orient again
-                            om = tOptions.orientation.to_matrix().to_4x4()
-                            poseMatrix = om @ poseMatrix @ om.inverted()
-
-                if tOptions.scale != 1.0:
-                    poseMatrix.translation *= tOptions.scale
-
-                # Extract position and rotation relative to parent in parent space        
-                t = poseMatrix.to_translation()
-                q = poseMatrix.to_quaternion()
-                s = poseMatrix.to_scale()
-                
-                # Convert position, rotation and scale to left hand:
-                if isArmature:
-                    # Bone animation
-                    tl = Vector((t.x, t.y, -t.z))
-                    ql = Quaternion((q.w, -q.x, -q.y, q.z))
-                    sl = Vector((s.x, s.y, s.z))
-                else:
-                    # Object animation
-                    tl = Vector((t.x, t.z, t.y))
-                    ql = Quaternion((q.w, -q.x, -q.z, -q.y))
-                    sl = Vector((s.x, s.z, s.y))
-                
-                if not tOptions.doAnimationPos:
-                    tl = None
-                if not tOptions.doAnimationRot:
-                    ql = None
-                if not tOptions.doAnimationSca:
-                    sl = None
-
-                tFrame = TFrame((frameTime - startframe) / scene.render.fps, tl, ql, sl)
-
-                # Append the frame to the track only if it is the first, the last or if something moved
-                if not tTrack.frames or isLastFrame or tTrack.frames[-1].hasMoved(tFrame):
-                    tTrack.frames.append(tFrame)
+        times = (np.array(frameTimes, dtype=np.float64) - startframe) / scene.render.fps
+        timesList = times.tolist()
+
+        # Keyframes reduction counters
+        keyframesBefore = 0
+        keyframesAfter = 0
+
+        for boneIndex, boneName in enumerate(bones):
+            if not len(times):
+                break
+
+            tTrack = TTrack(boneName)
+
+            bonePositions = None if positions is None else positions[:, boneIndex]
+            boneRotations = None if rotations is None else rotations[:, boneIndex]
+            boneScales = None if scales is None else scales[:, boneIndex]
+
+            if tOptions.doReduceKeyframes:
+                # Remove the keyframes that can be interpolated
+                kept = ReduceKeyframes(times, bonePositions, boneRotations, boneScales, 
+                            tOptions.reducePositionTolerance, math.radians(tOptions.reduceRotationTolerance),
+                            tOptions.reduceScaleTolerance)
+                keyframesBefore += len(times)
+                keyframesAfter += len(kept)
+            else:
+                # Keep the frame only if it is the first, the last or if something moved
+                moved = np.zeros(len(times), dtype=bool)
+                moved[0] = moved[-1] = True
+                for values in (bonePositions, boneRotations, boneScales):
+                    if values is not None:
+                        values = values.astype(np.float32)
+                        moved[1:] |= (values[1:] != values[:-1]).any(axis=1)
+                kept = np.flatnonzero(moved)
+
+            for i in kept.tolist():
+                tl = None if bonePositions is None else Vector(bonePositions[i].tolist())
+                ql = None if boneRotations is None else Quaternion(boneRotations[i].tolist())
+                sl = None if boneScales is None else Vector(boneScales[i].tolist())
+                tTrack.frames.append(TFrame(timesList[i], tl, ql, sl))
                 
             if tTrack.frames and (not tOptions.filterSingleKeyFrames or len(tTrack.frames) > 1):
                 tAnimation.tracks.append(tTrack)
 
+        if tOptions.doReduceKeyframes:
+            log.info("Reduced keyframes of {:s}: {:d} -> {:d}".format(object.name, keyframesBefore, keyframesAfter))
+
         # Use timeline marker as Urho triggers
         if tOptions.doTriggers:
             log.info("Decomposing markers for {:s}".format(object.name))
@@ -1699,6 +2370,9 @@ def DecomposeActions(scene, armatureObj, tData, tOptions):
                 tTrigger.data = name
                 tAnimation.triggers.append(tTrigger)
 
+        if cacheKey:
+            SaveCachedAnimation(tOptions.diskCache, cacheKey, tAnimation)
+
         if tAnimation.tracks and not commonAnimation:
             animationsList.append(tAnimation)
             # The first animation becomes the common animation
@@ -1719,11 +2393,288 @@ def DecomposeActions(scene, armatureObj, tData, tOptions):
     scene.frame_set(savedFrame)
 
 
+#---------------------------------
+# Bulk mesh attributes
+#---------------------------------
+
+# Attributes of the loop triangles corners of a mesh. Per corner arrays have one row
+# for each corner (3 * trianglesCount), corners of the triangle 't' are the rows
+# 3*t, 3*t+1, 3*t+2. Positions and normals are already transformed and converted
+# to Urho axes (x, z, y).
+class TMeshArrays:
+    def __init__(self):
+        # Number of loop triangles
+        self.trianglesCount = 0
+        # Blender vertex index of each corner: int32 (corners)
+        self.vertexIndices = None
+        # Blender loop index of each corner: int32 (corners)
+        self.loopIndices = None
+        # Material index of each triangle: int32 (triangles)
+        self.materialIndices = None
+        # True for triangles with 3 unique vertices: bool (triangles)
+        self.validTriangles = None
+        # Position of each corner: float (corners, 3)
+        self.positions = None
+        # Normal of each corner (split, vertex or face normal): float (corners, 3)
+        self.normals = None
+        # UV of each corner (u, 1-v), None if missing: float (corners, 2)
+        self.uvs = None
+        # UV2 of each corner (u, 1-v), None if missing: float (corners, 2)
+        self.uvs2 = None
+        # RGBA color of each corner, None if missing: uint8 (corners, 4)
+        self.colors = None
+
+# Shape keys: minimum change of position or normal of a morphed vertex
+MORPH_EPSILON = 1e-6
+
+# Apply a 4x4 mathutils matrix to an array of 3D points (as mathutils does with
+# 'matrix @ Vector((x, y, z))', the point is extended with w=1)
+def TransformPoints(matrix, points):
+    m = np.array(matrix, dtype=np.float64)
+    return points @ m[:3, :3].T + m[:3, 3]
+
+# Read with foreach_get all the attributes we need from the loop triangles of 'mesh'
+# and transform them with one batched operation. 'uvs', 'uvs2' and 'colors' are the
+# data of the UV layers and of the color layer (can be None).
+def ReadMeshArrays(mesh, posMatrix, normalMatrix, uvs, uvs2, colors):
+
+    mArrays = TMeshArrays()
+
+    triangles = mesh.loop_triangles
+    trianglesCount = len(triangles)
+    cornersCount = 3 * trianglesCount
+    mArrays.trianglesCount = trianglesCount
+
+    vertexIndices = np.empty(cornersCount, dtype=np.int32)
+    triangles.foreach_get("vertices", vertexIndices)
+    mArrays.vertexIndices = vertexIndices
+
+    loopIndices = np.empty(cornersCount, dtype=np.int32)
+    triangles.foreach_get("loops", loopIndices)
+    mArrays.loopIndices = loopIndices
+
+    materialIndices = np.empty(trianglesCount, dtype=np.int32)
+    triangles.foreach_get("material_index", materialIndices)
+    mArrays.materialIndices = materialIndices
+
+    # Skip faces with less than 3 unique vertices
+    tv = vertexIndices.reshape(-1, 3)
+    mArrays.validTriangles = (tv[:, 0] != tv[:, 1]) & (tv[:, 1] != tv[:, 2]) & (tv[:, 0] != tv[:, 2])
+
+    verticesCount = len(mesh.vertices)
+    coords = np.empty(verticesCount * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", coords)
+    coords = coords.reshape(-1, 3).astype(np.float64)
+
+    if mesh.use_auto_smooth:
+        # if using Data->Normals->Auto Smooth, use split normal vector
+        normals = np.empty(cornersCount * 3, dtype=np.float32)
+        triangles.foreach_get("split_normals", normals)
+        normals = normals.reshape(-1, 3)
+    else:
+        # if face is smooth, use vertex normal, otherwise use face normal
+        vertexNormals = np.empty(verticesCount * 3, dtype=np.float32)
+        mesh.vertices.foreach_get("normal", vertexNormals)
+        faceNormals = np.empty(trianglesCount * 3, dtype=np.float32)
+        triangles.foreach_get("normal", faceNormals)
+        smooth = np.empty(trianglesCount, dtype=bool)
+        triangles.foreach_get("use_smooth", smooth)
+        normals = np.where(np.repeat(smooth, 3)[:, np.newaxis],
+                           vertexNormals.reshape(-1, 3)[vertexIndices],
+                           np.repeat(faceNormals.reshape(-1, 3), 3, axis=0))
+    normals = normals.astype(np.float64)
+
+    # Transform and convert to Urho axes all the corners at once
+    mArrays.positions = TransformPoints(posMatrix, coords[vertexIndices])[:, (0, 2, 1)]
+    mArrays.normals = TransformPoints(normalMatrix, normals)[:, (0, 2, 1)]
+
+    loopsCount = len(mesh.loops)
+
+    def ReadUvs(data):
+        if not data:
+            return None
+        uv = np.empty(loopsCount * 2, dtype=np.float32)
+        data.foreach_get("uv", uv)
+        uv = uv.reshape(-1, 2)[loopIndices].astype(np.float64)
+        uv[:, 1] = 1.0 - uv[:, 1]
+        return uv
+
+    mArrays.uvs = ReadUvs(uvs)
+    mArrays.uvs2 = ReadUvs(uvs2)
+
+    if colors:
+        rgba = np.empty(loopsCount * 4, dtype=np.float32)
+        colors.foreach_get("color", rgba)
+        rgba = rgba.reshape(-1, 4)[loopIndices]
+        # Approx 255*float to the closest int, alpha is always 255
+        color = np.full((cornersCount, 4), 255, dtype=np.uint8)
+        color[:, :3] = np.clip(np.round(rgba[:, :3] * 255.0), 0, 255)
+        mArrays.colors = color
+
+    return mArrays
+
+# Read the MikkTSpace tangents that Blender calculates for the UV map 'uvMapName' of 
+# 'mesh' (mesh.calc_tangents), for the loops 'loopIndices'. Tangents are transformed 
+# with 'posMatrix', converted to Urho axes and orthogonalized with the corners 'normals'
+# (already transformed). Returns an array (corners, 4) with the bitangent sign as 4th
+# component, or None if Blender cannot calculate them (ex. n-gons).
+def ReadMeshTangents(mesh, posMatrix, uvMapName, loopIndices, normals):
+    try:
+        mesh.calc_tangents(uvmap=uvMapName)
+    except RuntimeError as e:
+        log.warning("Cannot calculate MikkTSpace tangents of mesh {:s}: {!s}".format(mesh.name, e))
+        return None
+
+    loopsCount = len(mesh.loops)
+    tangents = np.empty(loopsCount * 3, dtype=np.float32)
+    mesh.loops.foreach_get("tangent", tangents)
+    signs = np.empty(loopsCount, dtype=np.float32)
+    mesh.loops.foreach_get("bitangent_sign", signs)
+    mesh.free_tangents()
+
+    # Tangents are directions, use only the rotation and scale of the matrix
+    m = np.array(posMatrix, dtype=np.float64)[:3, :3]
+    tangents = (tangents.reshape(-1, 3)[loopIndices].astype(np.float64) @ m.T)[:, (0, 2, 1)]
+    tangents = NormalizeRows(tangents - normals * np.einsum('ij,ij->i', normals, tangents)[:, None])
+    # Changing axes and flipping V cancel out on the bitangent direction, a mirroring
+    # matrix doesn't
+    signs = signs[loopIndices].astype(np.float64)
+    if np.linalg.det(m) < 0.0:
+        signs = -signs
+    return np.hstack((tangents, signs[:, None]))
+
+# Calculate the normals of the vertices 'coords' (vertices, 3) for the loop triangles
+# 'vertexIndices' (corners), like Blender does: vertex normals are the average of the
+# normals of the triangles weighted by the angle of the corner.
+# Returns the unit vertex normals (vertices, 3) and triangle normals (triangles, 3).
+def CalculateNormals(coords, vertexIndices):
+    tv = vertexIndices.reshape(-1, 3)
+    points = coords[tv]
+    faceNormals = NormalizeRows(np.cross(points[:, 1] - points[:, 0], points[:, 2] - points[:, 0]))
+    # Angle of each corner of the triangles
+    edges1 = NormalizeRows((points[:, (1, 2, 0)] - points).reshape(-1, 3))
+    edges2 = NormalizeRows((points[:, (2, 0, 1)] - points).reshape(-1, 3))
+    angles = np.arccos(np.clip(np.einsum('ij,ij->i', edges1, edges2), -1.0, 1.0))
+    vertexNormals = np.zeros_like(coords)
+    np.add.at(vertexNormals, vertexIndices, np.repeat(faceNormals, 3, axis=0) * angles[:, None])
+    return NormalizeRows(vertexNormals), faceNormals
+
+# Find the unique rows of the per corner attributes in 'columns' (list of arrays with
+# 'count' rows). All the columns are packed in fixed width integer rows and
+# deduplicated in one pass. If 'tolerance' is not zero, float values are quantized
+# to multiples of 'tolerance' before comparing them.
+# Returns the array of the first corner of each unique vertex and the array that
+# maps each corner to its unique vertex, unique vertices are numbered in order of
+# first use.
+def WeldCorners(columns, count, tolerance=0.0):
+
+    keys = []
+    for column in columns:
+        column = column.reshape(count, -1)
+        if column.dtype.kind == 'f':
+            if tolerance > 0.0:
+                keys.append(np.round(column / tolerance).astype(np.int64))
+            else:
+                # Compare float bits (+0.0 turns -0.0 into 0.0)
+                keys.append((column.astype(np.float64) + 0.0).view(np.int64))
+        else:
+            keys.append(column.astype(np.int64))
+    if not keys:
+        # No attributes, all the corners are the same vertex
+        keys.append(np.zeros((count, 1), dtype=np.int64))
+    keys = np.ascontiguousarray(np.hstack(keys))
+
+    # View each row as a single opaque value, so we can sort rows
+    rows = keys.view(np.dtype((np.void, keys.dtype.itemsize * keys.shape[1]))).ravel()
+    _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+
+    # np.unique numbers the rows in sorted order, renumber them in order of first use
+    order = np.argsort(first, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+
+    return first[order], rank[inverse.ravel()]
+
+# Select the rows 'rows' of a CSR array with 'offsets', returns the new offsets and the
+# indices of the selected items
+def CsrGather(offsets, rows):
+    counts = (offsets[1:] - offsets[:-1])[rows]
+    newOffsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=newOffsets[1:])
+    # Start of each row in the old array, repeated for each item, plus the item position in its row
+    items = np.repeat(offsets[:-1][rows] - newOffsets[:-1], counts) + np.arange(newOffsets[-1])
+    return newOffsets, items
+
+# Add the item (bone, weight) at the end of the rows of the CSR arrays selected by 'rowsMask'
+def CsrAppend(offsets, bones, weights, rowsMask, bone, weight):
+    counts = offsets[1:] - offsets[:-1]
+    newOffsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts + rowsMask, out=newOffsets[1:])
+    newBones = np.empty(newOffsets[-1], dtype=bones.dtype)
+    newWeights = np.empty(newOffsets[-1], dtype=weights.dtype)
+    # Old items are shifted by the number of items added in the previous rows
+    shift = np.repeat(newOffsets[:-1] - offsets[:-1], counts)
+    newBones[np.arange(len(bones)) + shift] = bones
+    newWeights[np.arange(len(weights)) + shift] = weights
+    lastItems = newOffsets[1:][rowsMask] - 1
+    newBones[lastItems] = bone
+    newWeights[lastItems] = weight
+    return newOffsets, newBones, newWeights
+
+# Read the vertex groups of the Blender vertices 'vertexIndices', each vertex is read
+# only once. Returns them in CSR format (offsets, vertex group indices, weights).
+def ReadVertexGroups(mesh, vertexIndices):
+    meshVertices = mesh.vertices
+    counts = np.zeros(len(vertexIndices), dtype=np.int64)
+    groupsList = []
+    weightsList = []
+    for i, vertexIndex in enumerate(vertexIndices.tolist()):
+        # Type: VertexGroupElement(bpy_struct)
+        groups = meshVertices[vertexIndex].groups
+        counts[i] = len(groups)
+        for g in groups:
+            groupsList.append(g.group)
+            weightsList.append(g.weight)
+    groups = np.array(groupsList, dtype=np.int64)
+    weights = np.array(weightsList, dtype=np.float32)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets, groups, weights
+
+# Get the bones weights from the vertex groups 'vertexGroups' (CSR format, see
+# ReadVertexGroups). 'groupBones' maps a vertex group index to a bone index (-1 if
+# the group is not a bone). Groups which are not bones are skipped, a zero weight is
+# kept only if it is the first of its vertex.
+# Returns the weights in CSR format (offsets, bone indices, weights) and the array of
+# the vertex group indices found.
+def VertexGroupsWeights(vertexGroups, groupBones):
+    offsets, groups, weights = vertexGroups
+    counts = offsets[1:] - offsets[:-1]
+
+    # Groups out of range are missing
+    bones = np.full(len(groups), -1, dtype=np.int32)
+    inRange = groups < len(groupBones)
+    bones[inRange] = groupBones[groups[inRange]]
+    isBone = bones >= 0
+
+    # Is the bone the first of its vertex
+    rowStarts = np.repeat(offsets[:-1], counts)
+    bonesBefore = np.cumsum(isBone) - isBone
+    isFirst = (bonesBefore - bonesBefore[rowStarts]) == 0
+    keep = isBone & ((weights > 0.0) | isFirst)
+
+    rowIds = np.repeat(np.arange(len(counts)), counts)
+    newOffsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rowIds[keep], minlength=len(counts)), out=newOffsets[1:])
+    return newOffsets, bones[keep], weights[keep], np.unique(groups)
+
+
 #---------------------------------
 # Decompose geometries and morphs
 #---------------------------------
 
-def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMaterial):
+# The temporary meshes are owned by 'tempDatablocks'
+def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMaterial, tempDatablocks):
 
     verticesList = tData.verticesList
     geometriesList = tData.geometriesList
@@ -1740,7 +2691,6 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
     bpy.context.view_layer.objects.active = meshObj
     bpy.ops.object.mode_set(mode="OBJECT")
 
-    verticesMap = {}
     
     print("decompose mesh:%s" %meshObj.name)
 
@@ -1765,21 +2715,40 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
     # TODO2.8: not 100% sure about calc_undeformed- formerly you specified PREVIEW or RENDER
 #    mesh = meshObj.to_mesh(dgraph, (tOptions.applyModifiers and not onlyProcessMaterial) or meshObj.lodsetID==-2, calc_undeformed=False)
 
-    if tOptions.applyModifiers or "_LOD" in meshObj.name:
+    applyModifiers = tOptions.applyModifiers or "_LOD" in meshObj.name
+
+    # Arrays of the evaluated mesh saved by a previous export, if the object and its
+    # inputs are not changed (morphs need the evaluated mesh)
+    evaluatedMesh = None
+    evaluatedKey = None
+    if applyModifiers and tOptions.useEvaluatedCache and not (keyBlocks and meshObj.data.urho_export.export_morph):
+        evaluatedKey = EvaluatedMeshKey(meshObj, tOptions)
+        evaluatedMesh = GetEvaluatedMesh(meshObj, evaluatedKey, tOptions.doGeometryWei)
+
+    if evaluatedMesh:
+        # the evaluated mesh is not needed, its export settings and material trees
+        # are the ones of the mesh data
+        mesh = meshObj.data
+        verticesCount = evaluatedMesh.verticesCount
+        log.info("Using the cached evaluated mesh of {:s}".format(meshObj.name))
+    elif applyModifiers:
         # apply modifiers
-        mesh = meshObj.evaluated_get(dgraph).to_mesh()
+        mesh = tempDatablocks.toMesh(meshObj, dgraph)
         print("MeshObj-Type:%s" % type(meshObj))
         meshObj.data.urho_export.copyInto(mesh.urho_export)
         #mesh = meshObj.to_mesh(preserve_all_data_layers=True,depsgraph=dgraph)
+        verticesCount = len(mesh.vertices)
     else:
         # do not apply modifiers just use the current meshdata
         mesh = meshObj.data
+        verticesCount = len(mesh.vertices)
 
-    log.info("Decomposing mesh: {:s} ({:d} vertices)".format(meshObj.name, len(mesh.vertices)) )
+    log.info("Decomposing mesh: {:s} ({:d} vertices)".format(meshObj.name, verticesCount) )
 
-    # Compute local space unit length split normals vectors
-    mesh.calc_normals_split()
-    mesh.calc_loop_triangles()
+    if not evaluatedMesh:
+        # Compute local space unit length split normals vectors
+        mesh.calc_normals_split()
+        mesh.calc_loop_triangles()
 
     # If we use the object local origin (orange dot) we don't need transformations
     posMatrix = Matrix.Identity(4)
@@ -1799,9 +2768,6 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
     if tOptions.scale != 1.0:
         posMatrix = Matrix.Scale(tOptions.scale, 4) @ posMatrix 
 
-    # Vertices map: vertex Blender index to TVertex index
-    faceVertexMap = {}
-
     # Here we store geometriesList indices of geometries with new vertices in its last LOD
     # We use this to create a new LOD only once per geometry and to filter where we have
     # to optimize and recalculate tangents
@@ -1903,70 +2869,188 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
     #     if not mesh.materials:
     #         log.warning("Object {:s} has no materials data".format(meshObj.name))
 
-    # Progress counter
-    progressCur = 0
-    progressTot = 0.01 * len(mesh.loop_triangles)
-
-    for face in mesh.loop_triangles:
-        if (progressCur % 10) == 0:
-            print("{:.3f}%\r".format(progressCur / progressTot), end='' )
-        progressCur += 1
-
-        # Skip if this face has less than 3 unique vertices
-        # (a frozenset is an immutable set of unique elements)
-        if len(frozenset(face.vertices)) < 3: 
-            #blender2.8: not sure how to do this "hiding" in 2.8. But isn't just to continue enough?
-            #face.hide = True
-            continue
-
-        #if face.hide:
-        #   continue
-
-        faceLoops = face.loops
-
-        ## TODO Multimaterial-Export:
-        ## use this:
-        materialIndex = face.material_index
-
-        # Get face vertices UV, type: MeshTextureFace(bpy_struct)
-        #faceUv = uvs and uvs[face.index]
-        #faceUv2 = uvs2 and uvs2[face.index]
-
-        # Get face 4 vertices colors
-        #fcol = colorsRgb and colorsRgb[face.index]
-        #faceRgbColor = fcol and (fcol.color1, fcol.color2, fcol.color3, fcol.color4)
-        #fcol = colorsAlpha and colorsAlpha[face.index]
-        #faceAlphaColor = fcol and (fcol.color1, fcol.color2, fcol.color3, fcol.color4)
-
-        # Get the face material
-        # If no material is associated then face.material_index is 0 but mesh.materials
-        # is not None
-        #material = None
-        #if mesh.materials and len(mesh.materials):
-        #    material = mesh.materials[face.material_index]
-        
-        # Add the material if it is new
-        #materialName = material and material.name
+    # Read the attributes of all the corners in bulk, already transformed
+    if evaluatedMesh:
+        meshArrays = evaluatedMesh.meshArrays
+    else:
+        meshArrays = ReadMeshArrays(mesh, posMatrix, normalMatrix, uvs, uvs2, colorsRgb)
+    cornerVertexIndices = meshArrays.vertexIndices
+    cornerPositions = meshArrays.positions
+    cornerNormals = meshArrays.normals
+    cornerUvs = meshArrays.uvs
+    cornerUvs2 = meshArrays.uvs2
+    cornerColors = meshArrays.colors
+
+    # Get the tangents from Blender if requested, if they cannot be calculated fall
+    # back to GenerateTangents
+    cornerTangents = None
+    if evaluatedMesh:
+        cornerTangents = evaluatedMesh.tangents
+    elif mesh.urho_export.export_tan and mesh.urho_export.tangent_method == 'MIKKTSPACE':
+        uvMapName = ""
+        if uv1_idx != -1:
+            uvMapName = mesh.uv_layers[uv1_idx].name
+        cornerTangents = ReadMeshTangents(mesh, posMatrix, uvMapName, meshArrays.loopIndices, cornerNormals)
+
+    # Vertex groups of all the vertices, if saved in the cache
+    allVertexGroups = None
+    if evaluatedMesh:
+        allVertexGroups = evaluatedMesh.vertexGroups
+
+    # Save the evaluated mesh arrays for the next exports
+    if evaluatedKey and not evaluatedMesh:
+        newEvaluatedMesh = TEvaluatedMesh()
+        newEvaluatedMesh.key = evaluatedKey
+        newEvaluatedMesh.dataPointer = meshObj.data.as_pointer()
+        newEvaluatedMesh.verticesCount = verticesCount
+        newEvaluatedMesh.meshArrays = meshArrays
+        newEvaluatedMesh.tangents = cornerTangents
+        if tOptions.doGeometryWei:
+            if meshVertexGroups:
+                allVertexGroups = ReadVertexGroups(mesh, np.arange(verticesCount))
+            else:
+                allVertexGroups = (np.zeros(verticesCount + 1, dtype=np.int64),
+                                   np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+            newEvaluatedMesh.vertexGroups = allVertexGroups
+        evaluatedMeshes[EvaluatedMeshSlot(meshObj)] = newEvaluatedMesh
+
+    # Weld the corners of the valid triangles into unique vertices, 'cornerVertexMap'
+    # maps each corner to its TVertex index (-1 for corners of skipped triangles)
+    validCorners = np.flatnonzero(np.repeat(meshArrays.validTriangles, 3))
+    weldColumns = []
+    if mesh.urho_export.export_pos:
+        weldColumns.append(cornerPositions[validCorners])
+    if mesh.urho_export.export_norm:
+        weldColumns.append(cornerNormals[validCorners])
+    if mesh.urho_export.export_uv and cornerUvs is not None:
+        weldColumns.append(cornerUvs[validCorners])
+    if mesh.urho_export.export_uv and cornerUvs2 is not None:
+        weldColumns.append(cornerUvs2[validCorners])
+    if mesh.urho_export.export_vcol and cornerColors is not None:
+        weldColumns.append(cornerColors[validCorners])
+    if cornerTangents is not None:
+        weldColumns.append(cornerTangents[validCorners])
+    uniqueCorners, weldRemap = WeldCorners(weldColumns, len(validCorners), tOptions.weldTolerance)
+    cornerVertexMap = np.full(3 * meshArrays.trianglesCount, -1, dtype=np.int64)
+    cornerVertexMap[validCorners] = weldRemap + len(verticesList)
+
+    # Add the unique vertices to the vertices list, in order of first use
+    vertexCorners = validCorners[uniqueCorners]
+    vertexCount = len(vertexCorners)
+    # Set Blender index
+    blenderIndices = np.empty((vertexCount, 2), dtype=np.int32)
+    blenderIndices[:, 0] = meshIndex
+    blenderIndices[:, 1] = cornerVertexIndices[vertexCorners]
+    # Set Vertex position
+    positionArray = None
+    if mesh.urho_export.export_pos:
+        positionArray = cornerPositions[vertexCorners]
+    # Set Vertex normal
+    normalArray = None
+    if mesh.urho_export.export_norm:
+        normalArray = cornerNormals[vertexCorners]
+    # Set Vertex UV coordinates
+    uvArray = None
+    if mesh.urho_export.export_uv and cornerUvs is not None:
+        uvArray = cornerUvs[vertexCorners]
+    elif tOptions.doForceElements:
+        uvArray = np.zeros((vertexCount, 2), dtype=np.float32)
+    #blender2.8: todo uv2 (untested).
+    uv2Array = None
+    if mesh.urho_export.export_uv and cornerUvs2 is not None:
+        uv2Array = cornerUvs2[vertexCorners]
+    # Set vertex color 2.8
+    colorArray = None
+    if mesh.urho_export.export_vcol:
+        if cornerColors is not None:
+            colorArray = cornerColors[vertexCorners]
+        else:
+            colorArray = np.tile(np.array((0, 0, 0, 255), dtype=np.uint8), (vertexCount, 1))
+    # Set Vertex tangent (only MikkTSpace)
+    tangentArray = None
+    if cornerTangents is not None:
+        tangentArray = cornerTangents[vertexCorners]
+
+    # Set Vertex bones weights
+    vertexWeights = None
+    if tOptions.doGeometryWei:
+        # Map each vertex group to its bone index, the group name should be the bone
+        # name, but it can also be an user made vertex group
+        groupBones = np.full(len(meshVertexGroups), -1, dtype=np.int32)
+        for group in meshVertexGroups:
+            if group.name in bonesMap:
+                groupBones[group.index] = bonesMap[group.name].index
+        # Read the weights of each Blender vertex once
+        usedVertices, vertexRows = np.unique(blenderIndices[:, 1], return_inverse=True)
+        if allVertexGroups is not None:
+            groupOffsets, items = CsrGather(allVertexGroups[0], usedVertices)
+            vertexGroups = (groupOffsets, allVertexGroups[1][items], allVertexGroups[2][items])
+        else:
+            vertexGroups = ReadVertexGroups(mesh, usedVertices)
+        offsets, bones, weights, usedGroups = VertexGroupsWeights(vertexGroups, groupBones)
+        for group in usedGroups.tolist():
+            if group >= len(meshVertexGroups):
+                missingGroups.add(str(group))
+            elif groupBones[group] < 0:
+                notBonesGroups.add(meshVertexGroups[group].name)
+        # Weights of each new vertex
+        offsets, items = CsrGather(offsets, vertexRows.ravel())
+        bones = bones[items]
+        weights = weights[items]
+        # If the mesh has a bone for parent use it for a 100% weight skinning
+        if tOptions.skinBoneParent and meshObj.parent_type == 'BONE' and meshObj.parent_bone:
+            boneName = meshObj.parent_bone
+            # We shouldn't have any skinning on the vertices
+            if len(bones):
+                overrideBones.add(boneName)
+            try:
+                boneIndex = bonesMap[boneName].index
+                offsets, bones, weights = CsrAppend(offsets, bones, weights,
+                        np.ones(vertexCount, dtype=bool), boneIndex, 1.0)
+            except KeyError:
+                missingBones.add(boneName)
+        # If we found no bone weight (not even one with weight zero) leave the vertex without weights
+        noWeights = offsets[1:] == offsets[:-1]
+        hasWeight[1] += vertexCount
+        hasWeight[0] += vertexCount - np.count_nonzero(noWeights)
+        if tOptions.doForceElements:
+            offsets, bones, weights = CsrAppend(offsets, bones, weights, noWeights, 0, 0.0)
+        vertexWeights = (offsets, bones, weights)
+
+    verticesList.appendArrays(vertexCount, blenderIndices, vertexWeights,
+            pos=positionArray, normal=normalArray, uv=uvArray, uv2=uv2Array, color=colorArray,
+            tangent=tangentArray)
+
+    ## TODO Multimaterial-Export:
+    ## TODO: What strategie to use for multimaterial-meshes
+    ## Now: if for materialIndex no corresponding materialNode exists take the first material-node. that would be also find for baked-materials
+    nodetreesCount = 0
+    if hasattr(mesh, "materialNodetrees"):
+        nodetreesCount = len(mesh.materialNodetrees)
+
+    # Material slot of each triangle with 3 unique vertices
+    validTriangles = np.flatnonzero(meshArrays.validTriangles)
+    triangleSlots = meshArrays.materialIndices[validTriangles].astype(np.int64)
+    triangleSlots[triangleSlots >= nodetreesCount] = 0
+
+    # Used slots in order of first use, so geometries are created in the order of the triangles
+    usedSlots, firstUse = np.unique(triangleSlots, return_index=True)
+    usedSlots = usedSlots[np.argsort(firstUse)]
+
+    # Resolve each used slot to its geometry index
+    slotGeometries = np.zeros(max(nodetreesCount, 1), dtype=np.int64)
+    for slot in usedSlots.tolist():
         materialName = "default_materialtree"
-        #print("CHECK: %s %s idx:%s" % (hasattr(mesh,"materialNodetrees"), len(mesh.materialNodetrees),materialIndex))
-
-        if hasattr(mesh,"materialNodetrees") and len(mesh.materialNodetrees)>0:
-            ## TODO: What strategie to use for multimaterial-meshes
-            ## Now: if for materialIndex no corresponding materialNode exists take the first material-node. that would be also find for baked-materials
-            if materialIndex >= len(mesh.materialNodetrees):
-                materialIndex = 0
-
-            ntSlot = mesh.materialNodetrees[materialIndex]
+        if nodetreesCount > 0:
+            ntSlot = mesh.materialNodetrees[slot]
             if ntSlot.nodetreePointer:
                 materialName = ntSlot.nodetreePointer.name
-                print("USING %s" % materialName)
-            #materialName = mesh.materialNodetree.name
-        
+                log.info("Using material {:s}".format(materialName))
+
         # blender2.8: just set the material-tree-name in the dictionary so we know what material-tree to export
         if tOptions.doMaterials and materialName and (not materialName in materialsList):
             materialsList.append(materialName)
-        
-        
+
         #if tOptions.doMaterials and materialName and (not materialName in materialsList):
         #    tMaterial = TMaterial(materialName)
         #    materialsList.append(tMaterial)
@@ -2031,7 +3115,7 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
         # Get the geometry associated to the material
         geometry = geometriesList[geometryIndex]
         
-        # Get the last LOD level, or add a new one if requested in the options
+        # Add a new LOD level if requested in the options, the triangles go in the last LOD
         lodLevelIndex = len(geometry.lodLevels)
         if not geometry.lodLevels or geometryIndex not in tOptions.lodUpdatedGeometryIndices:
             tLodLevel = TLodLevel()
@@ -2039,185 +3123,29 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
             geometry.lodLevels.append(tLodLevel)
             tOptions.lodUpdatedGeometryIndices.add(geometryIndex)
             log.info("New LOD{:d} created for material {!s}".format(lodLevelIndex, materialName))
-        else:
-            tLodLevel = geometry.lodLevels[-1]
 
         # Add the index of the geometry we are going to update
         updatedGeometryIndices.add(geometryIndex)
+        slotGeometries[slot] = geometryIndex
+
+    # Split the triangles by geometry with a stable sort, so each geometry keeps the 
+    # triangles order
+    triangleGeometries = slotGeometries[triangleSlots]
+    order = np.argsort(triangleGeometries, kind='stable')
+    triangleGeometries = triangleGeometries[order]
+    # TVertex indices of the triangles, swap the last two to change the winding
+    triangles = cornerVertexMap.reshape(-1, 3)[validTriangles[order]][:, (0, 2, 1)]
+
+    # Add the triangles of each geometry to its last LOD
+    geometryIndices, starts = np.unique(triangleGeometries, return_index=True)
+    ends = np.append(starts[1:], len(triangles))
+    for geometryIndex, start, end in zip(geometryIndices.tolist(), starts.tolist(), ends.tolist()):
+        tLodLevel = geometriesList[geometryIndex].lodLevels[-1]
+        lodTriangles = triangles[start:end]
+        # Save every unique vertex this LOD is using
+        tLodLevel.indexSet.update(np.unique(lodTriangles).tolist())
+        tLodLevel.triangleList.extend(map(tuple, lodTriangles.tolist()))
 
-        indexSet = tLodLevel.indexSet
-        triangleList = tLodLevel.triangleList
-            
-        # Here we store all the indices of the face, then we decompose it into triangles
-        tempList = []
-
-        for i, vertexIndex in enumerate(face.vertices):
-            # i: vertex index in the face (0..2 tris, 0..3 quad)
-            # vertexIndex: vertex index in Blender buffer
-
-            # Blender vertex
-            vertex = mesh.vertices[vertexIndex]
-
-            position = posMatrix @ vertex.co
-
-            if mesh.use_auto_smooth:
-                # if using Data->Normals->Auto Smooth, use split normal vector
-                normal = Vector(face.split_normals[i])
-            elif face.use_smooth:
-                # if face is smooth, use vertex normal
-                normal = vertex.normal
-            else:
-                # use face normal
-                normal = face.normal
-            normal = normalMatrix @ normal
-            
-            # Create a new vertex
-            tVertex = TVertex()
-            
-            # Set Blender index
-            tVertex.blenderIndex = (meshIndex, vertexIndex)
-
-            # Set Vertex position
-            if mesh.urho_export.export_pos:
-                tVertex.pos = Vector((position.x, position.z, position.y))
-
-            # Set Vertex normal
-            if mesh.urho_export.export_norm:
-                tVertex.normal = Vector((normal.x, normal.z, normal.y))
-                
-            # Set Vertex UV coordinates
-            if mesh.urho_export.export_uv and uvs:
-                if uvs:
-                    idx = faceLoops[i]
-                    uvResult = uvs[idx]
-                    uv = uvResult.uv
-                    tVertex.uv = Vector((uv[0], 1.0 - uv[1]))
-            elif tOptions.doForceElements:
-                tVertex.uv = Vector((0.0, 0.0))
-
-            #blender2.8: todo uv2 (untested).
-            if mesh.urho_export.export_uv and uvs2:
-                if uvs2:
-                    uv2 = uvs2[faceLoops[i]]
-                    tVertex.uv2 = Vector((uv2[0], 1.0 - uv2[1]))
-                elif tOptions.doForceElements:
-                    tVertex.uv2 = Vector((0.0, 0.0))
-
-            # Set Vertex color
-            # if tOptions.doGeometryCol or tOptions.doGeometryColAlpha:
-            #     color = [0, 0, 0, 255]
-            #     if faceRgbColor or faceAlphaColor:
-            #         if faceRgbColor:
-            #             # This is an array of 3 floats from 0.0 to 1.0
-            #             rgb = faceRgbColor[i]
-            #             # Approx 255*float to the closest int
-            #             color[:3] = ( int(round(rgb.r * 255.0)), 
-            #                           int(round(rgb.g * 255.0)), 
-            #                           int(round(rgb.b * 255.0)) )
-            #         if faceAlphaColor:
-            #             # For Alpha use Value of HSV
-            #             alpha = faceAlphaColor[i]
-            #             color[3] = int(round(alpha.v * 255.0))
-            #         tVertex.color = tuple(color)
-            #     elif tOptions.doForceElements:
-            #         tVertex.color = tuple(color)
-
-            # Set vertex color 2.8
-            if mesh.urho_export.export_vcol:
-                color = [0,0,0,255]
-                if colorsRgb:
-                    rgb = colorsRgb[faceLoops[i]]
-                    # Approx 255*float to the closest int
-                    color[:3] = ( int(round(rgb.color[0] * 255.0)), 
-                                    int(round(rgb.color[1] * 255.0)), 
-                                    int(round(rgb.color[2] * 255.0)) )                    
-                tVertex.color =tuple(color)
-                
-                    
-            # Set Vertex bones weights
-            if tOptions.doGeometryWei:
-                weights = []
-                # Scan all the vertex groups associated to the vertex, type: VertexGroupElement(bpy_struct)
-                for g in vertex.groups:
-                    # The group name should be the bone name, but it can also be an user made vertex group
-                    try:
-                        boneName = meshVertexGroups[g.group].name
-                        try:
-                            boneIndex = bonesMap[boneName].index
-                            if g.weight > 0.0 or not weights:
-                                weights.append( (boneIndex, g.weight) )
-                        except KeyError:
-                            notBonesGroups.add(boneName)
-                    except IndexError:
-                        missingGroups.add(str(g.group))
-                # If the mesh has a bone for parent use it for a 100% weight skinning
-                if tOptions.skinBoneParent and meshObj.parent_type == 'BONE' and meshObj.parent_bone:
-                    boneName = meshObj.parent_bone
-                    # We shouldn't have any skinning on the vertex
-                    if weights:
-                        overrideBones.add(boneName)
-                    try:
-                        boneIndex = bonesMap[boneName].index
-                        weights.append( (boneIndex, 1.0) )
-                    except KeyError:
-                        missingBones.add(boneName)
-                # If we found no bone weight (not even one with weight zero) leave the list equal to None
-                hasWeight[1] += 1
-                if weights:
-                    hasWeight[0] += 1
-                    tVertex.weights = weights
-                elif tOptions.doForceElements:
-                    tVertex.weights = [(0, 0.0)]
-                
-            # All this code do is "tVertexIndex = verticesMapList.index(tVertex)", but we use
-            # a map to speed up.
-
-            # Get an hash of the vertex (different vertices with the same hash are ok)
-            vertexHash = hash(tVertex)
-            
-            try:
-                # Get a list of vertex indices with the same hash
-                verticesMapList = verticesMap[vertexHash]
-            except KeyError:
-                # If the hash is not mapped, create a new list (we should use sets but lists are faster)
-                verticesMapList = []
-                verticesMap[vertexHash] = verticesMapList
-            
-            # For each index in the list, test if it is the same as the current tVertex.
-            # If Position, Normal and UV must be the same get its index.
-            ## tVertexIndex = next((j for j in verticesMapList if verticesList[j] == tVertex), None)
-            tVertexIndex = None
-            for j in verticesMapList:
-                if verticesList[j].isEqual(tVertex):
-                    tVertexIndex = j
-                    break
-
-            # If we cannot find it, the vertex is new, add it to the list, and its index to the map list
-            if tVertexIndex is None:
-                tVertexIndex = len(verticesList)
-                verticesList.append(tVertex)
-                verticesMapList.append(tVertexIndex)
-
-
-            # Add the vertex index to the temp list to create triangles later
-            tempList.append(tVertexIndex)
-                        
-            # Map Blender face index and Blender vertex index to our TVertex index (this is used later by Morphs)
-            faceVertexMap[(face.index, vertexIndex)] = tVertexIndex
-            
-            # Save every unique vertex this LOD is using
-            indexSet.add(tVertexIndex)
-
-            # Create triangles
-            if i == 2:
-                triangle = (tempList[0], tempList[2], tempList[1])
-                triangleList.append(triangle)
-
-            if i == 3:
-                triangle = (tempList[0], tempList[3], tempList[2])
-                triangleList.append(triangle)
-        # end loop vertices
-    # end loop faces
     if not onlyProcessMaterial:
         if notBonesGroups:
             log.info("These groups are not used for bone deforms: {:s}".format( ", ".join(notBonesGroups) ))
@@ -2234,7 +3162,8 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
                 print("Object {:s} is only {:.1f}% skinned".format(meshObj.name, 100.0 * hasWeight[0] / hasWeight[1]))
         
         # Generate tangents for the last LOD of every geometry with new vertices
-        if mesh.urho_export.export_tan:
+        # (not needed if we already have MikkTSpace tangents)
+        if mesh.urho_export.export_tan and cornerTangents is None:
             lodLevels = []
             for geometryIndex in updatedGeometryIndices:
                 geometry = geometriesList[geometryIndex]
@@ -2247,13 +3176,41 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
                 
         # Optimize vertex index buffer for the last LOD of every geometry with new vertices
         if tOptions.doOptimizeIndices:
-            for geometryIndex in updatedGeometryIndices:
-                geometry = geometriesList[geometryIndex]
-                # Only the last LOD was modified (even if it wasn't a new LOD)
-                lodLevel = geometry.lodLevels[-1]
+            geometryIndices = sorted(updatedGeometryIndices)
+            # Only the last LOD was modified (even if it wasn't a new LOD)
+            lodLevels = [geometriesList[geometryIndex].lodLevels[-1] for geometryIndex in geometryIndices]
+            statsBefore = []
+            for geometryIndex, lodLevel in zip(geometryIndices, lodLevels):
                 log.info("Optimizing {:d} indices for {:s} Geometry{:d}"
                         .format(len(lodLevel.indexSet), meshObj.name, geometryIndex) )
-                OptimizeIndices(lodLevel)
+                statsBefore.append(CacheStatistics(lodLevel.triangleList, tOptions.vertexCacheSize))
+            # Get the already optimized LODs from the disk cache
+            cache = tOptions.diskCache
+            doOverdraw = tOptions.doOptimizeOverdraw and mesh.urho_export.export_pos
+            cacheKeys = {}
+            lodLevelsToDo = []
+            for lodLevel in lodLevels:
+                if cache:
+                    key = OptimizedIndicesKey(lodLevel, verticesList, tOptions, doOverdraw)
+                    data = cache.get(key)
+                    if data is not None and len(data) == len(lodLevel.triangleList) * 12:
+                        triangles = np.frombuffer(data, dtype=np.int32).reshape(-1, 3)
+                        lodLevel.triangleList = list(map(tuple, triangles.tolist()))
+                        continue
+                    cacheKeys[id(lodLevel)] = key
+                lodLevelsToDo.append(lodLevel)
+            OptimizeIndicesList(lodLevelsToDo, tOptions)
+            for lodLevel in lodLevelsToDo:
+                if doOverdraw:
+                    OptimizeOverdraw(lodLevel, verticesList, tOptions.vertexCacheSize, tOptions.overdrawThreshold)
+                if cache:
+                    triangles = np.array(lodLevel.triangleList, dtype=np.int32)
+                    cache.put(cacheKeys[id(lodLevel)], triangles.tobytes())
+            for geometryIndex, lodLevel, (acmrBefore, atvrBefore) in zip(geometryIndices, lodLevels, statsBefore):
+                acmr, atvr = CacheStatistics(lodLevel.triangleList, tOptions.vertexCacheSize)
+                log.info("Geometry{:d} {:s} (cache {:d}): ACMR {:.3f} -> {:.3f}, ATVR {:.3f} -> {:.3f}"
+                        .format(geometryIndex, tOptions.optimizeIndicesMode, tOptions.vertexCacheSize,
+                        acmrBefore, acmr, atvrBefore, atvr) )
         
         # Check if we need and can work on shape keys (morphs)
         shapeKeys = meshObj.data.shape_keys
@@ -2264,6 +3221,31 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
             else:
                 keyBlocks = shapeKeys.key_blocks
 
+        # Without modifiers the shape keys can be read directly from the key blocks
+        # (relative keys without vertex groups) and all the morphs computed in bulk.
+        # The evaluated mesh already has the keys at their current values.
+        keysCoords = None
+        evaluatedKeys = (mesh != meshObj.data)
+        if keyBlocks and shapeKeys.use_relative and len(keyBlocks[0].data) == len(mesh.vertices) and \
+                (not evaluatedKeys or not (meshObj.modifiers or meshObj.show_only_shape_key)) and \
+                not (tOptions.doMorphNor and mesh.use_auto_smooth):
+            verticesCount = len(mesh.vertices)
+            keysCoords = ReadShapeKeysCoords(keyBlocks, verticesCount)
+            appliedValues = AppliedShapeKeysValues(keyBlocks, evaluatedKeys)
+            keySlots = {block.name: i for i, block in enumerate(keyBlocks)}
+            baseCoords = np.empty(verticesCount * 3, dtype=np.float32)
+            mesh.vertices.foreach_get("co", baseCoords)
+            baseCoords = baseCoords.reshape(-1, 3).astype(np.float64)
+            smoothCorners = np.empty(meshArrays.trianglesCount, dtype=bool)
+            mesh.loop_triangles.foreach_get("use_smooth", smoothCorners)
+            smoothCorners = np.repeat(smoothCorners, 3)[:, None]
+            # Normals of the base mesh calculated like the morphs ones, we add to the
+            # Blender normals only the difference
+            vertexNormals, faceNormals = CalculateNormals(baseCoords, cornerVertexIndices)
+            baseNormals = np.where(smoothCorners, vertexNormals[cornerVertexIndices],
+                                   np.repeat(faceNormals, 3, axis=0))
+            validTrianglesMask = meshArrays.validTriangles
+
         # Decompose shape keys (morphs)
         for j, block in enumerate(keyBlocks):
             # Skip 'Basis' shape key
@@ -2277,6 +3259,55 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
             
             log.info("Decomposing shape: {:s} ({:d} vertices)".format(block.name, len(block.data)) )
 
+            if keysCoords is not None and not block.vertex_group and block.relative_key.name in keySlots:
+                # Shape key at 100%
+                coords = ShapeKeyCoords(baseCoords, keysCoords, j, keySlots[block.relative_key.name], appliedValues[j])
+                positions = TransformPoints(posMatrix, coords[cornerVertexIndices])[:, (0, 2, 1)]
+                movedCorners = np.linalg.norm(positions - cornerPositions, axis=1) > MORPH_EPSILON
+                if tOptions.doMorphNor:
+                    vertexNormals, faceNormals = CalculateNormals(coords, cornerVertexIndices)
+                    morphNormals = np.where(smoothCorners, vertexNormals[cornerVertexIndices],
+                                            np.repeat(faceNormals, 3, axis=0))
+                    normals = cornerNormals + TransformPoints(normalMatrix, morphNormals - baseNormals)[:, (0, 2, 1)]
+                    movedCorners |= np.linalg.norm(normals - cornerNormals, axis=1) > MORPH_EPSILON
+
+                # Add all the vertices of the triangles with at least one morphed vertex
+                morphedTriangles = np.flatnonzero(movedCorners.reshape(-1, 3).any(axis=1) & validTrianglesMask)
+                morphedCorners = (3 * morphedTriangles[:, None] + np.arange(3)).ravel()
+                tVertexIndices, firstCorners = np.unique(cornerVertexMap[morphedCorners], return_index=True)
+                for tVertexIndex, corner in zip(tVertexIndices.tolist(), morphedCorners[firstCorners].tolist()):
+                    tVertex = verticesList[tVertexIndex]
+                    # Create a new morphed vertex
+                    # (note: this vertex stores absolute values, not relative to original values)
+                    tMorphVertex = TVertex()
+                    tMorphVertex.blenderIndex = (meshIndex, int(cornerVertexIndices[corner]))
+                    tMorphVertex.pos = Vector(positions[corner])
+                    if tOptions.doMorphNor:
+                        tMorphVertex.normal = Vector(normals[corner])
+                    # If we have UV, copy them to the TVertex, we only need them to calculate tangents
+                    if tOptions.doMorphUV:
+                        if tVertex.uv:
+                            tMorphVertex.uv = tVertex.uv
+                        elif tOptions.doForceElements:
+                            tMorphVertex.uv = Vector((0.0, 0.0))
+                    tMorph.vertexMap[tVertexIndex] = tMorphVertex
+                # Save how many unique vertex this LOD is using (for tangents calculation)
+                tMorph.indexSet.update(tVertexIndices.tolist())
+                # Create triangles (for tangents calculation)
+                triangles = cornerVertexMap.reshape(-1, 3)[morphedTriangles][:, (0, 2, 1)]
+                tMorph.triangleList.extend(map(tuple, triangles.tolist()))
+
+                if tOptions.doMorphTan:
+                    log.info("Generating morph tangents {:s}".format(block.name) )
+                    GenerateTangents((tMorph,), tMorph.vertexMap, None)
+
+                # If valid add the morph to the model list
+                if tMorph.vertexMap:
+                    morphsList.append(tMorph)
+                else:
+                    log.warning('Empty shape {:s}.'.format(block.name))
+                continue
+
             #Set the shape key to 100%
             block.value = 1
             #Make a tempory copy of the mesh at this shape.
@@ -2287,7 +3318,8 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
             #TODO2.8: not sure about calc_undeformed. formerly there was 'PREVIEW' or 'RENDER'
             #shapeMesh = meshObj.to_mesh(dgraph, (tOptions.applyModifiers and not onlyProcessMaterial) or meshObj.lodsetID==-2, calc_undeformed=False)
 #            shapeMesh = meshObj.to_mesh(dgraph, True, calc_undeformed=False)
-            shapeMesh = meshObj.evaluated_get(dgraph).to_mesh(preserve_all_data_layers=True,depsgraph=dgraph)
+            # (note: a new mesh in bpy.data, to_mesh() would free the evaluated 'mesh')
+            shapeMesh = tempDatablocks.meshFromObject(meshObj, dgraph, preserve_all_data_layers=True)
             #shapeMesh = meshObj.to_mesh(preserve_all_data_layers=True,depsgraph=dgraph)
             #Reset the shape key to 0%
             block.value = 0
@@ -2298,15 +3330,15 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
                 #Try a fallback of converting shape key data directly to vertex data. If there is a vertex count mismatch, it's due to a modifier changing the vertex count (e.g. mirror).
                 if len(shapeMesh.vertices) != len(block.data):
                     # Delete the temporary copy
-                    bpy.data.meshes.remove(shapeMesh)
+                    tempDatablocks.removeMesh(shapeMesh)
                     #TODO: Handling this requires a method for mapping original vertex points to their final points, which handles cases where the vertex count changes.
                     log.error("Vertex count mismatch on shape {:s}.".format(block.name))
                     continue
                 else:
                     # Delete the temporary copy
-                    bpy.data.meshes.remove(shapeMesh)
+                    tempDatablocks.removeMesh(shapeMesh)
                     # Make a new temporary copy of the base mesh
-                    shapeMesh = mesh.copy()
+                    shapeMesh = tempDatablocks.copyMesh(mesh)
                     # Apply the shape
                     for i, data in enumerate(block.data):
                         shapeMesh.vertices[i].co = data.co
@@ -2356,9 +3388,14 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
                     normal = normalMatrix @ normal
 
                     # Try to find the TVertex index corresponding to this Blender vertex index
-                    try:
-                        tVertexIndex = faceVertexMap[(face.index, vertexIndex)]
-                    except KeyError:
+                    # in the same face of the mesh
+                    tVertexIndex = -1
+                    if face.index < meshArrays.trianglesCount:
+                        for corner in range(3 * face.index, 3 * face.index + 3):
+                            if cornerVertexIndices[corner] == vertexIndex:
+                                tVertexIndex = int(cornerVertexMap[corner])
+                                break
+                    if tVertexIndex < 0:
                         log.error("Cannot find vertex {:d} of face {:d} of shape {:s}."
                                 .format(vertexIndex, face.index, block.name) )
                         continue
@@ -2385,7 +3422,7 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
                         if tVertex.uv:
                             tMorphVertex.uv = tVertex.uv
                         elif tOptions.doForceElements:
-                            tVertex.uv = Vector(0.0, 0.0)
+                            tMorphVertex.uv = Vector((0.0, 0.0))
                     
                     # Save vertex index and morphed vertex, to be added later if at least one
                     # vertex in the face was morphed
@@ -2394,11 +3431,6 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
                     # Check if the morph has effect
                     if tMorphVertex.isMorphed(tVertex):
                         morphed = True
-                        print("###############MORPHED: %s => %s" %(tMorphVertex.pos,tVertex.pos))
-                    else:
-                        origCO = meshObj.data.vertices[vertexIndex].co
-                        morphCO = shapeMesh.vertices[vertexIndex].co
-                        print("NOT MORPHED: %s => %s  | %s => %s" %(tMorphVertex.pos,tVertex.pos,morphCO,origCO))
                 
                 # If at least one vertex in the face was morphed
                 if morphed:
@@ -2439,8 +3471,8 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
             else:
                 log.warning('Empty shape {:s}.'.format(block.name))
 
-            # Delete the temporary copy 
-            #bpy.data.meshes.remove(shapeMesh)
+            # Delete the temporary copy
+            tempDatablocks.removeMesh(shapeMesh)
 
         #Restore shape keys
         for j, block in enumerate(keyBlocks):
@@ -2448,21 +3480,177 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
                 continue
             block.value = shapeKeysOldValues[j]
 
-    #bpy.data.meshes.remove(mesh)    
     meshObj.select_set(beforeSelectstate)
     bpy.ops.object.mode_set(mode=beforeMode)
 
     return
 
+#--------------------
+# Evaluated meshes cache
+#--------------------
+
+# Arrays read from a mesh evaluated with its modifiers, kept between the exports of
+# the session until the object or one of its inputs changes (see EvaluatedMeshesUpdate)
+class TEvaluatedMesh:
+    def __init__(self):
+        # Key of the mesh data, modifiers and options used (see EvaluatedMeshKey)
+        self.key = None
+        # Pointer of the mesh data of the object
+        self.dataPointer = None
+        # Number of vertices of the evaluated mesh
+        self.verticesCount = 0
+        # TMeshArrays of the loop triangles
+        self.meshArrays = None
+        # MikkTSpace tangents (corners, 4) or None
+        self.tangents = None
+        # Vertex groups of all the vertices (see ReadVertexGroups) or None if not read
+        self.vertexGroups = None
+
+# Slot (see EvaluatedMeshSlot) to TEvaluatedMesh
+evaluatedMeshes = {}
+
+# Returns the slot of 'meshObj' in the evaluated meshes: the object pointer, or the
+# object name for the temporary LOD objects which are created again by each export
+# (their name is the lodset name and the LOD distance, their key has the LOD mesh
+# and the decimate settings)
+def EvaluatedMeshSlot(meshObj):
+    if meshObj.lodsetID == -2:
+        return meshObj.name
+    return meshObj.as_pointer()
+
+# Returns the signature of the modifiers stack of the object 'obj' (the type and the
+# settings of each modifier) and True if a modifier uses other datablocks
+def ModifiersSignature(obj):
+    usesIds = False
+    signature = []
+    for modifier in obj.modifiers:
+        values = [modifier.type]
+        for prop in modifier.bl_rna.properties:
+            if prop.identifier in ('rna_type', 'name'):
+                continue
+            value = getattr(modifier, prop.identifier, None)
+            if isinstance(value, bpy.types.ID):
+                usesIds = True
+                values.append(value.as_pointer())
+                continue
+            if prop.type in ('POINTER', 'COLLECTION'):
+                continue
+            if getattr(prop, 'is_array', False):
+                value = tuple(value)
+            values.append(value)
+        signature.append(tuple(values))
+    return tuple(signature), usesIds
+
+# Returns the key of the arrays read from the evaluated mesh of 'meshObj': the mesh
+# data, the modifiers and the options used to transform and read the corners
+def EvaluatedMeshKey(meshObj, tOptions):
+    exportSettings = meshObj.data.urho_export
+    parts = [meshObj.data.as_pointer(), ModifiersSignature(meshObj)[0]]
+    if tOptions.globalOrigin:
+        parts.append(tuple(tuple(row) for row in meshObj.matrix_world))
+    if tOptions.orientation:
+        parts.append(tuple(tOptions.orientation))
+    parts.append(tOptions.scale)
+    parts.append((exportSettings.get_export_uv1(), exportSettings.get_export_uv2(),
+                  exportSettings.export_tan, exportSettings.tangent_method))
+    return tuple(parts)
+
+# Returns the TEvaluatedMesh of 'meshObj' saved with 'key', or None
+def GetEvaluatedMesh(meshObj, key, needVertexGroups):
+    evaluatedMesh = evaluatedMeshes.get(EvaluatedMeshSlot(meshObj))
+    if evaluatedMesh is None or evaluatedMesh.key != key:
+        return None
+    if needVertexGroups and evaluatedMesh.vertexGroups is None:
+        return None
+    return evaluatedMesh
+
+def ClearEvaluatedMeshes():
+    evaluatedMeshes.clear()
+
+# Forget the evaluated meshes of the objects and of the mesh datas not in bpy.data
+# anymore (deleted objects are not reported by the depsgraph updates)
+def PruneEvaluatedMeshes():
+    if not evaluatedMeshes:
+        return
+    objectPointers = {obj.as_pointer() for obj in bpy.data.objects}
+    meshPointers = {mesh.as_pointer() for mesh in bpy.data.meshes}
+    for slot, evaluatedMesh in list(evaluatedMeshes.items()):
+        if evaluatedMesh.dataPointer not in meshPointers or \
+                (not isinstance(slot, str) and slot not in objectPointers):
+            del evaluatedMeshes[slot]
+
+# Handler of depsgraph_update_post: forget the evaluated meshes of the objects with a
+# new geometry (the depsgraph also reports the objects whose inputs changed, like the
+# target of a boolean modifier) and of the changed mesh datas
+@persistent
+def EvaluatedMeshesUpdate(scene, depsgraph = None):
+    if not evaluatedMeshes:
+        return
+    if depsgraph is None:
+        evaluatedMeshes.clear()
+        return
+    for update in depsgraph.updates:
+        updatedId = update.id
+        if isinstance(updatedId, bpy.types.Object):
+            if update.is_updated_geometry:
+                evaluatedMeshes.pop(updatedId.original.as_pointer(), None)
+        elif isinstance(updatedId, bpy.types.Mesh):
+            dataPointer = updatedId.original.as_pointer()
+            for slot, evaluatedMesh in list(evaluatedMeshes.items()):
+                if evaluatedMesh.dataPointer == dataPointer:
+                    del evaluatedMeshes[slot]
+
+#--------------------
+# Shared geometries
+#--------------------
+
+# Returns the key of the geometry decomposed from the object 'obj', objects with the
+# same key share the mesh datablock, the modifiers (if applied) and the transform (if
+# using the global origin). Returns None if the geometry cannot be shared.
+def MeshGeometryKey(obj, tOptions):
+    parts = [obj.data.as_pointer()]
+    if tOptions.applyModifiers or "_LOD" in obj.name:
+        signature, usesIds = ModifiersSignature(obj)
+        # Modifiers using other objects depend on their transforms
+        if usesIds:
+            return None
+        parts.append(signature)
+    if tOptions.globalOrigin:
+        parts.append(tuple(tuple(row) for row in obj.matrix_world))
+    return tuple(parts)
+
+# Use in 'tData' the geometry already decomposed in 'sourceTData'
+def ShareGeometry(tData, sourceTData):
+    tData.verticesList = sourceTData.verticesList
+    tData.geometriesList = sourceTData.geometriesList
+    tData.morphsList = sourceTData.morphsList
+    tData.materialsList = sourceTData.materialsList
+    tData.materialGeometryMap = sourceTData.materialGeometryMap
+    tData.geometrySource = sourceTData
+
 #--------------------
 # Scan objects
 #--------------------
 
-# Scan and decompose objects
+# Scan and decompose objects, the index optimization workers are stopped at the end
+# even if an error occurs
 def Scan(context, tDataList, errorsMem, tOptions):
+    try:
+        ScanObjects(context, tDataList, errorsMem, tOptions)
+    finally:
+        tOptions.objectsMatrices = None
+        # Stop the index optimization workers
+        if tOptions.optimizeIndicesPool:
+            tOptions.optimizeIndicesPool.close()
+            tOptions.optimizeIndicesPool = None
+
+def ScanObjects(context, tDataList, errorsMem, tOptions):
     global decomposedActions
     decomposedActions  = []
 
+    # Objects deleted since the last export
+    PruneEvaluatedMeshes()
+
     scene = context.scene
     
     # Get all objects in the scene or only the selected in visible layers
@@ -2524,6 +3712,14 @@ def Scan(context, tDataList, errorsMem, tOptions):
         # Sort by object name = LOD name
         meshes.sort(key=lambda x: x[1])
 
+    # Sample the animations of all the objects in a single sweep of the timeline
+    if tOptions.doObjAnimations:
+        tOptions.objectsMatrices = SampleObjectsAnimations(scene, [obj for obj, _, _ in meshes], tOptions)
+
+    # Geometry key to the TData where it was decomposed
+    decomposedGeometries = {}
+    sharedCount = 0
+
     # Decompose objects
     tData = None
     lodCurrentName = None
@@ -2623,11 +3819,27 @@ def Scan(context, tDataList, errorsMem, tOptions):
             DecomposeActions(scene, obj, tData, tOptions)
 
         # Decompose geometries
-        if tOptions.doGeometries :
+        # Objects with the same mesh (and without skeleton) reuse its decomposed geometry
+        geometryKey = None
+        if tOptions.doGeometries and createNew and not armatureObj and not tOptions.mergeObjects and \
+                not tOptions.useLods and obj.lodsetID == 0:
+            geometryKey = MeshGeometryKey(obj, tOptions)
+        if geometryKey in decomposedGeometries:
+            log.info("Sharing the geometry of {:s}".format(decomposedGeometries[geometryKey].objectName))
+            ShareGeometry(tData, decomposedGeometries[geometryKey])
+            sharedCount += 1
+        elif tOptions.doGeometries :
+            if geometryKey:
+                decomposedGeometries[geometryKey] = tData
             savedValue = SetRestPosePosition(context, armatureObj)
-            DecomposeMesh(scene, obj, tData, tOptions, errorsMem,obj.lodsetID>0)
+            # Temporary meshes of this object are released as soon as it is decomposed
+            with TempDatablocks(tOptions.tempDatablocks) as tempDatablocks:
+                DecomposeMesh(scene, obj, tData, tOptions, errorsMem, obj.lodsetID>0, tempDatablocks)
             RestorePosePosition(armatureObj, savedValue)
 
+    if sharedCount:
+        log.info("Shared geometries: {:d} objects, {:d} meshes decomposed".format(sharedCount, len(decomposedGeometries)))
+
 #-----------------------------------------------------------------------------
 
 if __name__ == "__main__":
@@ -10,7 +10,9 @@ from mathutils import Vector, Matrix, Quaternion
 from math import cos, pi
 from xml.etree import ElementTree as ET
 from collections import defaultdict
+import numpy as np
 import operator
+import copy
 import os
 import random
 import bpy
@@ -44,6 +46,9 @@ TRACK_POSITION      = 0x0001
 TRACK_ROTATION      = 0x0002
 TRACK_SCALE         = 0x0004
 
+# Maximum difference between the values of a channel to consider it constant
+CONSTANT_CHANNEL_EPSILON = 1e-4
+
 TRIANGLE_LIST       = 0
 LINE_LIST           = 1
             
@@ -101,6 +106,35 @@ def VectorDotProduct(v1, v2):
         return -1
     return v1.dot(v2)
 
+#--------------------
+# Bones weights
+#--------------------
+
+# Select the 'maxCount' biggest weights of each vertex from the weights in CSR format
+# (offsets, bone indices, weights) and normalize them.
+# Returns two arrays (vertices x maxCount) of bone indices and weights, sorted by
+# decreasing weight, unused slots are zero.
+def SelectTopWeights(offsets, bones, weights, maxCount = BONES_PER_VERTEX):
+    count = len(offsets) - 1
+    counts = offsets[1:] - offsets[:-1]
+    rowIds = np.repeat(np.arange(count), counts)
+    # Sort by vertex and then by decreasing weight (equal weights keep their order)
+    order = np.lexsort((-weights, rowIds))
+    # Position of each sorted weight in its vertex
+    rank = np.arange(len(order)) - np.repeat(offsets[:-1], counts)
+    keep = rank < maxCount
+    order = order[keep]
+    rank = rank[keep]
+    rowIds = rowIds[keep]
+    topBones = np.zeros((count, maxCount), dtype=np.int32)
+    topWeights = np.zeros((count, maxCount), dtype=np.float64)
+    topBones[rowIds, rank] = bones[order]
+    topWeights[rowIds, rank] = weights[order]
+    # Normalize weights
+    totalWeights = topWeights.sum(axis=1, keepdims=True)
+    np.divide(topWeights, totalWeights, out=topWeights, where=(totalWeights > 0.0))
+    return topBones, topWeights
+
 #--------------------
 # Classes
 #--------------------
@@ -175,7 +209,9 @@ class FrameMaskError(Exception):
 # --- Model classes ---
 
 class UrhoVertex:
-    def __init__(self, tVertex):
+    # 'boneWeights' are the bone indices and weights of the vertex already selected
+    # and normalized by SelectTopWeights, if None they are taken from tVertex
+    def __init__(self, tVertex, boneWeights = None):
         # Bit mask of elements present
         self.mask = 0
         # Only used by morphs, original vertex index in the not morphed vertex buffer
@@ -206,14 +242,15 @@ class UrhoVertex:
             self.mask |= ELEMENT_TANGENT
         # List of tuples: blend weight (float), bone index (unsigned byte), mapped bone index (None if the bone is not mapped)
         self.weights = [(0.0, 0, None)] * BONES_PER_VERTEX
-        if tVertex.weights is not None:
-            # Sort tuples (index, weight) by decreasing weight
-            sortedList = sorted(tVertex.weights, key = operator.itemgetter(1), reverse = True)
-            sortedList = sortedList[:BONES_PER_VERTEX]
-            # Normalize weights and add to the list
-            totalWeight = sum([t[1] for t in sortedList])
-            for i, t in enumerate(sortedList):
-                self.weights[i] = (t[1] / totalWeight, t[0], None)
+        if boneWeights is None and tVertex.weights is not None:
+            # Select and normalize the biggest weights of tuples (index, weight)
+            bones = np.array([t[0] for t in tVertex.weights], dtype=np.int32)
+            weights = np.array([t[1] for t in tVertex.weights], dtype=np.float64)
+            topBones, topWeights = SelectTopWeights(np.array([0, len(bones)]), bones, weights)
+            boneWeights = (topBones[0], topWeights[0])
+        if boneWeights is not None:
+            bones, weights = boneWeights
+            self.weights = [(w, b, None) for b, w in zip(bones.tolist(), weights.tolist())]
             self.mask |= ELEMENT_BLEND
 
     # used by the function index() of lists
@@ -416,6 +453,42 @@ class UrhoTrack:
             self.elementMask &= keyframeMask
             raise FrameMaskError(oldMask, keyframeMask, self.elementMask)
 
+    # Remove from the mask the channels which are constant in all the keyframes and equal to
+    # the bind pose (Urho3D resets the channels not in the mask to the bind pose), a bind value
+    # is None if unknown. If the remaining channels are all constant keep only the first keyframe.
+    # Returns the number of removed channels.
+    def stripConstantChannels(self, bindPosition, bindRotation, bindScale):
+        if not self.keyframes or not self.elementMask:
+            return 0
+        removed = 0
+        constantMask = 0
+        for channel, name, bindValue in ((TRACK_POSITION, 'position', bindPosition),
+                                         (TRACK_ROTATION, 'rotation', bindRotation),
+                                         (TRACK_SCALE, 'scale', bindScale)):
+            if not (self.elementMask & channel):
+                continue
+            values = np.array([tuple(getattr(keyframe, name)) for keyframe in self.keyframes], dtype=np.float64)
+            first = values[0]
+            if channel == TRACK_ROTATION:
+                # q and -q are the same rotation
+                values *= np.where(values @ first < 0.0, -1.0, 1.0)[:, None]
+            if np.abs(values - first).max() > CONSTANT_CHANNEL_EPSILON:
+                continue
+            constantMask |= channel
+            if bindValue is None:
+                continue
+            bindValue = np.array(tuple(bindValue), dtype=np.float64)
+            if channel == TRACK_ROTATION and bindValue @ first < 0.0:
+                bindValue = -bindValue
+            if np.abs(bindValue - first).max() <= CONSTANT_CHANNEL_EPSILON:
+                self.elementMask &= ~channel
+                constantMask &= ~channel
+                removed += 1
+        # All the remaining channels are constant (but not equal to the bind pose)
+        if self.elementMask and (self.elementMask & ~constantMask) == 0:
+            del self.keyframes[1:]
+        return removed
+
 class UrhoTrigger:
     def __init__(self):
         # Trigger name 
@@ -516,6 +589,7 @@ class UrhoExportOptions:
     def __init__(self):
         self.splitSubMeshes = False
         self.useStrictLods = True
+        self.stripConstantChannels = True
 
 
 #--------------------
@@ -775,6 +849,45 @@ def UrhoWriteTriggers(triggersList, filename, fOptions):
 # Utils
 #--------------------
 
+# Renumber the vertices of each vertex buffer in order of first use by the index
+# buffers (vertices not used go last), and remap the indices. This improves the
+# locality of the vertex fetches of the GPU.
+# Returns for each vertex buffer the array mapping old to new vertex indices.
+def OptimizeVertexFetch(uModel):
+    # Index ranges of each vertex buffer, in drawing order
+    bufferRanges = defaultdict(list)
+    for uGeometry in uModel.geometries:
+        for uLodLevel in uGeometry.lodLevels:
+            bufferRanges[uLodLevel.vertexBuffer].append(uLodLevel)
+
+    remaps = []
+    for bufferIndex, uVertexBuffer in enumerate(uModel.vertexBuffers):
+        count = len(uVertexBuffer.vertices)
+        usedIndices = []
+        for uLodLevel in bufferRanges[bufferIndex]:
+            indexes = uModel.indexBuffers[uLodLevel.indexBuffer].indexes
+            usedIndices.append(np.array(indexes[uLodLevel.startIndex:uLodLevel.startIndex + uLodLevel.countIndex], dtype=np.int64))
+        usedIndices.append(np.arange(count))
+        usedIndices = np.concatenate(usedIndices)
+        # Old vertex indices in order of first use
+        _, firstUse = np.unique(usedIndices, return_index=True)
+        newToOld = usedIndices[np.sort(firstUse)]
+        remap = np.empty(count, dtype=np.int64)
+        remap[newToOld] = np.arange(count)
+        uVertexBuffer.vertices = [uVertexBuffer.vertices[i] for i in newToOld.tolist()]
+        remaps.append(remap)
+
+    # Remap the indices of each LOD (LODs use distinct ranges of the index buffers)
+    for bufferIndex, uLodLevels in bufferRanges.items():
+        remap = remaps[bufferIndex]
+        for uLodLevel in uLodLevels:
+            indexes = uModel.indexBuffers[uLodLevel.indexBuffer].indexes
+            start = uLodLevel.startIndex
+            end = start + uLodLevel.countIndex
+            indexes[start:end] = remap[np.array(indexes[start:end], dtype=np.int64)].tolist()
+
+    return remaps
+
 # Search for the most complete element mask
 def GetMaxElementMask(indices, vertices):
     maxElementMask = 0
@@ -816,7 +929,9 @@ def GetMaxElementMask(indices, vertices):
 # Urho exporter
 #--------------------
 
-def UrhoExport(tData, uExportOptions, uExportData, errorsMem):
+# 'sharedModels' (optional) is a dictionary of the models already exported, objects
+# sharing the geometry of one of them (tData.geometrySource) reuse its buffers
+def UrhoExport(tData, uExportOptions, uExportData, errorsMem, sharedModels = None):
 
     global MAX_SKIN_MATRICES
     global BONES_PER_VERTEX
@@ -825,10 +940,28 @@ def UrhoExport(tData, uExportOptions, uExportData, errorsMem):
     if uExportOptions.bonesPerVertex:
         BONES_PER_VERTEX = uExportOptions.bonesPerVertex
 
-    uModel = UrhoModel()
-    uModel.name = tData.objectName
-    uExportData.models.append(uModel)    
-    
+    sourceModel = None
+    if sharedModels is not None and tData.geometrySource:
+        sourceModel = sharedModels.get(id(tData.geometrySource))
+
+    if sourceModel:
+        # Same buffers, geometries, morphs and bones, only the name changes
+        uModel = copy.copy(sourceModel)
+        uModel.name = tData.objectName
+        uExportData.models.append(uModel)
+    else:
+        uModel = UrhoModel()
+        uModel.name = tData.objectName
+        uExportData.models.append(uModel)
+        UrhoExportModel(tData, uExportOptions, uModel, errorsMem)
+        if sharedModels is not None:
+            sharedModels[id(tData)] = uModel
+
+    UrhoExportAnimations(tData, uExportOptions, uExportData)
+
+# Convert the bones, geometries and morphs of 'tData' to the model 'uModel'
+def UrhoExportModel(tData, uExportOptions, uModel, errorsMem):
+
     # For each bone
     for boneName, bone in tData.bonesMap.items():
         uBoneIndex = len(uModel.bones)
@@ -875,6 +1008,11 @@ def UrhoExport(tData, uExportOptions, uExportData, errorsMem):
     indexBuffer = None
     # Maps old vertex index to Urho vertex buffer index and Urho vertex index
     modelIndexMap = {}
+
+    # Select and normalize the bones weights of all the vertices
+    weightOffsets, weightBones, weightValues = tData.verticesList.csrWeights()
+    topBones, topWeights = SelectTopWeights(weightOffsets, weightBones, weightValues)
+    hasWeights = weightOffsets[1:] > weightOffsets[:-1]
     
     # For each geometry
     for tGeometry in tData.geometriesList:
@@ -948,7 +1086,10 @@ def UrhoExport(tData, uExportOptions, uExportData, errorsMem):
                 tVertex = tData.verticesList[tVertexIndex]
 
                 # Create a Urho vertex
-                uVertex = UrhoVertex(tVertex)
+                boneWeights = None
+                if hasWeights[tVertexIndex]:
+                    boneWeights = (topBones[tVertexIndex], topWeights[tVertexIndex])
+                uVertex = UrhoVertex(tVertex, boneWeights)
                 try:
                     vertexBuffer.updateMask(uVertex.mask)
                 except VertexMaskError as e:
@@ -1086,6 +1227,11 @@ def UrhoExport(tData, uExportOptions, uExportData, errorsMem):
         #Geometry loop
     #
 
+    # Renumber the vertices in order of first use, then update the map used by morphs
+    vertexRemaps = OptimizeVertexFetch(uModel)
+    for oldIndex, vbviSet in modelIndexMap.items():
+        modelIndexMap[oldIndex] = set((vb, int(vertexRemaps[vb][vi])) for vb, vi in vbviSet)
+
     if tData.geometriesList and uModel.boundingBox.min is None:
         uModel.boundingBox.min = Vector((0.0, 0.0, 0.0))
         uModel.boundingBox.max = Vector((0.0, 0.0, 0.0))
@@ -1214,12 +1360,17 @@ def UrhoExport(tData, uExportOptions, uExportData, errorsMem):
             uVertexBuffer.morphMinIndex = 0
             uVertexBuffer.morphMaxIndex = 0
 
-            
+# Convert the animations of 'tData'
+def UrhoExportAnimations(tData, uExportOptions, uExportData):
+
     uAnimations = uExportData.animations
     for tAnimation in tData.animationsList:
         uAnimation = UrhoAnimation()
         uAnimation.name = tAnimation.name
         uAnimation.length = None
+        strippedChannels = 0
+        strippedTracks = 0
+        firstStrippedTrack = None
         
         for tTrack in tAnimation.tracks:
             uTrack = UrhoTrack()
@@ -1237,13 +1388,42 @@ def UrhoExport(tData, uExportOptions, uExportData, errorsMem):
             # Make sure keyframes are sorted from beginning to end
             uTrack.keyframes.sort(key = operator.attrgetter('time'))
 
+            if not uTrack.keyframes or not uTrack.elementMask:
+                continue
+
+            # Update animation length (before removing keyframes)
+            length = uTrack.keyframes[-1].time
+            if uAnimation.length is None or uAnimation.length < length:
+                uAnimation.length = length
+
+            # Remove the constant channels, for bones we know the bind pose
+            elementMask = uTrack.elementMask
+            if uExportOptions.stripConstantChannels:
+                tBone = tData.bonesMap.get(uTrack.name)
+                if tBone:
+                    strippedChannels += uTrack.stripConstantChannels(tBone.bindPosition, 
+                                            tBone.bindRotation, tBone.bindScale)
+                else:
+                    strippedChannels += uTrack.stripConstantChannels(None, None, None)
+
             # Add only tracks with keyframes
             if uTrack.keyframes and uTrack.elementMask:
                 uAnimation.tracks.append(uTrack)
-                # Update animation length
-                length = uTrack.keyframes[-1].time
-                if uAnimation.length is None or uAnimation.length < length:
-                    uAnimation.length = length
+            else:
+                strippedTracks += 1
+                if firstStrippedTrack is None:
+                    # Save it with one keyframe, in case the whole animation is the bind pose
+                    uTrack.elementMask = elementMask
+                    del uTrack.keyframes[1:]
+                    firstStrippedTrack = uTrack
+
+        # If the whole animation is the bind pose keep a track, otherwise the animation is lost
+        if not uAnimation.tracks and firstStrippedTrack:
+            uAnimation.tracks.append(firstStrippedTrack)
+            strippedTracks -= 1
+        if strippedChannels:
+            log.info("Animation {:s}: removed {:d} constant channels and {:d} tracks"
+                     .format(uAnimation.name, strippedChannels, strippedTracks))
 
         # Add the triggers for the animation
         for tTrigger in tAnimation.triggers:
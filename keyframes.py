@@ -0,0 +1,97 @@
+
+#
+# This script is licensed as public domain.
+#
+
+# Keyframes reduction of the animation tracks.
+# This module only needs NumPy (no bpy, no mathutils), so it can also run
+# outside Blender.
+
+import numpy as np
+
+# Spherical interpolation between the quaternions arrays 'q0' and 'q1' (n, 4) with the
+# factors 't' (n), same as Quaternion::Slerp of Urho3D
+def QuaternionsSlerp(q0, q1, t):
+    cosAngle = np.einsum('ij,ij->i', q0, q1)
+    sign = np.where(cosAngle < 0.0, -1.0, 1.0)
+    angle = np.arccos(np.minimum(np.abs(cosAngle), 1.0))
+    sinAngle = np.sin(angle)
+    small = (sinAngle <= 0.001)
+    sinAngle = np.where(small, 1.0, sinAngle)
+    t1 = np.where(small, 1.0 - t, np.sin((1.0 - t) * angle) / sinAngle)
+    t2 = np.where(small, t, np.sin(t * angle) / sinAngle) * sign
+    return q0 * t1[:, None] + q1 * t2[:, None]
+
+# Angles (radians) between the quaternions arrays 'q0' and 'q1' (n, 4)
+def QuaternionsAngle(q0, q1):
+    q0 = q0 / np.linalg.norm(q0, axis=1, keepdims=True)
+    q1 = q1 / np.linalg.norm(q1, axis=1, keepdims=True)
+    return 2.0 * np.arccos(np.minimum(np.abs(np.einsum('ij,ij->i', q0, q1)), 1.0))
+
+# Find the keyframes that cannot be rebuilt within the tolerances interpolating the other
+# keyframes, as Urho3D does: lerp for positions and scales, slerp for rotations.
+# 'times' is the array of the keyframes times, 'positions', 'rotations' and 'scales' the
+# arrays of their values (None if not exported). 'rotationTolerance' is in radians.
+# The first and the last keyframes are always kept. Returns the indices of the keyframes
+# to keep.
+def ReduceKeyframes(times, positions, rotations, scales, positionTolerance, rotationTolerance, scaleTolerance):
+    count = len(times)
+    if count <= 2:
+        return np.arange(count)
+
+    # List of (values array, tolerance, is rotation)
+    channels = []
+    if positions is not None:
+        channels.append((positions, positionTolerance, False))
+    if rotations is not None:
+        channels.append((rotations, rotationTolerance, True))
+    if scales is not None:
+        channels.append((scales, scaleTolerance, False))
+
+    # Check if the keyframes between 'start' and 'end' can be interpolated
+    def CanInterpolate(start, end):
+        duration = times[end] - times[start]
+        if duration <= 0.0:
+            return False
+        t = (times[start+1:end] - times[start]) / duration
+        for values, tolerance, isRotation in channels:
+            v0 = np.broadcast_to(values[start], (len(t), values.shape[1]))
+            v1 = np.broadcast_to(values[end], (len(t), values.shape[1]))
+            if isRotation:
+                errors = QuaternionsAngle(QuaternionsSlerp(v0, v1, t), values[start+1:end])
+            else:
+                errors = np.linalg.norm(v0 + (v1 - v0) * t[:, None] - values[start+1:end], axis=1)
+            if errors.max() > tolerance:
+                return False
+        return True
+
+    # Extend each segment as much as possible: double its length while it can be
+    # interpolated, then bisect between the last end that can be interpolated and the
+    # first that cannot. Each check costs the segment length, so a long segment costs
+    # O(n log n) instead of O(n^2) adding one keyframe at a time.
+    kept = [0]
+    start = 0
+    while start < count - 1:
+        # Two consecutive keyframes need no interpolation
+        good = start + 1
+        bad = None
+        step = 1
+        while good < count - 1:
+            end = min(good + step, count - 1)
+            if not CanInterpolate(start, end):
+                bad = end
+                break
+            good = end
+            step *= 2
+        if bad is not None:
+            while bad - good > 1:
+                middle = (good + bad) // 2
+                if CanInterpolate(start, middle):
+                    good = middle
+                else:
+                    bad = middle
+        if good < count - 1:
+            kept.append(good)
+        start = good
+    kept.append(count - 1)
+    return np.array(kept)
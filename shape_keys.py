@@ -0,0 +1,37 @@
+
+#
+# This script is licensed as public domain.
+#
+
+# Shape keys (morphs) coordinates computed in bulk.
+# This module only needs NumPy (no bpy, no mathutils), so it can also run
+# outside Blender.
+
+import numpy as np
+
+# Read with foreach_get the coordinates of all the shape keys 'keyBlocks'.
+# Returns an array (keys, vertices, 3).
+def ReadShapeKeysCoords(keyBlocks, verticesCount):
+    coords = np.empty((len(keyBlocks), verticesCount * 3), dtype=np.float32)
+    for i, block in enumerate(keyBlocks):
+        block.data.foreach_get("co", coords[i])
+    return coords.reshape(len(keyBlocks), verticesCount, 3).astype(np.float64)
+
+# Values of the relative shape keys 'keyBlocks' already applied to the vertices of the
+# mesh: none for the original mesh data, the current values (muted keys excluded) for
+# the evaluated mesh. Returns an array (keys).
+def AppliedShapeKeysValues(keyBlocks, evaluated):
+    values = np.zeros(len(keyBlocks))
+    if evaluated:
+        for i, block in enumerate(keyBlocks):
+            if i > 0 and not block.mute:
+                values[i] = block.value
+    return values
+
+# Coordinates (vertices, 3) of the mesh with the shape key 'index' at 100% and the other
+# keys unchanged, 'baseCoords' are the mesh vertices, 'keysCoords' the coordinates of
+# all the keys (see ReadShapeKeysCoords), 'relativeIndex' the index of the key relative
+# key and 'appliedValue' the value of the key already applied to 'baseCoords'.
+# Same as Blender evaluating the key at 1.0, the key must not have a vertex group.
+def ShapeKeyCoords(baseCoords, keysCoords, index, relativeIndex, appliedValue):
+    return baseCoords + (1.0 - appliedValue) * (keysCoords[index] - keysCoords[relativeIndex])
@@ -0,0 +1,95 @@
+#
+# This script is licensed as public domain.
+#
+
+# Tests of the keyframes reduction (keyframes.py), run with: python -m pytest tests
+
+import os
+import sys
+import pytest
+
+np = pytest.importorskip("numpy")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from keyframes import QuaternionsSlerp, QuaternionsAngle, ReduceKeyframes
+
+# Quaternions (w, x, y, z) of the rotations of 'angles' (degrees) around 'axis'
+def AxisQuaternions(axis, angles):
+    halfAngles = np.radians(angles) / 2.0
+    quaternions = np.zeros((len(angles), 4))
+    quaternions[:, 0] = np.cos(halfAngles)
+    quaternions[:, 1:] = np.outer(np.sin(halfAngles), axis)
+    return quaternions
+
+def QuaternionsMultiply(a, b):
+    w1, x1, y1, z1 = a.T
+    w2, x2, y2, z2 = b.T
+    return np.stack((w1*w2 - x1*x2 - y1*y2 - z1*z2,
+                     w1*x2 + x1*w2 + y1*z2 - z1*y2,
+                     w1*y2 - x1*z2 + y1*w2 + z1*x2,
+                     w1*z2 + x1*y2 - y1*x2 + z1*w2), axis=1)
+
+def test_lerp_keeps_corners():
+    times = np.arange(11) / 30.0
+    positions = np.zeros((11, 3))
+    positions[:6, 0] = np.arange(6)
+    positions[6:, 0] = 5.0
+    positions[:, 1] = 2.0
+    kept = ReduceKeyframes(times, positions, None, None, 0.001, 0.001, 0.001)
+    assert kept.tolist() == [0, 5, 10]
+
+def test_lerp_uneven_times():
+    # Constant speed in space with uneven times is not linear in time
+    times = np.array([0.0, 0.1, 0.2, 0.5, 0.6, 0.7])
+    positions = np.zeros((6, 3))
+    positions[:, 2] = times * 10.0
+    positions[4:, 2] = 5.0
+    kept = ReduceKeyframes(times, positions, None, None, 0.001, 0.001, 0.001)
+    assert kept.tolist() == [0, 3, 5]
+
+def test_slerp_keeps_axis_change():
+    # 10 degrees per frame around Z, then 10 degrees per frame around X
+    first = AxisQuaternions((0.0, 0.0, 1.0), np.arange(5) * 10.0)
+    second = QuaternionsMultiply(AxisQuaternions((1.0, 0.0, 0.0), np.arange(1, 5) * 10.0),
+                                 np.repeat(first[-1:], 4, axis=0))
+    rotations = np.vstack((first, second))
+    times = np.arange(9) / 30.0
+    kept = ReduceKeyframes(times, None, rotations, None, 0.001, np.radians(0.1), 0.001)
+    assert kept.tolist() == [0, 4, 8]
+
+def test_slerp_constant_speed():
+    rotations = AxisQuaternions(np.array((1.0, 2.0, 2.0)) / 3.0, np.arange(40) * 4.0)
+    times = np.arange(40) / 30.0
+    kept = ReduceKeyframes(times, None, rotations, None, 0.001, np.radians(0.1), 0.001)
+    assert kept.tolist() == [0, 39]
+
+def test_near_static_channel():
+    rng = np.random.default_rng(5)
+    times = np.arange(5000) / 30.0
+    positions = 1.0 + rng.uniform(-1e-5, 1e-5, size=(5000, 3))
+    scales = np.ones((5000, 3))
+    kept = ReduceKeyframes(times, positions, None, scales, 0.001, 0.001, 0.001)
+    assert kept.tolist() == [0, 4999]
+
+def test_errors_within_tolerance():
+    rng = np.random.default_rng(7)
+    count = 300
+    times = np.cumsum(rng.uniform(0.01, 0.05, size=count))
+    positions = np.cumsum(rng.normal(scale=0.01, size=(count, 3)), axis=0)
+    angles = np.cumsum(rng.normal(scale=1.0, size=count))
+    rotations = AxisQuaternions((0.0, 1.0, 0.0), angles)
+    positionTolerance = 0.005
+    rotationTolerance = np.radians(0.5)
+    kept = ReduceKeyframes(times, positions, rotations, None, positionTolerance, rotationTolerance, 0.001)
+    assert kept[0] == 0 and kept[-1] == count - 1
+    assert len(kept) < count
+    # Rebuild the removed keyframes as Urho3D does
+    segment = np.searchsorted(kept, np.arange(count), side='right') - 1
+    segment = np.minimum(segment, len(kept) - 2)
+    start = kept[segment]
+    end = kept[segment + 1]
+    t = (times - times[start]) / (times[end] - times[start])
+    rebuilt = positions[start] + (positions[end] - positions[start]) * t[:, None]
+    assert np.linalg.norm(rebuilt - positions, axis=1).max() <= positionTolerance
+    slerped = QuaternionsSlerp(rotations[start], rotations[end], t)
+    assert QuaternionsAngle(slerped, rotations).max() <= rotationTolerance
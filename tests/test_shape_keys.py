@@ -0,0 +1,77 @@
+#
+# This script is licensed as public domain.
+#
+
+# Tests of the shape keys coordinates (shape_keys.py), run with: python -m pytest tests
+
+import os
+import sys
+import pytest
+
+np = pytest.importorskip("numpy")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shape_keys import ReadShapeKeysCoords, AppliedShapeKeysValues, ShapeKeyCoords
+
+# Minimal key block: foreach_get of the coordinates, value, mute and relative key
+class KeyData:
+    def __init__(self, coords):
+        self.coords = coords
+
+    def foreach_get(self, name, buffer):
+        assert name == "co"
+        buffer[:] = self.coords.ravel()
+
+class KeyBlock:
+    def __init__(self, coords, value=0.0, relative=0, mute=False):
+        self.data = KeyData(np.asarray(coords, dtype=np.float32))
+        self.value = value
+        self.relative = relative
+        self.mute = mute
+
+# Relative shape keys mixed at 'values' as Blender does
+def EvaluateKeys(keyBlocks, values):
+    coords = ReadShapeKeysCoords(keyBlocks, len(keyBlocks[0].data.coords))
+    result = coords[0].copy()
+    for i, block in enumerate(keyBlocks[1:], 1):
+        if not block.mute:
+            result += values[i] * (coords[i] - coords[block.relative])
+    return result
+
+def MakeKeys():
+    basis = np.array([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [0.0, 1.0, 0.0]])
+    keyA = basis + [[0.0, 0.0, 1.0], [0.0, 0.0, 0.0], [0.0, 0.0, 0.5]]
+    keyB = basis + [[0.5, 0.0, 0.0], [0.0, 2.0, 0.0], [0.0, 0.0, 0.0]]
+    # Key C is relative to A
+    keyC = keyA + [[0.0, 0.0, 0.0], [0.0, 0.0, -1.0], [0.0, 0.0, 0.0]]
+    return [KeyBlock(basis), KeyBlock(keyA, 0.3), KeyBlock(keyB, 0.5), KeyBlock(keyC, 0.25, relative=1),
+            KeyBlock(keyB * 2.0, 0.75, mute=True)]
+
+def Values(keyBlocks):
+    return [0.0 if block.mute else block.value for block in keyBlocks]
+
+def test_evaluated_mesh_keys_at_full():
+    keyBlocks = MakeKeys()
+    coords = ReadShapeKeysCoords(keyBlocks, 3)
+    values = AppliedShapeKeysValues(keyBlocks, True)
+    assert values.tolist() == [0.0, 0.3, 0.5, 0.25, 0.0]
+    # The evaluated mesh has all the keys at their current values
+    baseCoords = EvaluateKeys(keyBlocks, Values(keyBlocks))
+    for index in (1, 2, 3):
+        expected = Values(keyBlocks)
+        expected[index] = 1.0
+        result = ShapeKeyCoords(baseCoords, coords, index, keyBlocks[index].relative, values[index])
+        assert np.allclose(result, EvaluateKeys(keyBlocks, expected))
+
+def test_mesh_data_keys_at_full():
+    keyBlocks = MakeKeys()
+    coords = ReadShapeKeysCoords(keyBlocks, 3)
+    values = AppliedShapeKeysValues(keyBlocks, False)
+    assert not values.any()
+    # The mesh data vertices are the basis
+    baseCoords = coords[0]
+    for index in (1, 2, 3):
+        expected = [0.0] * len(keyBlocks)
+        expected[index] = 1.0
+        result = ShapeKeyCoords(baseCoords, coords, index, keyBlocks[index].relative, values[index])
+        assert np.allclose(result, EvaluateKeys(keyBlocks, expected))
@@ -9,6 +9,7 @@ from xml.etree import ElementTree as ET
 from xml.dom import minidom
 import os
 import struct
+import hashlib
 import array
 import logging
 import bpy
@@ -225,6 +226,210 @@ def XmlToPrettyString(elem):
     return pretty.strip()
 
 
+#--------------------
+# Disk cache
+#--------------------
+
+# Name of the cache folder in the output path
+DISK_CACHE_DIR = ".urhocache"
+
+# Persistent cache of binary data (bytes) stored in a directory, one file per key.
+# When the total size exceeds 'maxSize' bytes the least recently used entries
+# are deleted (the file modification time is the last use).
+class DiskCache:
+    def __init__(self, directory, maxSize = 256 * 1024 * 1024):
+        # Directory where the entries are saved
+        self.directory = directory
+        # Maximum size of the cache in bytes
+        self.maxSize = maxSize
+        # Running total size of the entries in bytes, None until the directory is scanned
+        self.size = None
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+
+    # Returns the key (hex digest) of a sequence of parts (bytes, str, numbers, numpy arrays)
+    @staticmethod
+    def Key(*parts):
+        digest = hashlib.sha1()
+        for part in parts:
+            if hasattr(part, "tobytes"):
+                part = part.tobytes()
+            elif not isinstance(part, (bytes, bytearray)):
+                part = repr(part).encode("utf-8")
+            # Prefix the length to separate the parts
+            digest.update(struct.pack("<Q", len(part)))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def filepath(self, key):
+        return os.path.join(self.directory, key + ".bin")
+
+    # Returns the data saved with 'key' or None
+    def get(self, key):
+        filepath = self.filepath(key)
+        try:
+            with open(filepath, "rb") as file:
+                data = file.read()
+            # Mark as recently used
+            os.utime(filepath, None)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    # Saves 'data' with 'key'
+    def put(self, key, data):
+        filepath = self.filepath(key)
+        tempPath = filepath + ".tmp"
+        try:
+            oldSize = os.path.getsize(filepath)
+        except OSError:
+            oldSize = 0
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tempPath, "wb") as file:
+                file.write(data)
+            os.replace(tempPath, filepath)
+        except OSError as e:
+            log.warning("Cannot write cache file {:s}: {!s}".format(filepath, e))
+            return
+        # Scan the directory only the first time, then keep the total updated
+        if self.size is not None:
+            self.size += len(data) - oldSize
+            if self.size <= self.maxSize:
+                return
+        self.evict()
+
+    # Deletes the least recently used entries until the cache fits in 'maxSize' with
+    # some room left, so a full cache is not scanned again at the next put. Updates
+    # the total size from the entries found in the directory.
+    def evict(self):
+        targetSize = self.maxSize * 0.9
+        entries = []
+        totalSize = 0
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.is_file() and entry.name.endswith(".bin"):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                        totalSize += stat.st_size
+        except OSError:
+            return
+        if totalSize > self.maxSize:
+            entries.sort()
+            for mtime, size, path in entries:
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                totalSize -= size
+                if totalSize <= targetSize:
+                    break
+        self.size = totalSize
+
+
+#--------------------
+# Temporary datablocks
+#--------------------
+
+# Owner of the temporary meshes and objects created during an export, use it in a
+# 'with' statement so they are released at the end even when an error occurs.
+# Evaluated meshes (to_mesh) are cleared, meshes and objects are removed from bpy.data.
+# Counts are also added to the 'parent' owner, so the outer owner has the peak of
+# all the nested ones.
+class TempDatablocks:
+    def __init__(self, parent = None):
+        # Outer owner
+        self.parent = parent
+        # Objects and depsgraphs of the evaluated objects with a mesh from to_mesh()
+        self.evaluatedObjects = []
+        # Meshes and objects in bpy.data
+        self.meshes = []
+        self.objects = []
+        # Statistics: live datablocks, maximum live datablocks, total created
+        self.count = 0
+        self.peak = 0
+        self.created = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.release()
+        return False
+
+    def added(self, count):
+        owner = self
+        while owner:
+            owner.count += count
+            if count > 0:
+                owner.created += count
+                owner.peak = max(owner.peak, owner.count)
+            owner = owner.parent
+
+    # Returns the mesh of the object 'obj' evaluated with 'depsgraph', owned by the object.
+    # Note: a new call on the same object frees the previous mesh.
+    def toMesh(self, obj, depsgraph, **kwargs):
+        mesh = obj.evaluated_get(depsgraph).to_mesh(**kwargs)
+        if (obj, depsgraph) not in self.evaluatedObjects:
+            self.evaluatedObjects.append((obj, depsgraph))
+            self.added(1)
+        return mesh
+
+    # Returns a new mesh in bpy.data from the object 'obj' evaluated with 'depsgraph'
+    def meshFromObject(self, obj, depsgraph, **kwargs):
+        mesh = bpy.data.meshes.new_from_object(obj.evaluated_get(depsgraph), depsgraph=depsgraph, **kwargs)
+        self.meshes.append(mesh)
+        self.added(1)
+        return mesh
+
+    # Returns a copy of 'mesh' in bpy.data
+    def copyMesh(self, mesh):
+        mesh = mesh.copy()
+        self.meshes.append(mesh)
+        self.added(1)
+        return mesh
+
+    # Takes ownership of a temporary object 'obj'
+    def addObject(self, obj):
+        self.objects.append(obj)
+        self.added(1)
+        return obj
+
+    # Removes now a mesh created by meshFromObject or copyMesh
+    def removeMesh(self, mesh):
+        if mesh in self.meshes:
+            self.meshes.remove(mesh)
+            bpy.data.meshes.remove(mesh)
+            self.added(-1)
+
+    # Releases all the datablocks, evaluated meshes first because removing an object
+    # also frees its evaluated copy
+    def release(self):
+        for obj, depsgraph in self.evaluatedObjects:
+            try:
+                obj.evaluated_get(depsgraph).to_mesh_clear()
+            except ReferenceError:
+                pass
+        for mesh in self.meshes:
+            try:
+                bpy.data.meshes.remove(mesh)
+            except ReferenceError:
+                pass
+        for obj in self.objects:
+            try:
+                bpy.data.objects.remove(obj, do_unlink=True)
+            except ReferenceError:
+                pass
+        self.added(-(len(self.objects) + len(self.meshes) + len(self.evaluatedObjects)))
+        self.objects.clear()
+        self.meshes.clear()
+        self.evaluatedObjects.clear()
+
+
 #--------------------
 # XML writers
 #--------------------
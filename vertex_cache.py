@@ -0,0 +1,515 @@
+
+#
+# This script is licensed as public domain.
+#
+
+# Triangle ordering for the GPU post-transform vertex cache.
+# This module only needs NumPy (no bpy, no mathutils), so it can also run
+# outside Blender.
+
+import heapq
+import os
+import sys
+import queue
+import threading
+import subprocess
+import numpy as np
+
+#--------------------
+# Linear-Speed Vertex Cache Optimisation algorithm by Tom Forsyth
+#  https://home.comcast.net/~tom_forsyth/papers/fast_vert_cache_opt.html
+#--------------------
+
+#  We try to sort triangles in the index buffer so that we gain an optimal use
+#  of the hardware vertices cache.
+#  We assign a score to each triangle, we find the best and save it in a new
+#  ordered list.
+#  The score of each triangle is the sum of the score of its vertices, and the
+#  score of a vertex is higher if it is:
+#  - used recently (it is still in the cache) but we also try to avoid the last
+#    triangle added (n this way we get better result),
+#  - lonely isolated vertices (otherwise the will be keep for last and drawing
+#    them will require an higher cost)
+#  The order of vertices in the triangle does not matter.
+#  We'll apply this optimization to each lod of each geometry.
+
+# These are the constants used in the algorithm:
+VERTEX_CACHE_SIZE = 32
+CACHE_DECAY_POWER = 1.5
+LAST_TRI_SCORE = 0.75
+VALENCE_BOOST_SCALE = 2.0
+VALENCE_BOOST_POWER = 0.5
+
+# Compact the vertex indices of 'triangles' (array triangles x 3) to 0..count-1.
+# Returns the compacted triangles, the vertices count and, for each vertex, the
+# triangles using it as CSR arrays (offsets, triangle indices).
+def TriangleAdjacency(triangles):
+    vertices, corners = np.unique(triangles, return_inverse=True)
+    corners = corners.reshape(-1)
+    count = len(vertices)
+    valence = np.bincount(corners, minlength=count)
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(valence, out=offsets[1:])
+    adjacency = np.argsort(corners, kind='stable') // 3
+    return corners.reshape(-1, 3), count, offsets, adjacency
+
+# Score of a vertex at each cache position (see CalculateScore in the paper)
+def CachePositionScores(cacheSize):
+    scores = [LAST_TRI_SCORE] * min(3, cacheSize)
+    for position in range(3, cacheSize):
+        # Points for being high in the cache
+        score = 1.0 - float(position - 3) / (cacheSize - 3)
+        scores.append(pow(score, CACHE_DECAY_POWER))
+    return scores
+
+# Bonus points for having a low number of tris still to use the vert, so we
+# get rid of lone verts quickly
+def ValenceScores(maxValence):
+    return [-1.0] + [VALENCE_BOOST_SCALE * pow(n, -VALENCE_BOOST_POWER) for n in range(1, maxValence + 1)]
+
+# Returns the new order (array of triangle indices) of 'triangles' (array or list of
+# triples of vertex indices) for an optimal use of a vertex cache of 'cacheSize'.
+# Triangles and vertices are kept in integer arrays: vertex to triangles adjacency
+# in CSR format (emitted triangles are swapped out of the live part of each vertex
+# range), emitted flags, a fixed size LRU cache and a max-heap of triangle scores
+# with lazy deletion for when no triangle in the cache is left. Each step only
+# updates the vertices in the cache, so the time is linear with the triangles count.
+def ForsythOrder(triangles, cacheSize = VERTEX_CACHE_SIZE):
+    triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+    trianglesCount = len(triangles)
+    if trianglesCount == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    corners, verticesCount, offsets, adjacency = TriangleAdjacency(triangles)
+    # Plain lists are faster than arrays for single element access
+    corners = corners.tolist()
+    adjacency = adjacency.tolist()
+    starts = offsets[:-1].tolist()
+    liveCount = (offsets[1:] - offsets[:-1]).tolist()
+
+    positionScores = CachePositionScores(cacheSize)
+    valenceScores = ValenceScores(max(liveCount))
+
+    # Current score of each vertex and each triangle
+    vertexScores = [valenceScores[n] for n in liveCount]
+    triangleScores = [vertexScores[a] + vertexScores[b] + vertexScores[c] for a, b, c in corners]
+
+    # Position of each vertex in the cache (-1 if not in the cache)
+    cachePositions = [-1] * verticesCount
+    # Cache of vertex indices, most recent first
+    vertexCache = []
+
+    # Max-heap of (-score, triangle), entries can be old: emitted triangles are
+    # skipped and triangles with a changed score are pushed again
+    heap = [(-score, i) for i, score in enumerate(triangleScores)]
+    heapq.heapify(heap)
+
+    emitted = bytearray(trianglesCount)
+    newOrder = []
+    bestTriangle = -1
+
+    while len(newOrder) < trianglesCount:
+        if bestTriangle < 0:
+            # No triangle in the cache, get the best from the heap
+            while heap:
+                negScore, triangle = heapq.heappop(heap)
+                if emitted[triangle]:
+                    continue
+                if -negScore != triangleScores[triangle]:
+                    heapq.heappush(heap, (-triangleScores[triangle], triangle))
+                    continue
+                bestTriangle = triangle
+                break
+            if bestTriangle < 0:
+                break
+
+        # Move the best triangle to the output list
+        emitted[bestTriangle] = 1
+        newOrder.append(bestTriangle)
+        triangleCorners = corners[bestTriangle]
+
+        # Remove the triangle from the live triangles of its vertices
+        for vertex in triangleCorners:
+            start = starts[vertex]
+            last = start + liveCount[vertex] - 1
+            for i in range(start, last + 1):
+                if adjacency[i] == bestTriangle:
+                    adjacency[i] = adjacency[last]
+                    adjacency[last] = bestTriangle
+                    break
+            liveCount[vertex] -= 1
+
+        # Model the LRU cache behaviour, push the triangle vertices to the front
+        a, b, c = triangleCorners
+        newCache = [a, b, c]
+        for vertex in vertexCache:
+            if vertex != a and vertex != b and vertex != c:
+                newCache.append(vertex)
+        # Vertices pushed out of the cache
+        evicted = newCache[cacheSize:]
+        vertexCache = newCache[:cacheSize]
+
+        # Update positions & scores of all vertices in the cache
+        for position, vertex in enumerate(vertexCache):
+            cachePositions[vertex] = position
+            if liveCount[vertex]:
+                vertexScores[vertex] = positionScores[position] + valenceScores[liveCount[vertex]]
+            else:
+                vertexScores[vertex] = -1.0
+        for vertex in evicted:
+            cachePositions[vertex] = -1
+            vertexScores[vertex] = valenceScores[liveCount[vertex]]
+
+        # Update the score of the triangles in the cache and find the best
+        bestTriangle = -1
+        bestScore = None
+        for vertex in vertexCache:
+            start = starts[vertex]
+            for i in range(start, start + liveCount[vertex]):
+                triangle = adjacency[i]
+                a, b, c = corners[triangle]
+                score = vertexScores[a] + vertexScores[b] + vertexScores[c]
+                triangleScores[triangle] = score
+                if bestScore is None or score > bestScore:
+                    bestScore = score
+                    bestTriangle = triangle
+        # Triangles of the vertices out of the cache go back in the heap with their new score
+        for vertex in evicted:
+            start = starts[vertex]
+            for i in range(start, start + liveCount[vertex]):
+                triangle = adjacency[i]
+                a, b, c = corners[triangle]
+                score = vertexScores[a] + vertexScores[b] + vertexScores[c]
+                triangleScores[triangle] = score
+                heapq.heappush(heap, (-score, triangle))
+
+    return np.array(newOrder, dtype=np.int64)
+
+#--------------------
+# "Fast Triangle Reordering for Vertex Locality and Reduced Overdraw" (Tipsify)
+#  by Sander, Nehab, Barczak, 2007
+#--------------------
+
+#  Starting from a vertex (the fanning vertex) we emit all its triangles, then
+#  we choose as next fanning vertex a vertex of these triangles which will be
+#  still in the cache after its remaining triangles are emitted, preferring the
+#  oldest in the cache. If there are no such vertices we go back to the last
+#  vertices used that still have triangles (dead-end stack) or to the next 
+#  vertex in input order.
+#  The time is linear with the triangles count and the cache size is a parameter.
+
+# Returns the new order (array of triangle indices) of 'triangles' (array or list of
+# triples of vertex indices) for a vertex cache of 'cacheSize'
+def TipsifyOrder(triangles, cacheSize = VERTEX_CACHE_SIZE):
+    triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+    trianglesCount = len(triangles)
+    if trianglesCount == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    corners, verticesCount, offsets, adjacency = TriangleAdjacency(triangles)
+    corners = corners.tolist()
+    adjacency = adjacency.tolist()
+    starts = offsets[:-1].tolist()
+    ends = offsets[1:].tolist()
+    # Count of live (not emitted) triangles of each vertex
+    liveCount = (offsets[1:] - offsets[:-1]).tolist()
+
+    # Time stamp of each vertex in the cache, a vertex is in the cache if
+    # time - timeStamps[vertex] <= cacheSize
+    timeStamps = [0] * verticesCount
+    time = cacheSize + 1
+    # Dead-end vertex stack
+    deadEnd = []
+    emitted = bytearray(trianglesCount)
+    newOrder = []
+    # Cursor for the next vertex in input order
+    cursor = 0
+
+    # Fanning vertex
+    fanning = 0
+    while fanning >= 0:
+        # 1-ring of the fanning vertex, candidates for the next fanning vertex
+        candidates = []
+        for i in range(starts[fanning], ends[fanning]):
+            triangle = adjacency[i]
+            if emitted[triangle]:
+                continue
+            for vertex in corners[triangle]:
+                deadEnd.append(vertex)
+                candidates.append(vertex)
+                liveCount[vertex] -= 1
+                # Not in the cache
+                if time - timeStamps[vertex] > cacheSize:
+                    timeStamps[vertex] = time
+                    time += 1
+            emitted[triangle] = 1
+            newOrder.append(triangle)
+
+        # Get the next fanning vertex, the candidate with the highest priority
+        fanning = -1
+        bestPriority = -1
+        for vertex in candidates:
+            if liveCount[vertex] > 0:
+                priority = 0
+                # Will it still be in the cache after fanning all its triangles?
+                if time - timeStamps[vertex] + 2 * liveCount[vertex] <= cacheSize:
+                    priority = time - timeStamps[vertex]
+                if priority > bestPriority:
+                    bestPriority = priority
+                    fanning = vertex
+
+        # Skip the dead-end
+        if fanning < 0:
+            while deadEnd:
+                vertex = deadEnd.pop()
+                if liveCount[vertex] > 0:
+                    fanning = vertex
+                    break
+        if fanning < 0:
+            while cursor < verticesCount:
+                if liveCount[cursor] > 0:
+                    fanning = cursor
+                    break
+                cursor += 1
+
+    return np.array(newOrder, dtype=np.int64)
+
+#--------------------
+# Vertex cache statistics
+#--------------------
+
+# Simulate a FIFO vertex cache of 'cacheSize' drawing 'triangles', returns the
+# number of cache misses of each triangle (0..3)
+def CacheMisses(triangles, cacheSize = VERTEX_CACHE_SIZE):
+    corners, verticesCount, offsets, adjacency = TriangleAdjacency(triangles)
+    # Time stamp (miss count) when each vertex entered the cache
+    timeStamps = [-cacheSize - 1] * verticesCount
+    cornerMisses = bytearray(corners.size)
+    misses = 0
+    for i, vertex in enumerate(corners.ravel().tolist()):
+        if misses - timeStamps[vertex] > cacheSize:
+            timeStamps[vertex] = misses
+            misses += 1
+            cornerMisses[i] = 1
+    return np.frombuffer(bytes(cornerMisses), dtype=np.uint8).reshape(-1, 3).sum(axis=1)
+
+# Simulate a FIFO vertex cache of 'cacheSize' drawing 'triangles', returns the
+# average cache miss ratio (ACMR: transformed vertices per triangle) and the 
+# average transform to vertex ratio (ATVR: transformed vertices per vertex, 1.0 is 
+# the optimum)
+def CacheStatistics(triangles, cacheSize = VERTEX_CACHE_SIZE):
+    triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+    if len(triangles) == 0:
+        return 0.0, 0.0
+    misses = int(CacheMisses(triangles, cacheSize).sum())
+    return misses / len(triangles), misses / len(np.unique(triangles))
+
+#--------------------
+# View independent overdraw optimisation, from "Fast Triangle Reordering for
+# Vertex Locality and Reduced Overdraw" (Sander, Nehab, Barczak, 2007)
+#--------------------
+
+#  The triangles, already sorted for the vertex cache, are split in clusters:
+#  - hard boundaries where the cache is flushed (all the vertices of a triangle
+#    are cache misses),
+#  - soft boundaries where a triangle has a cache miss and the ACMR of the
+#    cluster so far is below 'threshold' times the ACMR of the whole list.
+#  Then the clusters are sorted so that the ones more likely to occlude the
+#  others are drawn first: the occlusion potential is the dot product between
+#  the cluster normal and the vector from the mesh centroid to the cluster
+#  centroid (clusters facing outward are drawn first).
+#  An higher threshold gives more clusters: less overdraw but higher ACMR.
+
+# Returns the new order (array of triangle indices) of 'triangles' (array or list of
+# triples of vertex indices), 'positions' is the array of the vertices positions
+# (indexed by the triangles vertex indices). Triangles faces must be clockwise
+# (Urho3D, left hand).
+def OverdrawOrder(triangles, positions, cacheSize = VERTEX_CACHE_SIZE, threshold = 1.05):
+    triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+    trianglesCount = len(triangles)
+    if trianglesCount == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # Find the clusters boundaries
+    misses = CacheMisses(triangles, cacheSize)
+    maxClusterMisses = threshold * misses.sum() / trianglesCount
+    boundaries = np.zeros(trianglesCount, dtype=bool)
+    clusterMisses = 0
+    clusterCount = 0
+    for i, triangleMisses in enumerate(misses.tolist()):
+        if clusterCount and (triangleMisses == 3 or
+                (triangleMisses and clusterMisses <= maxClusterMisses * clusterCount)):
+            boundaries[i] = True
+            clusterMisses = 0
+            clusterCount = 0
+        clusterMisses += triangleMisses
+        clusterCount += 1
+    starts = np.flatnonzero(boundaries)
+    starts = np.concatenate(([0], starts))
+    clustersCount = len(starts)
+    clusterIds = np.cumsum(boundaries)
+
+    # Triangles area weighted normals (facing out) and centroids
+    p = np.asarray(positions, dtype=np.float64)[triangles]
+    normals = np.cross(p[:, 1] - p[:, 0], p[:, 2] - p[:, 0])
+    areas = np.linalg.norm(normals, axis=1)
+    centroids = p.mean(axis=1)
+    if areas.sum() > 0.0:
+        meshCentroid = (centroids * areas[:, None]).sum(axis=0) / areas.sum()
+    else:
+        meshCentroid = centroids.mean(axis=0)
+
+    # Clusters normals and centroids
+    clusterNormals = np.empty((clustersCount, 3))
+    clusterCentroids = np.empty((clustersCount, 3))
+    clusterAreas = np.bincount(clusterIds, weights=areas, minlength=clustersCount)
+    clusterSizes = np.bincount(clusterIds, minlength=clustersCount)
+    for i in range(3):
+        clusterNormals[:, i] = np.bincount(clusterIds, weights=normals[:, i], minlength=clustersCount)
+        weightedSum = np.bincount(clusterIds, weights=centroids[:, i] * areas, minlength=clustersCount)
+        plainSum = np.bincount(clusterIds, weights=centroids[:, i], minlength=clustersCount)
+        clusterCentroids[:, i] = np.where(clusterAreas > 0.0, weightedSum / np.maximum(clusterAreas, 1e-30), plainSum / clusterSizes)
+    lengths = np.linalg.norm(clusterNormals, axis=1)
+    np.divide(clusterNormals, lengths[:, None], out=clusterNormals, where=(lengths[:, None] > 0.0))
+
+    # Sort clusters by decreasing occlusion potential
+    potentials = np.einsum('ij,ij->i', clusterCentroids - meshCentroid, clusterNormals)
+    clusterOrder = np.argsort(-potentials, kind='stable')
+
+    ends = np.append(starts[1:], trianglesCount)
+    return np.concatenate([np.arange(starts[c], ends[c]) for c in clusterOrder.tolist()])
+
+
+#--------------------
+# Worker processes
+#--------------------
+
+#  The optimizers only need the triangles, so each LOD can be sent to a worker
+#  process and optimized on another core. A worker is this script executed by
+#  the Python interpreter shipped with Blender, it reads jobs from stdin and
+#  writes results to stdout:
+#  - job: int32 header (triangles count, cache size, mode index) followed by the
+#    int32 triangles (count x 3),
+#  - result: the int32 new order of the triangles (count).
+#  If a worker cannot be started or fails, its jobs are optimized serially.
+
+OPTIMIZE_MODES = ('FORSYTH', 'TIPSIFY')
+
+# Returns the new order of 'triangles' for the vertex cache, 'mode' is one of OPTIMIZE_MODES
+def OptimizeOrder(triangles, mode = 'FORSYTH', cacheSize = VERTEX_CACHE_SIZE):
+    if mode == 'TIPSIFY':
+        return TipsifyOrder(triangles, cacheSize)
+    return ForsythOrder(triangles, cacheSize)
+
+# Read exactly 'size' bytes from 'stream', returns None at the end of the stream
+def ReadExactly(stream, size):
+    chunks = []
+    while size > 0:
+        chunk = stream.read(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+class OptimizePool:
+    def __init__(self, workersCount, pythonPath = None):
+        # Maximum number of worker processes
+        self.workersCount = workersCount
+        # Python interpreter used to run the workers
+        self.pythonPath = pythonPath or sys.executable
+        # Running workers (subprocess.Popen)
+        self.workers = []
+        # True if the workers cannot be started
+        self.failed = False
+
+    # Start the workers (only the first time), returns the number of running workers
+    def start(self, count):
+        count = min(count, self.workersCount)
+        if self.failed:
+            return len(self.workers)
+        while len(self.workers) < count:
+            try:
+                worker = subprocess.Popen([self.pythonPath, os.path.abspath(__file__)],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0))
+            except (OSError, ValueError):
+                self.failed = True
+                break
+            self.workers.append(worker)
+        return len(self.workers)
+
+    # Send a job to a worker and wait for its result
+    def run(self, worker, triangles, mode, cacheSize):
+        header = np.array((len(triangles), cacheSize, OPTIMIZE_MODES.index(mode)), dtype=np.int32)
+        worker.stdin.write(header.tobytes())
+        worker.stdin.write(triangles.tobytes())
+        worker.stdin.flush()
+        data = ReadExactly(worker.stdout, len(triangles) * 4)
+        if data is None:
+            raise EOFError("vertex cache worker terminated")
+        return np.frombuffer(data, dtype=np.int32).astype(np.int64)
+
+    # Returns the new order of each triangles array in 'trianglesList' (see OptimizeOrder)
+    def map(self, trianglesList, mode = 'FORSYTH', cacheSize = VERTEX_CACHE_SIZE):
+        jobs = [np.ascontiguousarray(np.asarray(t, dtype=np.int32).reshape(-1, 3)) for t in trianglesList]
+        results = [None] * len(jobs)
+        # With one job there is nothing to gain
+        if len(jobs) > 1 and self.start(len(jobs)) > 0:
+            jobsQueue = queue.Queue()
+            for i in sorted(range(len(jobs)), key=lambda i: -len(jobs[i])):
+                jobsQueue.put(i)
+            deadWorkers = []
+
+            def Consume(worker):
+                while True:
+                    try:
+                        i = jobsQueue.get_nowait()
+                    except queue.Empty:
+                        return
+                    try:
+                        results[i] = self.run(worker, jobs[i], mode, cacheSize)
+                    except (OSError, ValueError, EOFError):
+                        # The job will be done serially
+                        deadWorkers.append(worker)
+                        return
+
+            threads = [threading.Thread(target=Consume, args=(w,)) for w in self.workers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            for worker in deadWorkers:
+                self.workers.remove(worker)
+                worker.kill()
+        # Serial fallback
+        for i, triangles in enumerate(jobs):
+            if results[i] is None:
+                results[i] = OptimizeOrder(triangles, mode, cacheSize)
+        return results
+
+    # Stop the workers
+    def close(self):
+        for worker in self.workers:
+            try:
+                worker.stdin.close()
+                worker.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                worker.kill()
+            worker.stdout.close()
+        self.workers = []
+
+# Worker process main loop
+def WorkerMain(stdin, stdout):
+    while True:
+        header = ReadExactly(stdin, 12)
+        if header is None:
+            break
+        count, cacheSize, modeIndex = np.frombuffer(header, dtype=np.int32).tolist()
+        triangles = np.frombuffer(ReadExactly(stdin, count * 12), dtype=np.int32).reshape(-1, 3)
+        newOrder = OptimizeOrder(triangles, OPTIMIZE_MODES[modeIndex], cacheSize)
+        stdout.write(np.asarray(newOrder, dtype=np.int32).tobytes())
+        stdout.flush()
+
+if __name__ == "__main__":
+    WorkerMain(sys.stdin.buffer, sys.stdout.buffer)